@@ -15,10 +15,14 @@ import logging
 import argparse
 import pprint
 import re
+import json
 from modules.resources import user_path, update_file, UPDATE_URL
 from modules.update import update_compressed_file
 import modules.version as version
 from modules.loadOrder import loadorder
+import modules.batch as batch
+import modules.server as server
+import modules.profiler as profiler
 from modules.translations import dump_translations, _
 
 def single_spaced(in_string):
@@ -65,7 +69,17 @@ class ListVersions(argparse.Action):
 def command_line_mode(args):
     """Run in command line mode.  This assumes log levels were properly set up beforehand"""
     logging.info("%s %s", version.full_version(), _["Hello!"])
-    if args.fromfile:
+    if args.serve:
+        server.serve(args.serve)
+    elif args.fromfile and args.batch:
+        results = batch.check_files(args.fromfile, args.jobs)
+        if results == None:
+            sys.exit(1)
+        if args.report_dir:
+            batch.write_reports(results, args.report_dir, args.fromfile)
+        else:
+            batch.write_json(results, sys.stdout)
+    elif args.fromfile:
         for fromfile in args.fromfile:
             my_loadorder = loadorder()
             my_loadorder.read_from_file(fromfile)
@@ -85,22 +99,54 @@ def process_load_order(a_loadorder, args):
     No matter how the list of plugins is obtained, what's done here stays the same.
     """
     if args.explain:
-        print(a_loadorder.explain(args.explain[0], args.base_only))
+        explanation = a_loadorder.explain(args.explain[0], args.base_only)
+        if args.json:
+            print(json.dumps({"type": "explanation", "plugin": args.explain[0], "explanation": explanation}))
+        else:
+            print(explanation)
         sys.exit(0)
+    a_loadorder.check_records = args.records
+    if args.json:
+        print_json(a_loadorder, args)
+        return
     if args.quiet:
         a_loadorder.update()
     else:
-        print(a_loadorder.update())
+        messages = a_loadorder.update()
+        with profiler.stage("print results"):
+            print(messages)
     if not args.warningsonly:
-        print("{0:-^80}".format('[New Load Order]'))
-        for plugin in a_loadorder.get_new_order():
-            print(plugin)
+        with profiler.stage("print results"):
+            print("{0:-^80}".format('[New Load Order]'))
+            for plugin in a_loadorder.get_new_order():
+                print(plugin)
         if args.update:
-            a_loadorder.write_new_order()
+            a_loadorder.write_new_order(args.minimal)
             print("{0:-^80}".format('[LOAD ORDER SAVED]'))
         else:
             print("{0:-^80}".format('[END PROPOSED LOAD ORDER]'))
 
+def print_json(a_loadorder, args):
+    """
+    Update a load order, and print the results as JSON, one object per line.
+
+    Each message is printed as soon as the load order is updated, as {"type": "message", ...} (see ruleEvaluator.rule_message.to_dict).
+    Then, unless --warningsonly is given, the new load order is printed as {"type": "load_order", ...}
+    """
+    if a_loadorder.update(text = False) == False:
+        print(json.dumps({"type": "error", "error": "Unable to sort the load order"}))
+        return
+    for message in a_loadorder.messages:
+        out = {"type": "message"}
+        out.update(message.to_dict())
+        print(json.dumps(out), flush=True)
+    if args.warningsonly:
+        return
+    out = {"type": "load_order", "is_sorted": a_loadorder.is_sorted, "new_order": a_loadorder.new_order_entries()}
+    if args.update:
+        out["saved"] = a_loadorder.write_new_order(args.minimal)
+    print(json.dumps(out), flush=True)
+
 if __name__ == "__main__":
     #Configure logging from python module
     logging.getLogger('').setLevel(logging.DEBUG)
@@ -150,6 +196,26 @@ if __name__ == "__main__":
     writer_group.add_argument("-w", "--warningsonly",
         help="Warnings only, do not display the new load order.\nImplies --check.",
         action="store_true")
+    parser.add_argument("--json",
+        help=single_spaced("""
+            Print the results as JSON, one object per line, instead of text.
+            Each message is an object with its kind, rules file and line, the plugins (or expressions) it is about, and the message from the rule.
+            The new load order comes last.
+            """),
+        action="store_true")
+    parser.add_argument("-r", "--records",
+        help=single_spaced("""
+            Also report plugins that change the same records, along with the conflicts from the rules.
+            Reading every record is slow the first time, after that only changed plugins are read again.
+            Only Morrowind plugins are checked.
+            """),
+        action="store_true")
+    parser.add_argument("-m", "--minimal",
+        help=single_spaced("""
+            Use this with the --update option to only change the modification times of plugins that have to move.
+            All other plugins (and the .bsa files) are left alone.
+            """),
+        action="store_true")
 
     #The strange double add is to make the exclusive group its own section in the help text
     verbosity_group = parser.add_argument_group('Verbosity Controls', 'Select ONLY one of these to set how much output to recieve.').add_mutually_exclusive_group()
@@ -173,6 +239,28 @@ if __name__ == "__main__":
         metavar='file',
         nargs='+',
         type=str)
+    parser.add_argument("-b", "--batch",
+        help=single_spaced("""
+            Use this with the --fromfile option to check many load orders quickly.
+            The rules are only read once, and the results are printed as one line of JSON per file.
+            """),
+        action="store_true")
+    parser.add_argument("--jobs",
+        help="Use this with the --batch option to check load orders on this many processes at once.",
+        metavar='N',
+        type=int)
+    parser.add_argument("--report-dir",
+        help="Use this with the --batch option to write a report for each file into a directory, instead of printing JSON.",
+        metavar='dir',
+        type=str)
+    parser.add_argument("--serve",
+        help=single_spaced("""
+            Keep running, and answer requests to sort, check, or explain load orders.
+            The rules are only read once, instead of for every load order.
+            Give a port number to answer JSON requests over HTTP on localhost, or a path to use a Unix socket.
+            """),
+        metavar='address',
+        type=str)
     parser.add_argument("-e", "--explain",
         help=single_spaced("""
             Print an explanation of the dependency graph for plugin.
@@ -203,8 +291,21 @@ if __name__ == "__main__":
         nargs=0,
         action=ListVersions)
     developer_group.add_argument("--profile",
-        help="Use hotshot to profile the application.",
+        help=single_spaced("""
+            Profile the application with cProfile, and print how long each stage took.
+            Profiling slows mlox down, so compare the stages with each other.
+            """),
+        action="store_true")
+    developer_group.add_argument("--profile-memory",
+        help="Use this with the --profile option to also record how much memory each stage allocates.",
         action="store_true")
+    developer_group.add_argument("--profile-output",
+        help=single_spaced("""
+            Use this with the --profile option to save the profile.
+            Writes the cProfile data to prefix.prof, and the stage timings to prefix.json.
+            """),
+        metavar='prefix',
+        type=str)
     developer_group.add_argument("--translations",
         help="Dump the translation dictionary for the specified language, then exit.",
         metavar='language',
@@ -219,6 +320,21 @@ if __name__ == "__main__":
     # parse command line arguments
     logging.debug("Command line: %s", " ".join(sys.argv))
     args = parser.parse_args()
+    if args.serve and server.address_error(args.serve):
+        parser.error("--serve: " + server.address_error(args.serve))
+    if args.batch and not args.fromfile:
+        parser.error("--batch needs the load order files to check, given with --fromfile")
+    # Options that only mean something along with another option
+    for (option, given, needed, needed_given) in (
+            ("--jobs", args.jobs != None, "--batch", args.batch),
+            ("--report-dir", args.report_dir != None, "--batch", args.batch),
+            ("--profile-memory", args.profile_memory, "--profile", args.profile),
+            ("--profile-output", args.profile_output != None, "--profile", args.profile),
+            ("--minimal", args.minimal, "--update", args.update)):
+        if given and not needed_given:
+            parser.error("{0} can only be used with {1}".format(option, needed))
+    if args.jobs == None:
+        args.jobs = 1
     logging.debug("Parsed Arguments: %s", pprint.pformat(args))
 
     #Handle verbosity_group
@@ -256,14 +372,17 @@ if __name__ == "__main__":
         MloxGui().start()
 
     if args.profile:
-        import hotshot
-        import hotshot.stats
-        prof = hotshot.Profile("mlox.prof")
-        time = prof.runcall(command_line_mode, args=args)
-        prof.close()
-        stats = hotshot.stats.load("mlox.prof")
-        stats.strip_dirs()
-        stats.sort_stats('time', 'calls')
-        stats.print_stats(20)
+        a_profile = profiler.profile(trace_memory=args.profile_memory)
+        a_profile.start()
+        try:
+            command_line_mode(args)
+        finally:
+            a_profile.stop()
+            # The results go to stderr, so they don't mix with the load order (or the JSON from --batch)
+            a_profile.print_functions(sys.stderr)
+            sys.stderr.write(a_profile.table())
+            if args.profile_output:
+                a_profile.write_stats(args.profile_output + ".prof")
+                a_profile.write_json(args.profile_output + ".json")
     else:
         command_line_mode(args)
@@ -0,0 +1,120 @@
+"""
+Check many load orders at once.
+
+Load orders posted by users are checked by the hundred.
+Reading the rules files is the slow part of checking one, so here they are read once, and shared by every load order.
+The load orders can also be checked on several processes at the same time.
+"""
+import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from . import loadOrder
+
+batch_logger = logging.getLogger('mlox.batch')
+
+# The rules shared by every load order checked in this process (see check_file)
+shared_rules = None
+
+
+def _init_worker(rules):
+    global shared_rules
+    shared_rules = rules
+
+
+def check_file(fromfile):
+    """
+    Check the load order in a file, against shared_rules.
+
+    :return: A dictionary with the file name, the messages from the rules (as text, and as ruleEvaluator.rule_message.to_dict
+             dictionaries), the original and new load orders,
+             and the new load order formatted for printing.  (The load orders are empty if the file could not be sorted.)
+    """
+    # The load order comes from the file, so there's no need to look for the game
+    a_loadorder = loadOrder.loadorder(find_game = False)
+    a_loadorder.read_from_file(fromfile)
+    messages = a_loadorder.update(rules = shared_rules)
+    return {
+        "file": fromfile,
+        "messages": messages if messages else "",
+        "structured_messages": [m.to_dict() for m in a_loadorder.messages],
+        "order": [a_loadorder.caseless.truename(p) for p in a_loadorder.order],
+        "new_order": a_loadorder.new_order,
+        "formatted": a_loadorder.get_new_order() if a_loadorder.new_order else [],
+        "is_sorted": a_loadorder.is_sorted
+    }
+
+
+def check_files(files, jobs = 1):
+    """
+    Check the load orders in many files, reading the rules files only once.
+
+    :param jobs: How many processes to check load orders on.  1 checks them all in this process.
+    :return: A generator of the results from check_file, in the same order as files,
+             or None if the rules files can not be read
+    """
+    rules = loadOrder.read_rule_files()
+    if rules == None:
+        batch_logger.error("Unable to parse 'mlox_base.txt', no load orders checked!")
+        return None
+    return _check_files(files, rules, jobs)
+
+
+def _check_files(files, rules, jobs):
+    if jobs <= 1 or len(files) < 2:
+        _init_worker(rules)
+        for fromfile in files:
+            yield check_file(fromfile)
+        return
+    # Each process gets its own copy of the rules once, instead of with every file
+    with ProcessPoolExecutor(max_workers = jobs, initializer = _init_worker, initargs = (rules,)) as pool:
+        for result in pool.map(check_file, files, chunksize = max(1, len(files) // (jobs * 4))):
+            yield result
+
+
+def format_report(result):
+    """Format a result from check_file the way mlox prints it on the command line"""
+    report = result["messages"]
+    report += "{0:-^80}\n".format('[New Load Order]')
+    for plugin in result["formatted"]:
+        report += plugin + "\n"
+    report += "{0:-^80}\n".format('[END PROPOSED LOAD ORDER]')
+    return report
+
+
+def report_names(files):
+    """
+    Get a report file name for each load order file that no other file shares.
+
+    Reports are named after the load order file's path, relative to the directory all the files are in,
+    so "a/load.txt" and "b/load.txt" become "a/load.txt.out" and "b/load.txt.out".
+
+    :return: A dictionary of load order file -> report file name, relative to the report directory
+    """
+    paths = [os.path.abspath(fromfile) for fromfile in files]
+    if paths == []:
+        return {}
+    common_dir = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return {fromfile: os.path.relpath(path, common_dir) + ".out" for (fromfile, path) in zip(files, paths)}
+
+
+def write_reports(results, report_dir, files):
+    """
+    Write each result to its own file in report_dir, named after the load order file (see report_names)
+
+    :param files: The load order files the results are for
+    """
+    names = report_names(files)
+    for result in results:
+        report_file = os.path.join(report_dir, names[result["file"]])
+        os.makedirs(os.path.dirname(report_file), exist_ok = True)
+        with open(report_file, 'w', encoding='utf-8') as file_handle:
+            file_handle.write(format_report(result))
+        batch_logger.info("Wrote: \"{0}\"".format(report_file))
+
+
+def write_json(results, stream):
+    """Write each result to stream as one line of JSON"""
+    for result in results:
+        stream.write(json.dumps(result) + "\n")
+        stream.flush()
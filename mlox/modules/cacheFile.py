@@ -0,0 +1,120 @@
+"""
+Save what mlox works out in the cache directory, to use again on the next run.
+
+Every cache file is a pickled (format, data) pair.  The format is bumped whenever the layout of the data changes,
+so old files are thrown out instead of misread.
+Files are written to a temporary file first and then moved into place, so a crash (or another mlox running at the
+same time) never leaves half a file behind.
+"""
+import gc
+import os
+import pickle
+import logging
+import threading
+
+cache_logger = logging.getLogger('mlox.cacheFile')
+
+
+def read(cache_file, cache_format, logger = cache_logger):
+    """
+    Read a cache file.
+
+    :param cache_format: The format the data must be in
+    :return: The saved data, or None if the file is missing, unreadable, or in another format
+    """
+    # The garbage collector would otherwise keep stopping to look at the many objects being unpickled,
+    # none of which can be garbage yet.  This makes loading the compiled rules several times faster.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cache_file, 'rb') as file_handle:
+            (saved_format, data) = pickle.load(file_handle)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug("Unable to read cache file {0}: {1}".format(cache_file, e))
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if saved_format != cache_format:
+        logger.debug("Cache file {0} is out of date".format(cache_file))
+        return None
+    return data
+
+
+def write(cache_file, cache_format, data, logger = cache_logger):
+    """
+    Write a cache file.  Failure is not fatal, whatever was cached will just be worked out again.
+
+    :return: True if the file was written
+    """
+    # Each process and thread writes its own temporary file, so they can't write over each other's
+    tmp_file = "{0}.{1}.{2}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        with open(tmp_file, 'wb') as file_handle:
+            pickle.dump((cache_format, data), file_handle, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        logger.warning("Unable to write cache file {0}: {1}".format(cache_file, e))
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+class entry_cache:
+    """
+    A dictionary of entries, kept in memory and saved in a cache file between runs.
+
+    The file is read the first time an entry is needed, and written by save() if anything changed.
+    The cache can be used from several threads (see engine), but only one of them loads or saves it at a time.
+    Subclasses give the cache_format and logger, and where the file is (see _path).
+    """
+    cache_format = None
+    logger = cache_logger
+
+    def __init__(self, cache_file = None):
+        """
+        :param cache_file: Where to save the cache, instead of the default (see _path)
+        """
+        self.cache_file = cache_file
+        self.entries = {}
+        self.loaded = False
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def _path(self):
+        """Get the path of the cache file"""
+        return self.cache_file
+
+    def _load_once(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def load(self):
+        """Read the saved cache.  A missing or unreadable cache is simply empty."""
+        entries = read(self._path(), self.cache_format, self.logger)
+        if entries != None:
+            # Anything looked up before loading is newer
+            entries.update(self.entries)
+            self.entries = entries
+        self.loaded = True
+
+    def save(self):
+        """Save the cache, if anything was added to it"""
+        if not self.changed:
+            return True
+        with self.lock:
+            self.changed = False
+            # Copied first, since other threads may still be adding to it
+            if not write(self._path(), self.cache_format, dict(self.entries), self.logger):
+                self.changed = True
+                return False
+        return True
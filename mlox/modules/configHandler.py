@@ -3,7 +3,10 @@
 import logging
 import re
 import os
+import bisect
+import math
 from functools import reduce
+from . import fileFinder
 
 config_logger = logging.getLogger('mlox.configHandler')
 
@@ -13,19 +16,56 @@ def caseless_uniq(un_uniqed_files):
     Given a list, return a list of unique strings, and a list of duplicates.
     This is a caseless comparison, so 'Test' and 'test' are considered duplicates.
     """
-    lower_files = []    # Use this to allow for easy use of the 'in' keyword
+    caseless_files = set()  # Use this to allow for easy use of the 'in' keyword
     unique_files = []   # Guaranteed case insensitive unique
     filtered = []       # any duplicates from the input
 
     for aFile in un_uniqed_files:
-        if aFile.lower() in lower_files:
+        if aFile.casefold() in caseless_files:
             filtered.append(aFile)
         else:
             unique_files.append(aFile)
-            lower_files.append(aFile.lower())
+            caseless_files.add(aFile.casefold())
     return(unique_files, filtered)
 
 
+def moved_plugins(old_order, new_order):
+    """
+    Find the fewest plugins that have to move, to turn old_order into new_order.
+
+    The plugins that stay put are a longest increasing subsequence of their old positions, in new order.
+    Plugins that are not in old_order at all count as moved.
+    :return: The set of moved plugins, as casefolded names
+    """
+    old_index = {}
+    for (i, a_plugin) in enumerate(old_order):
+        old_index.setdefault(a_plugin.casefold(), i)
+    names = [a_plugin.casefold() for a_plugin in new_order]
+    positions = [old_index.get(name, -1) for name in names]
+    # Patience sorting: tails[k] is the (position in new_order of the) smallest
+    # old position that ends an increasing run of length k+1
+    tails = []
+    tail_positions = []
+    previous = [-1] * len(positions)
+    for (i, position) in enumerate(positions):
+        if position < 0:
+            continue
+        k = bisect.bisect_left(tail_positions, position)
+        if k == len(tails):
+            tails.append(i)
+            tail_positions.append(position)
+        else:
+            tails[k] = i
+            tail_positions[k] = position
+        previous[i] = tails[k-1] if k > 0 else -1
+    kept = set()
+    i = tails[-1] if tails != [] else -1
+    while i != -1:
+        kept.add(i)
+        i = previous[i]
+    return set(names[i] for i in range(len(names)) if i not in kept)
+
+
 def partition_esps_and_esms(filelist):
     """Split filelist into separate lists for esms and esps, retaining order."""
     esm_files = []
@@ -85,22 +125,30 @@ class configHandler():
 
         :return: An ordered list of plugins
         """
-        files = []
-        regex = self.read_regexes[self.fileType]
         try:
-            file_handle = open(self.configFile, 'r')
-            for line in file_handle:
-                gamefile = regex.match(line.strip())
-                if gamefile:
-                    f = gamefile.group(1).strip()
-                    files.append(f)
-            file_handle.close()
+            with open(self.configFile, 'r') as file_handle:
+                return self.read_lines(file_handle)
         except IOError:
             config_logger.error("Unable to open configuration file: {0}".format(self.configFile))
             return []
         except UnicodeDecodeError:
             config_logger.error("Bad Characters in configuration file: {0}".format(self.configFile))
             return []
+
+    def read_lines(self, lines):
+        """
+        Read the contents of a configuration file, that has already been read from somewhere else.
+
+        :param lines: An iterable of the lines in the file
+        :return: An ordered list of plugins
+        """
+        files = []
+        regex = self.read_regexes[self.fileType]
+        for line in lines:
+            gamefile = regex.match(line.strip())
+            if gamefile:
+                f = gamefile.group(1).strip()
+                files.append(f)
         # Deal with duplicates
         (files, dups) = caseless_uniq(files)
         for f in dups:
@@ -197,6 +245,14 @@ class configHandler():
         return True
 
 
+# The fixed times of the official masters, compatible with `tes3cmd resetdates` (see dataDirHandler.write)
+official_master_times = {
+    "morrowind.esm": 1024695106,    # Fri Jun 21 17:31:46 2002
+    "tribunal.esm":  1035940926,    # Tue Oct 29 20:22:06 2002
+    "bloodmoon.esm": 1051807050,    # Thu May  1 12:37:30 2003
+}
+
+
 class dataDirHandler:
     """
     A class for handling a directory containing plugin files.
@@ -218,30 +274,106 @@ class dataDirHandler:
         """Convenience function to return the full path to a file."""
         return os.path.join(self.path,a_file)
 
-    def _sort_by_date(self, list_of_plugins):
+    def snapshot(self):
+        """Scan the directory for plugins (see fileFinder.plugin_snapshot)"""
+        return fileFinder.plugin_snapshot(self.path)
+
+    def _sort_by_date(self, list_of_plugins, snapshot):
         """Sort a list of plugin files by modification date"""
-        dated_plugins = [(os.path.getmtime(self._full_path(a_plugin)), a_plugin) for a_plugin in list_of_plugins]
+        dated_plugins = [(snapshot.stat(a_plugin).st_mtime, a_plugin) for a_plugin in list_of_plugins]
         dated_plugins.sort()
         return([x[1] for x in dated_plugins])
 
-    def read(self):
+    def read(self, snapshot = None):
         """
         Obtain an ordered list of plugins from a directory.
 
         Note:  Unlike configHandler.read(), ESM files will always be at the front of the returned list.
+        :param snapshot: A fileFinder.plugin_snapshot of the directory, to avoid scanning it again
         :return: An ordered list of plugins
         """
-        files = [f for f in os.listdir(self.path) if os.path.isfile(self._full_path(f))]
-        (files, dups) = caseless_uniq(files)
+        if snapshot == None:
+            snapshot = self.snapshot()
+        (files, dups) = caseless_uniq(snapshot.plugins())
         # Deal with duplicates
         for f in dups:
             logging.warning("Duplicate plugin found in data directory: {0}".format(f))
         # sort the plugins into load order by modification date (esm's first)
         (esm_files, esp_files) = partition_esps_and_esms(files)
-        files  = self._sort_by_date(esm_files)
-        files += self._sort_by_date(esp_files)
+        files  = self._sort_by_date(esm_files, snapshot)
+        files += self._sort_by_date(esp_files, snapshot)
         return files
 
+    def _minimal_times(self, old_order, new_order, snapshot):
+        """
+        Work out new modification times for only the plugins that move (see moved_plugins).
+
+        Each moved plugin gets a time in the gap between the unmoved plugins around it.
+        :return: A dictionary of plugin to its new modification time,
+                 or None if there's not enough room between two unmoved plugins
+        """
+        moved = moved_plugins(old_order, new_order)
+        new_times = {}
+        lower = None        # the time of the last unmoved plugin
+        run = []            # moved plugins since then
+        for a_plugin in new_order + [None]:
+            if a_plugin != None and a_plugin.casefold() in moved:
+                run.append(a_plugin)
+                continue
+            upper = None if a_plugin == None else snapshot.stat(a_plugin).st_mtime
+            if run != []:
+                if lower == None and upper == None:
+                    return None
+                elif lower == None:
+                    times = [math.ceil(upper) - 60 * (len(run) - i) for i in range(len(run))]
+                elif upper == None:
+                    times = [math.floor(lower) + 60 * (i + 1) for i in range(len(run))]
+                else:
+                    # whole seconds strictly between the neighbours, spread out as much as possible
+                    first = math.floor(lower) + 1
+                    room = math.ceil(upper) - first
+                    if room < len(run):
+                        return None
+                    times = [first + (room * i) // len(run) for i in range(len(run))]
+                for (a_moved, mtime) in zip(run, times):
+                    new_times[a_moved] = mtime
+                run = []
+            lower = upper
+        return new_times
+
+    def write_minimal(self, list_of_plugins):
+        """
+        Change the modification times of only the plugins that have to move, to get the order of file list.
+
+        Unlike write, this leaves every other plugin (and the bsa files) alone.
+        If there's no room to fit a moved plugin between its neighbours, or one of the official masters moves,
+        this falls back to write.
+        :return: True on success, or False on failure
+        """
+        (esm_files, esp_files) = partition_esps_and_esms(list_of_plugins)
+        snapshot = self.snapshot()
+        (old_esm_files, old_esp_files) = partition_esps_and_esms(self.read(snapshot))
+        new_times = {}
+        # masters always load before other plugins, so each group is ordered on its own
+        for (old_order, new_order) in ((old_esm_files, esm_files), (old_esp_files, esp_files)):
+            times = self._minimal_times(old_order, new_order, snapshot)
+            if times == None:
+                config_logger.info("Not enough room between plugin times for a minimal update, updating all plugins.")
+                return self.write(list_of_plugins)
+            new_times.update(times)
+        if any(a_plugin.lower() in official_master_times for a_plugin in new_times):
+            # these (and their bsa files) have fixed times, which only write knows how to keep
+            config_logger.info("An official master moved, updating all plugins.")
+            return self.write(list_of_plugins)
+        try:
+            for (a_plugin, mtime) in new_times.items():
+                os.utime(self._full_path(a_plugin), (-1, mtime))
+        except (TypeError, OSError) as e:
+            config_logger.error("Could not update load order: {0}".format(e))
+            return False
+        config_logger.info("Moved {0} of {1} plugins.".format(len(new_times), len(list_of_plugins)))
+        return True
+
     def write(self, list_of_plugins):
         """
         Change the modification times of plugin files to be in order of file list, oldest to newest
@@ -250,21 +382,17 @@ class dataDirHandler:
         These files are fixed to be compatible with `tes3cmd resetdates`.
         :return: True on success, or False on failure
         """
-        tes3cmd_resetdates_morrowind_mtime = 1024695106 # Fri Jun 21 17:31:46 2002
-        tes3cmd_resetdates_tribunal_mtime  = 1035940926 # Tue Oct 29 20:22:06 2002
-        tes3cmd_resetdates_bloodmoon_mtime = 1051807050 # Thu May  1 12:37:30 2003
-
-        mtime = tes3cmd_resetdates_morrowind_mtime
+        mtime = official_master_times["morrowind.esm"]
         try:
             for a_plugin in list_of_plugins:
                 if a_plugin.lower() == "morrowind.esm":
-                    mtime = tes3cmd_resetdates_morrowind_mtime
+                    mtime = official_master_times["morrowind.esm"]
                     os.utime(self._full_path("Morrowind.bsa"), (-1, mtime))
                 elif a_plugin.lower() == "tribunal.esm":
-                    mtime = tes3cmd_resetdates_tribunal_mtime
+                    mtime = official_master_times["tribunal.esm"]
                     os.utime(self._full_path("Tribunal.bsa"), (-1, mtime))
                 elif a_plugin.lower() == "bloodmoon.esm":
-                    mtime = tes3cmd_resetdates_bloodmoon_mtime
+                    mtime = official_master_times["bloodmoon.esm"]
                     os.utime(self._full_path("Bloodmoon.bsa"), (-1, mtime))
                 else:
                     mtime += 60 # standard 1 minute Mash step
@@ -0,0 +1,152 @@
+"""
+Use mlox from other programs.
+
+Updating a loadorder reads the rules files every time, which is most of the work.
+An Engine reads them once, and keeps them for every call after that (reading them again if a rules file changes).
+It also remembers the results for the last few load orders, so explaining several plugins in the same load order
+only evaluates the rules once.
+
+An Engine can be shared between threads.
+"""
+import os
+import logging
+import threading
+import collections
+from . import loadOrder
+from . import ruleParser
+from . import fileFinder
+
+engine_logger = logging.getLogger('mlox.engine')
+
+# How many load orders an Engine remembers the results for
+cache_size = 16
+
+
+class update_result:
+    """A load order, after it was updated by an Engine"""
+    def __init__(self, a_loadorder, messages):
+        self.loadorder = a_loadorder
+        self.messages = messages            # The messages from the rules, or False if the load order could not be sorted
+        # Explaining adds to the load order's name table, so it is only done by one thread at a time
+        self.lock = threading.Lock()
+
+
+class Engine:
+    """Sort, check, and explain load orders, reading the rules files only once"""
+
+    def __init__(self, base_file = None, user_file = None, game_type = None):
+        """
+        :param base_file: The path to mlox_base.txt (defaults to loadOrder.base_file)
+        :param user_file: The path to mlox_user.txt (defaults to loadOrder.user_file)
+        :param game_type: 'Morrowind', 'Oblivion', or None for unknown
+        """
+        self.base_file = loadOrder.base_file if base_file == None else base_file
+        self.user_file = loadOrder.user_file if user_file == None else user_file
+        self.game_type = game_type
+        self.lock = threading.Lock()
+        self._rules = None
+        self._stamp = None
+        self._results = collections.OrderedDict()     # (load order, data directory, plugins stamp) -> update_result
+
+    def _file_stamp(self):
+        stamp = []
+        for rule_file in (self.user_file, self.base_file):
+            try:
+                file_stat = os.stat(rule_file)
+                stamp.append((file_stat.st_size, file_stat.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def rules(self):
+        """
+        Get the rules, reading them again if a rules file has changed.
+
+        :return: A list of ruleParser.rule_set (see loadOrder.read_rule_files), or None if mlox_base.txt can not be read
+        """
+        stamp = self._file_stamp()
+        with self.lock:
+            if self._rules == None or stamp != self._stamp:
+                engine_logger.info("Reading rules")
+                self._rules = loadOrder.read_rule_files(self.base_file, self.user_file)
+                self._stamp = stamp
+                self._results.clear()
+            return self._rules
+
+    def _loadorder(self, order, datadir = None, snapshot = None):
+        # Everything the game search would find is given by the caller, so it is skipped
+        a_loadorder = loadOrder.loadorder(find_game = False)
+        a_loadorder.read_from_text(order if isinstance(order, str) else "\n".join(order), "engine")
+        a_loadorder.game_type = self.game_type
+        a_loadorder.datadir = datadir
+        a_loadorder.snapshot = snapshot
+        return a_loadorder
+
+    def update(self, order, datadir = None):
+        """
+        Update a load order with the rules.
+
+        :param order: A list of plugin names, or the contents of a load order file in any format mlox can read
+        :param datadir: The directory with the plugins in it, if there is one.
+                        Without it, [DESC], [VER], and [SIZE] rules can only use the plugin names, and masters are not used.
+        :return: An update_result
+        """
+        rules = self.rules()
+        # The results are only reused while the plugins in the data directory are unchanged
+        snapshot = fileFinder.plugin_snapshot(datadir) if datadir else None
+        key = (order if isinstance(order, str) else tuple(order), datadir, snapshot.stamp() if snapshot else None)
+        with self.lock:
+            result = self._results.get(key)
+            if result != None:
+                self._results.move_to_end(key)
+                return result
+        a_loadorder = self._loadorder(order, datadir, snapshot)
+        if rules == None:
+            engine_logger.error("Unable to parse 'mlox_base.txt', load order NOT sorted!")
+            return update_result(a_loadorder, False)
+        # Programs using the Engine do not want mlox's output files written for them
+        result = update_result(a_loadorder, a_loadorder.update(rules = rules, write_output = False))
+        with self.lock:
+            self._results[key] = result
+            while len(self._results) > cache_size:
+                self._results.popitem(last = False)
+        return result
+
+    def sort(self, order, datadir = None):
+        """
+        Sort a load order (see update)
+
+        :return: The new load order as a list of plugin names, or an empty list if it could not be sorted
+        """
+        return list(self.update(order, datadir).loadorder.new_order)
+
+    def check(self, order, datadir = None):
+        """
+        Check a load order against the rules (see update)
+
+        :return: The messages from the rules, or False if the load order could not be sorted
+        """
+        return self.update(order, datadir).messages
+
+    def explain(self, plugin, order, datadir = None, base_only = False):
+        """
+        Explain why a plugin is where it is in a load order (see update and loadorder.explain)
+
+        :param base_only: Leave the current load order out of the explanation
+        :return: The explanation
+        """
+        result = self.update(order, datadir)
+        with result.lock:
+            return result.loadorder.explain(plugin, base_only, self.rules())
+
+    def versions(self, order, datadir = None):
+        """
+        Get the versions of the plugins in a load order (see ruleParser.get_versions)
+
+        :return: A list of (plugin name, version from the file name, version from the description) tuples
+        """
+        a_loadorder = self._loadorder(order, datadir)
+        snapshot = fileFinder.plugin_snapshot(datadir) if datadir else None
+        versions = ruleParser.get_versions(a_loadorder.order, snapshot)
+        return [(a_loadorder.caseless.truename(p), file_ver, desc_ver)
+                for (p, (file_ver, desc_ver)) in zip(a_loadorder.order, versions)]
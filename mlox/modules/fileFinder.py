@@ -2,9 +2,11 @@
 
 # Utility classes For doing caseless filename processing:
 # caseless_filename uses a dictionary that stores the truename of a
-# plugin by its canonical lowercased form (cname). We only use the
+# plugin by its canonical casefolded form (cname). We only use the
 # truename for output, in all other processing, we use the cname so
 # that all processing of filenames is caseless.
+# It is also the table giving each plugin an integer id, which the
+# rest of mlox (like pluggraph) uses to store plugins compactly.
 
 # Note that the first function to call cname() is get_data_files()
 # this ensures that the proper truename of the actual file in the
@@ -19,17 +21,39 @@ import logging
 file_logger = logging.getLogger('mlox.fileFinder')
 
 
+def canonical(name):
+    """Get the canonical caseless form (cname) of a file name"""
+    return(name.casefold())
+
+
 class caseless_filenames:
 
     def __init__(self):
-        self.truenames = {}
+        self.truenames = {}     # cname -> truename
+        self.ids = {}           # cname -> id
+        self.cnames = []        # id -> cname
+        # every spelling seen so far -> cname, so names are only casefolded once
+        self.known = {}
 
     def cname(self, truename):
-        the_cname = truename.lower()
-        if not the_cname in self.truenames:
-            self.truenames[the_cname] = truename
+        the_cname = self.known.get(truename)
+        if the_cname == None:
+            the_cname = canonical(truename)
+            self.known[truename] = the_cname
+            if not the_cname in self.truenames:
+                self.truenames[the_cname] = truename
+            self.intern(the_cname)
         return(the_cname)
 
+    def intern(self, the_cname):
+        """Get the id of a cname, giving it the next free id if it doesn't have one."""
+        the_id = self.ids.get(the_cname)
+        if the_id == None:
+            the_id = len(self.cnames)
+            self.ids[the_cname] = the_id
+            self.cnames.append(the_cname)
+        return(the_id)
+
     def truename(self, cname):
         return(self.truenames[cname])
 
@@ -45,17 +69,21 @@ class caseless_dirlist:
         else:
             self.dir = os.path.normpath(os.path.abspath(dir))
         for f in [p for p in os.listdir(self.dir)]:
-            self.files[f.lower()] = f
+            self.files[canonical(f)] = f
 
     def find_file(self, file_name):
-        return(self.files.get(file_name.lower(), None))
+        return(self.files.get(canonical(file_name), None))
 
     def find_path(self, file_name):
-        f = file_name.lower()
+        f = canonical(file_name)
         if f in self.files:
             return(os.path.join(self.dir, self.files[f]))
         return(None)
 
+    def stat(self, file_name):
+        """The os.stat result for a file, if it is already known.  (None for a plain caseless_dirlist)"""
+        return(None)
+
     def find_parent_dir(self, file_name):
         """return the caseless_dirlist of the directory that contains file,
         starting from self.dir and working back towards root."""
@@ -75,6 +103,37 @@ class caseless_dirlist:
     def filelist(self):
         return(self.files.values())
 
+
+class plugin_snapshot(caseless_dirlist):
+    """
+    A caseless_dirlist of only the plugins (.esp and .esm files) in a directory, along with their stat results.
+
+    The directory is read in a single pass, so a Data Files directory full of other files costs little,
+    and plugin times and sizes can be used without asking the file system again.
+    """
+
+    def __init__(self, dir):
+        self.files = {}
+        self.stats = {}         # file name -> os.stat_result
+        self.dir = os.path.normpath(os.path.abspath(dir))
+        with os.scandir(self.dir) as entries:
+            for entry in entries:
+                if entry.name[-4:].lower() in (".esp", ".esm") and entry.is_file():
+                    self.stats[entry.name] = entry.stat()
+                    self.files.setdefault(canonical(entry.name), entry.name)
+
+    def plugins(self):
+        """The file names of every plugin in the directory"""
+        return(list(self.stats.keys()))
+
+    def stat(self, file_name):
+        f = self.find_file(file_name)
+        return(self.stats.get(f) if f != None else None)
+
+    def stamp(self):
+        """Something that changes whenever a plugin is added, removed, or changed.  (Its name, size, and modification time.)"""
+        return(tuple(sorted((name, stat.st_size, stat.st_mtime_ns) for (name, stat) in self.stats.items())))
+
 def _find_appdata():
     """a somewhat hacky function for finding where Oblivion's Application Data lives.
     Hopefully works under Windows, Wine, and native Linux."""
@@ -0,0 +1,197 @@
+"""
+Cache information read from plugin headers.
+
+[VER] and [DESC] rules need the description from a plugin's header, and [SIZE] rules need its size.
+The header also lists the plugin's masters, which it must always load after.
+The same plugins are checked over and over, both by different rules, and on every run.
+So what is read from each plugin is kept in memory, and saved in the cache directory between runs.
+An entry is only used while the plugin's path, size, and modification time are unchanged.
+"""
+import os
+import mmap
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from . import ruleParser
+from . import cacheFile
+from .resources import user_path
+
+header_logger = logging.getLogger('mlox.headerCache')
+
+# Where the cache is saved
+cache_dir = os.path.join(user_path, "cache")
+
+# Bump this whenever the layout of plugin_info changes, so old caches are thrown out
+CACHE_FORMAT = 2
+
+tes3_min_plugin_size = 362
+
+# How many plugin headers header_cache.prefetch reads at the same time
+max_workers = 8
+
+
+class plugin_info:
+    """What mlox knows about a plugin file"""
+    def __init__(self, size, mtime, header_type, description, masters = ()):
+        self.size = size
+        self.mtime = mtime
+        self.header_type = header_type      # "TES3" (Morrowind), "TES4" (Oblivion), or None
+        self.description = description
+        self.masters = list(masters)        # file names of the plugin's masters, as written in the header
+        # The version given in the description, as written and in comparable form (see ruleParser.format_version)
+        self.version = None
+        self.formatted_version = None
+        match = ruleParser.re_header_version.search(description)
+        if match:
+            self.version = match.group(1)
+            self.formatted_version = ruleParser.format_version(self.version)
+
+
+# The layout of the header record for each game:
+# (length of the record header, format of a subrecord's size)
+# Records start with a 4 byte type and a 4 byte size, and each subrecord with a 4 byte type and its size.
+header_layouts = {
+    b"TES3": (16, "<I"),    # Morrowind
+    b"TES4": (20, "<H"),    # Oblivion
+}
+
+
+def read_masters(block, header_type):
+    """
+    Get the masters listed in the header record (the first record) of a plugin.
+
+    Only the header record is looked at, and subrecords are unpacked in place, so block can be a
+    memory map of a plugin of any size.
+
+    :param block: The plugin's contents (bytes, or an mmap)
+    :return: A list of the masters' file names
+    """
+    (record_start, size_format) = header_layouts[header_type]
+    size_length = struct.calcsize(size_format)
+    if len(block) < record_start:
+        return []
+    (record_size,) = struct.unpack_from("<I", block, 4)
+    end = min(record_start + record_size, len(block))
+    masters = []
+    pos = record_start
+    while pos + 4 + size_length <= end:
+        (size,) = struct.unpack_from(size_format, block, pos + 4)
+        data = pos + 4 + size_length
+        if block[pos:pos + 4] == b"MAST":
+            name = block[data:min(data + size, end)].split(b"\x00", 1)[0]
+            masters.append(name.decode("cp1252", "replace"))
+        pos = data + size
+    return masters
+
+
+def read_header(plugin):
+    """
+    Read the description field and the masters from a TES3/TES4 plugin file header
+
+    The file is memory mapped, so only the parts of it that are looked at are actually read.
+
+    :return: A tuple of the header type ("TES3", "TES4", or None), the description, and a list of masters
+    :raises IOError: If the plugin can not be read
+    """
+    with open(plugin, 'rb') as inp:
+        try:
+            block = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:          # an empty file can not be mapped
+            return (None, "", [])
+        with block:
+            head = block[0:4096]
+            if head[0:4] == b"TES3":    # Morrowind
+                if len(head) < tes3_min_plugin_size:
+                    header_logger.warning("Cannot read plugin description(%s): file too short, returning NULL string", plugin)
+                    return ("TES3", "", [])
+                desc = head[64:head.find(b"\x00", 64)]
+                return ("TES3", str(desc), read_masters(block, b"TES3"))
+            elif head[0:4] == b"TES4":  # Oblivion
+                masters = read_masters(block, b"TES4")
+                # This is very cheesy.
+                pos = head.find(b"SNAM", 0)
+                if pos == -1:
+                    return ("TES4", "", masters)
+                desc_start = head.find(b"\x00", pos) + 1
+                if desc_start == -1:
+                    return ("TES4", "", masters)
+                desc_end = head.find(b"\x00", desc_start)
+                if desc_end == -1:
+                    return ("TES4", "", masters)
+                desc = head[desc_start:desc_end]
+                return ("TES4", str(desc), masters)
+            else:
+                return (None, "", [])
+
+
+def _read_plugin(path, stat, cached):
+    """
+    Get the plugin_info for a plugin file, reusing the cached one if the plugin has not changed.
+    Only touches the file system, so it is safe to run on any thread.
+
+    :return: A plugin_info, or None if the plugin can not be read
+    """
+    try:
+        if stat == None:
+            stat = os.stat(path)
+        if cached != None and cached.size == stat.st_size and cached.mtime == stat.st_mtime_ns:
+            return cached
+        (header_type, description, masters) = read_header(path)
+    except (IOError, OSError):
+        return None
+    return plugin_info(stat.st_size, stat.st_mtime_ns, header_type, description, masters)
+
+
+class header_cache(cacheFile.entry_cache):
+    """A cache of plugin_info, keyed by plugin path"""
+    cache_format = CACHE_FORMAT
+    logger = header_logger
+
+    def _path(self):
+        return self.cache_file if self.cache_file != None else os.path.join(cache_dir, "headers.pkl")
+
+    def get(self, plugin, stat = None):
+        """
+        Get the plugin_info for a plugin file.
+
+        :param plugin: Path to the plugin
+        :param stat: The result of os.stat(plugin), if the caller already has it
+        :return: A plugin_info, or None if the plugin can not be read
+        """
+        if plugin == None:
+            return None
+        self._load_once()
+        path = os.path.abspath(plugin)
+        return self._store(path, _read_plugin(path, stat, self.entries.get(path)))
+
+    def _store(self, path, info):
+        if info != None and self.entries.get(path) is not info:
+            self.entries[path] = info
+            self.changed = True
+        return info
+
+    def prefetch(self, plugins, workers = None):
+        """
+        Get the plugin_info for many plugin files, reading them on a pool of threads.
+
+        Reading a header is mostly waiting on the disk (or network), so reading several at once is much faster.
+
+        :param plugins: A list of (path, stat) tuples.  stat may be None, and a path of None is skipped.
+        :param workers: The most headers to read at the same time (defaults to max_workers)
+        :return: A list of plugin_info (or None if the plugin can not be read), in the same order as plugins
+        """
+        self._load_once()
+        jobs = [(os.path.abspath(plugin), stat) for (plugin, stat) in plugins if plugin != None]
+        jobs = [(path, stat, self.entries.get(path)) for (path, stat) in jobs]
+        infos = {}
+        if jobs != []:
+            workers = min(max_workers if workers == None else workers, len(jobs))
+            with ThreadPoolExecutor(max_workers = max(workers, 1)) as pool:
+                # Only the reading happens on the pool, the cache itself is only changed here
+                for ((path, stat, cached), info) in zip(jobs, pool.map(lambda job: _read_plugin(*job), jobs)):
+                    infos[path] = self._store(path, info)
+        return [None if plugin == None else infos[os.path.abspath(plugin)] for (plugin, stat) in plugins]
+
+
+# The cache used by the rest of mlox
+headers = header_cache()
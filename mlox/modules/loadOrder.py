@@ -4,6 +4,9 @@ from . import fileFinder
 from . import pluggraph
 from . import ruleParser
 from . import configHandler
+from . import headerCache
+from . import recordIndex
+from . import profiler
 from .resources import base_file, user_file
 
 old_loadorder_output = "current_loadorder.out"
@@ -11,19 +14,67 @@ new_loadorder_output = "mlox_new_loadorder.out"
 
 order_logger = logging.getLogger('mlox.loadOrder')
 
+
+def read_rule_files(base = None, user = None):
+    """
+    Read the rules files, so they can be used to update any number of load orders (see loadorder.update).
+
+    :param base: The path to mlox_base.txt (defaults to base_file)
+    :param user: The path to mlox_user.txt (defaults to user_file).  It is skipped if it doesn't exist.
+    :return: A list of ruleParser.rule_set, in order of priority, or None if mlox_base.txt can not be read
+    """
+    base = base_file if base == None else base
+    user = user_file if user == None else user
+    rules = []
+    for rule_file in (user, base):
+        if rule_file == user and not os.path.exists(user):
+            continue
+        try:
+            rules.append(ruleParser.read_rule_file(rule_file))
+        except (IOError, OSError, UnicodeDecodeError):
+            order_logger.error("Unable to read rules file:  {0}".format(rule_file))
+            if rule_file == base:
+                return None
+    return rules
+
 class loadorder:
     """Class for reading plugin mod times (load order), and updating them based on rules"""
-    def __init__(self):
+    def __init__(self, find_game = True):
+        """
+        :param find_game: Look for the game in the directories above the current one.
+                          Without it, there is no game, plugins file, or data directory until one is read or set.
+        """
         # order is the list of plugins in Data Files, ordered by mtime
         self.order = []                    # the load order
         self.new_order = []                # the new load order
+        self.messages = []                 # the messages from the last update (see ruleEvaluator.rule_message)
         self.is_sorted = False
         self.caseless = fileFinder.caseless_filenames()
+        # The graph built from the rules by the last update, and the load order it was built for.
+        # Sorting does not change the graph, so explain can reuse it instead of reading the rules again.
+        self.rule_graph = None
+        self.rule_graph_order = None
+        # Also report plugins that change the same records (see recordIndex).  Reading every record is slow the first time.
+        self.check_records = False
 
         # self.datadir = None                # where plugins live
         # self.plugin_file = None            # Path to the file containing the plugin list
         # self.game_type = None              # 'Morrowind', 'Oblivion', or None for unknown
-        self.game_type, self.plugin_file, self.datadir = fileFinder.find_game_dirs()
+        if find_game:
+            with profiler.stage("find game directories"):
+                self.game_type, self.plugin_file, self.datadir = fileFinder.find_game_dirs()
+        else:
+            (self.game_type, self.plugin_file, self.datadir) = (None, None, None)
+        self.snapshot = None                 # fileFinder.plugin_snapshot of self.datadir, shared by everything reading it
+
+    def _data_snapshot(self):
+        """Get the plugins in the data directory, scanning it only if it has not been scanned yet"""
+        if self.datadir == None:
+            return None
+        if self.snapshot == None or self.snapshot.dir != os.path.normpath(os.path.abspath(self.datadir)):
+            with profiler.stage("scan data directory"):
+                self.snapshot = fileFinder.plugin_snapshot(self.datadir)
+        return self.snapshot
 
     def get_active_plugins(self):
         """
@@ -38,14 +89,17 @@ class loadorder:
             return
 
         # Get all the plugins
-        configFiles = configHandler.configHandler(self.plugin_file,self.game_type).read()
-        dirFiles = configHandler.dataDirHandler(self.datadir).read()
+        with profiler.stage("read game configuration"):
+            configFiles = configHandler.configHandler(self.plugin_file,self.game_type).read()
+        snapshot = self._data_snapshot()
+        with profiler.stage("read data directory"):
+            dirFiles = configHandler.dataDirHandler(self.datadir).read(snapshot)
 
         # Remove plugins not in the data directory (and correct capitalization)
-        configFiles = list(map(str.lower, configFiles))
-        self.order = filter(lambda x: x.lower() in configFiles, dirFiles)
+        configFiles = set(map(fileFinder.canonical, configFiles))
+        self.order = filter(lambda x: fileFinder.canonical(x) in configFiles, dirFiles)
 
-        #Convert the files to lowercase, while storing them in a dict
+        #Convert the files to caseless names, while storing the originals in a dict
         self.order = list(map(self.caseless.cname,self.order))
 
         order_logger.info("Found {0} plugins in: \"{1}\"".format(len(self.order), self.plugin_file))
@@ -60,9 +114,11 @@ class loadorder:
         Updates self.order
         """
         self.is_sorted = False
-        self.order = configHandler.dataDirHandler(self.datadir).read()
+        snapshot = self._data_snapshot()
+        with profiler.stage("read data directory"):
+            self.order = configHandler.dataDirHandler(self.datadir).read(snapshot)
 
-        #Convert the files to lowercase, while storing them in a dict
+        #Convert the files to caseless names, while storing the originals in a dict
         self.order = list(map(self.caseless.cname,self.order))
 
         order_logger.info("Found {0} plugins in: \"{1}\"".format(len(self.order), self.datadir))
@@ -76,27 +132,91 @@ class loadorder:
         """
         self.is_sorted = False
         self.game_type = None
+        self.snapshot = None
         self.datadir = None         #This tells the parser to not worry about things like [SIZE] checks, or trying to read the plugin descriptions
         self.plugin_file = fromfile
+        with profiler.stage("read load order file"):
+            self._set_order(configHandler.configHandler(fromfile).read())
+
+    def read_from_text(self, text, source = "<text>"):
+        """
+        Get the load order from the contents of an input file (see read_from_file).
+
+        Clears self.game_type, self.datadir, and self.plugin_file.
+        Updates self.order
 
-        self.order = configHandler.configHandler(fromfile).read()
+        :param source: Where the text came from, for messages
+        """
+        self.is_sorted = False
+        self.game_type = None
+        self.snapshot = None
+        self.datadir = None
+        self.plugin_file = None     # There is no file to write the new order back to
+        self._set_order(configHandler.configHandler(None).read_lines(text.splitlines()), source)
+
+    def _set_order(self, plugins, source = None):
+        self.order = plugins
         if self.order == []:
             order_logger.warning("No plugins detected.\nmlox understands lists of plugins in the format used by Morrowind.ini or Wrye Mash.\nIs that what you used for input?")
 
-        #Convert the files to lowercase, while storing them in a dict
+        #Convert the files to caseless names, while storing the originals in a dict
         self.order = list(map(self.caseless.cname,self.order))
 
-        order_logger.info("Found {0} plugins in: \"{1}\"".format(len(self.order), self.plugin_file))
+        order_logger.info("Found {0} plugins in: \"{1}\"".format(len(self.order), source if source != None else self.plugin_file))
         order_logger.info("(Note: When the load order input is from an external source, the [SIZE] predicate cannot check the plugin filesizes, so it defaults to True).")
 
     def listversions(self):
         """List the versions of all plugins in the current load order"""
         out = "{0:20} {1:20} {2}\n".format("Name", "Description", "Plugin Name")
-        for p in self.order:
-            (file_ver, desc_ver) = ruleParser.get_version(p, self.datadir)
+        versions = ruleParser.get_versions(self.order, self._data_snapshot())
+        for (p, (file_ver, desc_ver)) in zip(self.order, versions):
             out += "{0:20} {1:20} {2}\n".format(str(file_ver), str(desc_ver), self.caseless.truename(p))
+        headerCache.headers.save()
         return out
 
+    def add_masters(self, graph, warn = True):
+        """
+        Add the masters listed in each active plugin's header, as rules that the plugin loads after them.
+
+        These are hard requirements (the game will not load a plugin before its masters),
+        and they also order plugins that no rule mentions.
+        They are added before any rules, so a rule that contradicts a master is the one that is rejected.
+        Only masters in the load order are added, a missing master is just reported.
+
+        :param warn: Report missing masters
+        """
+        snapshot = self._data_snapshot()
+        if snapshot == None:
+            return
+        active = set(self.order)
+        infos = headerCache.headers.prefetch([(snapshot.find_path(p), snapshot.stat(p)) for p in self.order])
+        for (p, info) in zip(self.order, infos):
+            if info == None:
+                continue
+            for master in info.masters:
+                if fileFinder.canonical(master) in active:
+                    graph.add_edge("{0} [MAST]".format(self.caseless.truename(p)), fileFinder.canonical(master), p)
+                elif warn:
+                    order_logger.warning("\"{0}\" is missing its master \"{1}\"".format(self.caseless.truename(p), master))
+
+    def record_conflicts(self):
+        """
+        Find the active plugins that change the same records.
+
+        :return: A list of recordIndex.conflict_message, one for each group of conflicting plugins
+        """
+        snapshot = self._data_snapshot()
+        if snapshot == None:
+            return []
+        paths = [(snapshot.find_path(p), snapshot.stat(p)) for p in self.order]
+        masters = {}
+        records = {}
+        for (p, (path, stat), info) in zip(self.order, paths, headerCache.headers.prefetch(paths)):
+            masters[p] = set() if info == None else set(map(fileFinder.canonical, info.masters))
+            records[p] = recordIndex.records.get(path, stat) or []
+        return [recordIndex.conflict_message([self.caseless.truename(p) for p in plugins], found)
+                for (plugins, found) in recordIndex.find_conflicts(self.order, records, masters)]
+
     def add_current_order(self, graph):
         """
         Add the current load order as a pseudo rule set.
@@ -127,26 +247,15 @@ class loadorder:
                         graph.add_edge("", "bloodmoon.esm", p)
 
         # make ordering pseudo-rules from nearend info
-        kingyo_fun = [x for x in graph.nearend if x in self.order]
+        active = set(self.order)
+        kingyo_fun = [x for x in graph.nearend if x in active]
         for p_end in kingyo_fun:
-            for p in [x for x in self.order if x != p_end]:
-                graph.add_edge("", p, p_end)
+            graph.add_edges_to("", [x for x in self.order if x != p_end], p_end)
         # make ordering pseudo-rules from current load order.
-        prev_i = 0
-        graph.nodes.setdefault(self.order[prev_i], [])
-        for curr_i in range(1, len(self.order)):
-            graph.nodes.setdefault(self.order[curr_i], [])
-            if (self.order[curr_i] not in graph.nearstart and
-                self.order[curr_i] not in graph.nearend):
-                # add an edge, on any failure due to cycle detection, we try
-                # to make an edge between the current plugin and the first
-                # previous ancestor we can succesfully link and edge from.
-                for i in range(prev_i, 0, -1):
-                    if (self.order[i] not in graph.nearstart and
-                        self.order[i] not in graph.nearend):
-                        if graph.add_edge("", self.order[i], self.order[curr_i]):
-                            break
-            prev_i = curr_i
+        # add an edge, on any failure due to cycle detection, we try
+        # to make an edge between the current plugin and the first
+        # previous ancestor we can succesfully link and edge from.
+        graph.add_chain("", self.order, set(graph.nearstart) | set(graph.nearend))
 
     def get_original_order(self):
         """Get the original plugin order in a nice printable format"""
@@ -157,31 +266,49 @@ class loadorder:
 
     def get_new_order(self):
         """Get the new plugin order in a nice printable format.
-        Also, highlight mods that have moved up in the load order."""
+        Also, highlight the fewest mods that could have been moved to get the new order."""
         formatted = []
+        for entry in self.new_order_entries():
+            highlight = "*" if entry["moved"] else "_"
+            formatted.append("%s%03d%s %s" % (highlight, entry["position"], highlight, entry["name"]))
+        return formatted
+
+    def new_order_entries(self):
+        """
+        Get the new plugin order, along with where each plugin was in the original order.
+
+        :return: A list of dictionaries with each plugin's "name", its "position" in the original order (starting at 1),
+                 and whether it is one of the fewest plugins that could have been "moved" to get the new order
+        """
         orig_index = {}
         for n in range(1,len(self.order)+1):
             orig_index[self.order[n-1]] = n
-        highlight = "_"
-        for i in range(0, len(self.new_order)):
-            p = self.new_order[i]
-            curr = p.lower()
-            if (orig_index[curr] - 1) > i: highlight = "*"
-            formatted.append("%s%03d%s %s" % (highlight, orig_index[curr], highlight, p))
-            if highlight == "*":
-                if i < len(self.new_order) - 1:
-                    next = self.new_order[i+1].lower()
-                if (orig_index[curr] > orig_index[next]):
-                    highlight = "_"
-        return formatted
+        moved = configHandler.moved_plugins(self.order, self.new_order)
+        entries = []
+        for p in self.new_order:
+            curr = self.caseless.cname(p)
+            entries.append({"name": p, "position": orig_index[curr], "moved": curr in moved})
+        return entries
+
+    def explain(self, plugin_name, base_only = False, rules = None):
+        """
+        Explain why a mod is in it's current position
 
-    def explain(self,plugin_name,base_only = False):
-        """Explain why a mod is in it's current position"""
-        parser = ruleParser.rule_parser(self.order, self.datadir, self.caseless)
-        if os.path.exists(user_file):
-            parser.read_rules(user_file)
-        parser.read_rules(base_file)
-        plugin_graph = parser.get_graph()
+        :param rules: The rules to use (see read_rule_files), instead of reading the rules files again
+        """
+        if self.rule_graph is not None and self.rule_graph_order == (self.order, self.datadir):
+            plugin_graph = self.rule_graph.copy()
+        else:
+            parser = ruleParser.rule_parser(self.order, self._data_snapshot(), self.caseless)
+            self.add_masters(parser.get_graph(), warn = False)
+            if rules != None:
+                for rule_set in rules:
+                    parser.add_rules(rule_set)
+            else:
+                if os.path.exists(user_file):
+                    parser.read_rules(user_file)
+                parser.read_rules(base_file)
+            plugin_graph = parser.get_graph()
 
         if not base_only:
             self.add_current_order(plugin_graph) # tertiary order "pseudo-rules" from current load order
@@ -189,12 +316,19 @@ class loadorder:
         output = plugin_graph.explain(plugin_name, self.order)
         return output
 
-    def update(self,progress = None):
+    def update(self, progress = None, rules = None, text = True, write_output = True):
         """
         Update the load order based on input rules.
         Returns the parser's recommendations on success, or False if something went wrong.
+        The recommendations are also kept in self.messages, as message objects.
+
+        :param rules: The rules to use (see read_rule_files), instead of reading the rules files again
+        :param text: Return the recommendations formatted as text.  Otherwise, True is returned on success.
+        :param write_output: With a data directory, save the plugin caches, and write the old and new load orders to
+                             current_loadorder.out and mlox_new_loadorder.out
         """
         self.is_sorted = False
+        self.messages = []
         if self.order == []:
             order_logger.error("No plugins detected!\nmlox needs to run somewhere under where the game is installed.")
             return False
@@ -204,22 +338,34 @@ class loadorder:
 
         # read rules from various sources, and add orderings to graph
         # if any subsequent rule causes a cycle in the current graph, it is discarded
-        parser = ruleParser.rule_parser(self.order, self.datadir, self.caseless)
-        if os.path.exists(user_file):
-            parser.read_rules(user_file, progress)
-        if not parser.read_rules(base_file, progress):
-            order_logger.error("Unable to parse 'mlox_base.txt', load order NOT sorted!")
-            self.new_order = []
-            return False
-
-        # Convert the graph into a sorted list of all plugins (rules + load order)
-        plugin_graph = parser.get_graph()
-        self.add_current_order(plugin_graph)    # tertiary order "pseudo-rules" from current load order
-        sorted_plugins = plugin_graph.topo_sort()
+        parser = ruleParser.rule_parser(self.order, self._data_snapshot(), self.caseless)
+        # masters first, since the game will not load a plugin before them, whatever the rules say
+        with profiler.stage("add masters"):
+            self.add_masters(parser.get_graph())
+        if rules != None:
+            for rule_set in rules:
+                parser.add_rules(rule_set, progress)
+        else:
+            if os.path.exists(user_file):
+                parser.read_rules(user_file, progress)
+            if not parser.read_rules(base_file, progress):
+                order_logger.error("Unable to parse 'mlox_base.txt', load order NOT sorted!")
+                self.new_order = []
+                return False
+
+        # Convert the graph into a sorted list of all plugins (masters + rules + load order)
+        self.rule_graph = parser.get_graph()
+        self.rule_graph_order = (list(self.order), self.datadir)
+        with profiler.stage("add current order"):
+            plugin_graph = self.rule_graph.copy()
+            self.add_current_order(plugin_graph)    # tertiary order "pseudo-rules" from current load order
+        with profiler.stage("topological sort"):
+            sorted_plugins = plugin_graph.topo_sort()
 
         # The "sorted" list will be a superset of all known plugin files,
         # but we only care about active plugins.
-        sorted_datafiles = [f for f in sorted_plugins if f in self.order]
+        active = set(self.order)
+        sorted_datafiles = [f for f in sorted_plugins if f in active]
         (esm_files, esp_files) = configHandler.partition_esps_and_esms(sorted_datafiles)
         new_order_cname = esm_files + esp_files
         self.new_order = list(map(self.caseless.truename, new_order_cname))
@@ -237,24 +383,49 @@ class loadorder:
             order_logger.info("[Plugins already in sorted order. No sorting needed!]")
             self.is_sorted = True
 
+        self.messages = list(parser.get_rule_messages())
         if self.datadir:
             # these are things we do not want to do if just testing a load order from a file
-            # save the load orders to file for future reference
-            configHandler.configHandler(old_loadorder_output, "raw").write(self.order)
-            configHandler.configHandler(new_loadorder_output, "raw").write(self.new_order)
-        return parser.get_messages()
+            if self.check_records:
+                with profiler.stage("find record conflicts"):
+                    self.messages += self.record_conflicts()
+                    if write_output:
+                        recordIndex.records.save()
+        if self.datadir and write_output:
+            with profiler.stage("write output"):
+                # remember what was read from the plugins, for next time
+                headerCache.headers.save()
+                # save the load orders to file for future reference
+                configHandler.configHandler(old_loadorder_output, "raw").write(self.order)
+                configHandler.configHandler(new_loadorder_output, "raw").write(self.new_order)
+        if not text:
+            return True
+        return self.get_messages()
+
+    def get_messages(self):
+        """Get the messages from the last update, formatted as text"""
+        return "".join(m.text() for m in self.messages)
+
+    def write_new_order(self, minimal = False):
+        """
+        Write/save the new order to the directory and config file.
 
-    def write_new_order(self):
-        """Write/save the new order to the directory and config file."""
+        :param minimal: Only change the modification times of plugins that have to move
+        """
         if not isinstance(self.new_order,list) or self.new_order == []:
             order_logger.error("Not saving blank load order.")
             return False
-        if self.datadir:
-            if configHandler.dataDirHandler(self.datadir).write(self.new_order):
-                self.is_sorted = True
-        if isinstance(self.plugin_file,str):
-            if configHandler.configHandler(self.plugin_file,self.game_type).write(self.new_order):
-                self.is_sorted = True
+        with profiler.stage("write new order"):
+            if self.datadir:
+                dir_handler = configHandler.dataDirHandler(self.datadir)
+                written = dir_handler.write_minimal(self.new_order) if minimal else dir_handler.write(self.new_order)
+                # plugin times have changed
+                self.snapshot = None
+                if written:
+                    self.is_sorted = True
+            if isinstance(self.plugin_file,str):
+                if configHandler.configHandler(self.plugin_file,self.game_type).write(self.new_order):
+                    self.is_sorted = True
 
         if not self.is_sorted:
             order_logger.error("Unable to save new load order.")
@@ -1,22 +1,47 @@
 from pprint import PrettyPrinter
+from array import array
 import logging
+from . import fileFinder
 
 pluggraph_logger = logging.getLogger('mlox.pluggraph')
 
 class pluggraph:
     """A graph structure built from ordering rules which specify plugin load (partial) order"""
-    def __init__(self):
-        # nodes is a dictionary of lists, where each key is a plugin, and each
-        # value is a list of the children of that plugin in the graph
+    def __init__(self, table = None):
+        # Every plugin in the graph is given an integer id, and the graph
+        # itself is stored using those ids.
+        # The ids come from a fileFinder.caseless_filenames table, which may
+        # be shared with the rest of mlox, so it can hold plugins that are
+        # not in the graph (yet).
+        # ids is a dictionary of plugin name to id, and names is the reverse
+        self.table = table if table != None else fileFinder.caseless_filenames()
+        self.ids = self.table.ids
+        self.names = self.table.cnames
+        # children is a list (indexed by id) of lists of the children of that
+        # plugin in the graph.
         # that is, if we have "foo.esp" -> "bar.esp" and "foo.esp" -> "baz.esp"
         # where "->" is read "is a parent of" and means "preceeds in load order"
-        # the data structure will contain: {"foo.esp": ["bar.esp", "baz.esp"]}
-        self.nodes = {}
-        # incoming_count is a dictionary of that keeps track of the count of
-        # how many incoming edges a plugin node in the graph has.
-        # incoming_count["bar.esp"] == 1 means that bar.esp only has one parent
-        # incoming_count["foo.esp"] == 0 means that foo.esp is a root node
-        self.incoming_count = {}
+        # the data structure will contain: children[foo] == [bar, baz]
+        self.children = []
+        # parents is the reverse of children
+        self.parents = []
+        # edges is the set of all edges, for quickly checking for duplicates
+        self.edges = set()
+        # incoming is an array of the count of how many incoming edges a
+        # plugin node in the graph has.
+        # incoming[bar] == 1 means that bar.esp only has one parent
+        # incoming[foo] == 0 means that foo.esp is a root node
+        self.incoming = array('l')
+        # listed holds the ids of plugins that were either added directly
+        # (see add_node), or are the parent in an edge.  In that order.
+        # Only listed plugins are considered as roots when sorting.
+        self.listed = []
+        self.is_listed = bytearray()
+        # order_index holds every node's position in a topological order of
+        # the graph, that is kept up to date as edges are added.
+        # If order_index[foo] < order_index[bar], then bar.esp can not reach
+        # foo.esp, so an edge foo.esp -> bar.esp is always safe.
+        self.order_index = array('l')
         # nodes (plugins) that should be pulled nearest to top of load order,
         # if possible.
         self.nearstart = []
@@ -24,30 +49,177 @@ class pluggraph:
         # if possible.
         self.nearend = []
 
-    def can_reach(self, startnode, plugin):
-        """Return True if startnode can reach plugin in the graph, False otherwise."""
-        stack = [startnode]
-        seen = {}
+    def copy(self):
+        """
+        Make an independent copy of the graph.
+
+        Useful for adding edges (like the current load order) without changing the original.
+        """
+        other = pluggraph.__new__(pluggraph)
+        # The plugin table is shared, it only ever grows
+        other.table = self.table
+        other.ids = self.ids
+        other.names = self.names
+        other.children = [list(c) for c in self.children]
+        other.parents = [list(p) for p in self.parents]
+        other.edges = set(self.edges)
+        other.incoming = array('l', self.incoming)
+        other.listed = list(self.listed)
+        other.is_listed = bytearray(self.is_listed)
+        other.order_index = array('l', self.order_index)
+        other.nearstart = list(self.nearstart)
+        other.nearend = list(self.nearend)
+        return other
+
+    def as_dict(self):
+        """
+        Get a copy of the graph as a dictionary of lists, where each key is a plugin, and each
+        value is a list of the children of that plugin in the graph.
+        For example: {"foo.esp": ["bar.esp", "baz.esp"]}
+
+        The graph itself is stored by plugin id, so this is built fresh on every call, and changing it does not change the graph.
+        """
+        return {self.names[i]: [self.names[c] for c in self.children[i]] for i in self.listed}
+
+    def incoming_counts(self):
+        """Get a dictionary of plugin to the count of incoming edges it has, for plugins with parents (built fresh on every call)"""
+        return {self.names[i]: self.incoming[i] for i in range(len(self.children)) if self.parents[i] != []}
+
+    def _id(self, plugin):
+        """Get the id of a plugin, adding it to the graph if it is new."""
+        node = self.table.intern(plugin)
+        # Make room for every id up to this one.  Each node's initial place in
+        # the topological order is its id, so they are all different.
+        for new_node in range(len(self.children), node + 1):
+            self.children.append([])
+            self.parents.append([])
+            self.incoming.append(0)
+            self.is_listed.append(0)
+            self.order_index.append(new_node)
+        return node
+
+    def _lookup(self, plugin):
+        """Get the id of a plugin, or None if it is not in the graph"""
+        node = self.ids.get(plugin)
+        if node == None or node >= len(self.children):
+            return None
+        return node
+
+    def _list(self, node):
+        """Mark a node as listed (see self.listed)"""
+        if not self.is_listed[node]:
+            self.is_listed[node] = 1
+            self.listed.append(node)
+
+    def add_node(self, plugin):
+        """Add a plugin to the graph, without any edges"""
+        self._list(self._id(plugin))
+
+    def _can_reach(self, start, target):
+        """Return True if node start can reach node target in the graph."""
+        index = self.order_index
+        upper = index[target]
+        if index[start] > upper:
+            # start comes after target in the topological order
+            return(False)
+        stack = [start]
+        seen = {start}
         while stack != []:
             p = stack.pop()
-            if p == plugin:
+            if p == target:
                 return(True)
-            seen[p] = True
-            if p in self.nodes:
-                stack.extend([child for child in self.nodes[p] if not child in seen])
+            for child in self.children[p]:
+                # nodes after target in the topological order can not lead to it
+                if not child in seen and index[child] <= upper:
+                    seen.add(child)
+                    stack.append(child)
         return(False)
 
+    def can_reach(self, startnode, plugin):
+        """Return True if startnode can reach plugin in the graph, False otherwise."""
+        if startnode == plugin:
+            return(True)
+        start = self._lookup(startnode)
+        target = self._lookup(plugin)
+        if start == None or target == None:
+            return(False)
+        return self._can_reach(start, target)
+
+    def _forward_region(self, start, target):
+        """
+        Search forwards from node start for node target, only visiting nodes that come before target in the topological order.
+
+        :return: None if target was found, otherwise the list of visited nodes
+        """
+        index = self.order_index
+        upper = index[target]
+        stack = [start]
+        seen = {start}
+        while stack != []:
+            p = stack.pop()
+            for child in self.children[p]:
+                if child == target:
+                    return None
+                if not child in seen and index[child] < upper:
+                    seen.add(child)
+                    stack.append(child)
+        return list(seen)
+
+    def _backward_region(self, start, lower):
+        """Search backwards from node start, only visiting nodes that come after lower in the topological order."""
+        index = self.order_index
+        stack = [start]
+        seen = {start}
+        while stack != []:
+            p = stack.pop()
+            for parent in self.parents[p]:
+                if not parent in seen and index[parent] > lower:
+                    seen.add(parent)
+                    stack.append(parent)
+        return list(seen)
+
+    def _check_and_reorder(self, node1, node2):
+        """
+        Check if an edge from node1 to node2 would create a cycle.
+        If not, update the topological order so the edge can be added.
+
+        This is the dynamic topological sort of Pearce and Kelly.
+        Only the nodes between node2 and node1 in the topological order are searched,
+        instead of everything reachable from node2.
+        :return: True if the edge would create a cycle
+        """
+        if node1 == node2:
+            return True
+        index = self.order_index
+        lower = index[node2]
+        upper = index[node1]
+        if upper < lower:
+            # node1 already comes before node2
+            return False
+        forward = self._forward_region(node2, node1)
+        if forward == None:
+            return True
+        backward = self._backward_region(node1, lower)
+        # Everything that leads to node1 must now come before everything that node2 leads to.
+        # Shuffle them around, using the same set of positions they had before.
+        moved = sorted(backward, key=index.__getitem__) + sorted(forward, key=index.__getitem__)
+        positions = sorted([index[p] for p in moved])
+        for (p, position) in zip(moved, positions):
+            index[p] = position
+        return False
+
     def add_edge(self, where, plug1, plug2):
         """Add an edge to our graph connecting plug1 to plug2, which means
-        that plug2 follows plug1 in the load order. Since we check every new
-        edge to see if it will make a cycle, the process of adding all edges
-        will be O(square(n)/2) in the worst case of a totally ordered
-        set. This could mean a long run-time for the Oblivion data, which
-        is currently a total order of a set of about 5000 plugins."""
+        that plug2 follows plug1 in the load order. Every new edge is checked
+        to see if it will make a cycle. Since the graph keeps a topological
+        order up to date, only the part of the graph between plug2 and plug1
+        in that order needs to be searched."""
+        node1 = self._id(plug1)
+        node2 = self._id(plug2)
         # before adding edge from plug1 to plug2 (meaning plug1 is parent of plug2),
         # we look to see if plug2 is already a parent of plug1, if so, we have
         # detected a cycle, which we disallow.
-        if self.can_reach(plug2, plug1):
+        if self._check_and_reorder(node1, node2):
             # (where == "") when adding edges from psuedo-rules we
             # create from our current plugin list, We ignore cycles in
             # this case because they do not matter.
@@ -59,16 +231,106 @@ class pluggraph:
             else:
                 pluggraph_logger.warning(cycle_detected)
             return False
-        self.nodes.setdefault(plug1, [])
-        if plug2 in self.nodes[plug1]: # edge already exists
-            pluggraph_logger.debug("%s: Not adding duplicate Edge: \"%s\" -> \"%s\"", where, plug1, plug2)
-            return True
-        # add plug2 to the graph as a child of plug1
-        self.nodes[plug1].append(plug2)
-        self.incoming_count[plug2] = self.incoming_count.setdefault(plug2, 0) + 1
-        pluggraph_logger.debug("adding edge: %s -> %s" % (plug1, plug2))
+        self._link(where, node1, node2)
         return(True)
 
+    def _link(self, where, node1, node2):
+        """Add an edge from node1 to node2, which must already be known not to make a cycle."""
+        self._list(node1)
+        edge = (node1 << 32) | node2
+        if edge in self.edges: # edge already exists
+            pluggraph_logger.debug("%s: Not adding duplicate Edge: \"%s\" -> \"%s\"", where, self.names[node1], self.names[node2])
+            return
+        # add node2 to the graph as a child of node1
+        self.edges.add(edge)
+        self.children[node1].append(node2)
+        self.parents[node2].append(node1)
+        self.incoming[node2] += 1
+        pluggraph_logger.debug("adding edge: %s -> %s" % (self.names[node1], self.names[node2]))
+
+    def _descendants(self, start, edges = None):
+        """Get the set of all nodes start can reach, including start itself"""
+        edges = self.children if edges == None else edges
+        seen = {start}
+        stack = [start]
+        while stack != []:
+            p = stack.pop()
+            for child in edges[p]:
+                if not child in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def _ancestors(self, start):
+        """Get the set of all nodes that can reach start, including start itself"""
+        return self._descendants(start, self.parents)
+
+    def _renumber(self):
+        """Rebuild the topological order (order_index) from scratch, after edges were added without keeping it up to date."""
+        incoming = array('l', self.incoming)
+        ready = [node for node in range(len(self.children)) if incoming[node] == 0]
+        position = 0
+        while ready != []:
+            node = ready.pop()
+            self.order_index[node] = position
+            position += 1
+            for child in self.children[node]:
+                incoming[child] -= 1
+                if incoming[child] == 0:
+                    ready.append(child)
+
+    def add_edges_to(self, where, plugins, target):
+        """
+        Add an edge from each of plugins (in order) to target.
+        This is the same as calling add_edge for each one, except that edges that would make a cycle are
+        silently skipped.
+
+        Adding edges into target can not change what target leads to,
+        so that is only searched once, instead of once per edge.
+        """
+        node2 = self._id(target)
+        reach = self._descendants(node2)
+        for plugin in plugins:
+            node1 = self._id(plugin)
+            if node1 in reach:
+                pluggraph_logger.debug("%s: Cycle detected, not adding: \"%s\" -> \"%s\"" % (where, plugin, target))
+                continue
+            self._link(where, node1, node2)
+        self._renumber()
+
+    def add_chain(self, where, chain, anchored = ()):
+        """
+        Add the plugins in chain to the graph, each one following the one before it where possible.
+        Plugins in anchored are added without any edges.
+
+        If a plugin can't follow the one before it without making a cycle, it follows the nearest one
+        further back that it can.  (The first plugin in the chain is never linked to.)
+        This gives the same graph as trying add_edge with each earlier plugin in turn,
+        but what the plugin leads to is only searched once, instead of once per try.
+        """
+        nodes = [self._id(p) for p in chain]
+        for curr_i in range(len(chain)):
+            curr = nodes[curr_i]
+            self._list(curr)
+            if chain[curr_i] in anchored:
+                continue
+            reach = None
+            for i in range(curr_i - 1, 0, -1):
+                if chain[i] in anchored:
+                    continue
+                node = nodes[i]
+                if reach == None:
+                    # Usually the plugin can simply follow the one before it
+                    if not self._check_and_reorder(node, curr):
+                        self._link(where, node, curr)
+                        break
+                    reach = self._descendants(curr)
+                    pluggraph_logger.debug("%s: Cycle detected, searching back for a plugin for \"%s\" to follow" % (where, chain[curr_i]))
+                elif not node in reach:
+                    self._check_and_reorder(node, curr)
+                    self._link(where, node, curr)
+                    break
+
     def get_dot_graph(self):
         """
         Produce a graphviz dot graph.
@@ -76,7 +338,7 @@ class pluggraph:
         This is mostly a novelty to visualize what's going on
         """
         buffer = "digraph plugins {\n"
-        for (node, plugins) in self.nodes.items():
+        for (node, plugins) in self.as_dict().items():
             for a_plugin in plugins:
                 buffer += "\""+ node + "\" -> \"" + a_plugin + "\"\n"
         buffer += "}\n"
@@ -86,6 +348,7 @@ class pluggraph:
         """
         Tell the user all the plugins mlox thinks should follow <what>
         """
+        nodes = self.as_dict()
         seen = {}
         output = ""
         output += "This is a picture of all the plugins mlox thinks should follow {0}\n".format(what)
@@ -97,66 +360,77 @@ class pluggraph:
             if n in seen:
                 return
             seen[n] = True
-            if n in self.nodes:
-                for child in self.nodes[n]:
+            if n in nodes:
+                for child in nodes[n]:
                     prefix = indent.replace(" ", "+") if child in active_plugins else indent.replace(" ", "=")
                     output += "%s%s\n" % (prefix, child)
                     explain_rec(" " + indent, child)
             return output
-        output += explain_rec(" ", what.lower())
+        output += explain_rec(" ", fileFinder.canonical(what))
         return output
 
     def topo_sort(self):
         """topological sort"""
+        names = self.names
 
         def remove_roots(roots, which):
             """This function is used to yank roots out of the main list of graph roots to
             support the NearStart and NearEnd rules."""
             removed = []
             for p in which:
+                p = self._lookup(p)
+                if p == None:
+                    continue
+                # one search back from p, instead of one search forward from every root
+                leads_to_p = self._ancestors(p).__contains__
                 leftover = []
-                while len(roots) > 0:
-                    r = roots.pop(0)
-                    if self.can_reach(r, p):
+                for r in roots:
+                    if leads_to_p(r):
                         removed.append(r)
                     else:
                         leftover.append(r)
                 roots = leftover
             return(removed, roots)
 
+        debug = pluggraph_logger.isEnabledFor(logging.DEBUG)
         # find the roots of the graph
-        roots = [node for node in self.nodes if self.incoming_count.get(node, 0) == 0]
-        pluggraph_logger.debug("========== BEGIN TOPOLOGICAL SORT DEBUG INFO ==========")
-        pluggraph_logger.debug("graph before sort (node: children)")
-        pluggraph_logger.debug(PrettyPrinter(indent=4).pformat(self.nodes))
-        pluggraph_logger.debug("roots:\n  %s" % ("\n  ".join(roots)))
+        roots = [node for node in self.listed if self.incoming[node] == 0]
+        if debug:
+            pluggraph_logger.debug("========== BEGIN TOPOLOGICAL SORT DEBUG INFO ==========")
+            pluggraph_logger.debug("graph before sort (node: children)")
+            pluggraph_logger.debug(PrettyPrinter(indent=4).pformat(self.as_dict()))
+            pluggraph_logger.debug("roots:\n  %s" % ("\n  ".join([names[r] for r in roots])))
         if len(roots) > 0:
             # use the nearstart information to pull preferred plugins to top of load order
             (top_roots, roots) = remove_roots(roots, self.nearstart)
             bottom_roots = roots        # any leftovers go at the end
             roots = top_roots + bottom_roots
-            pluggraph_logger.debug("nearstart:\n  %s" % ("\n  ".join(self.nearstart)))
-            pluggraph_logger.debug("top roots:\n  %s" % ("\n  ".join(top_roots)))
-            pluggraph_logger.debug("nearend:\n  %s" % ("\n  ".join(self.nearend)))
-            pluggraph_logger.debug("bottom roots:\n  %s" % ("\n  ".join(bottom_roots)))
-            pluggraph_logger.debug("newroots:\n  %s" % ("\n  ".join(roots)))
-        pluggraph_logger.debug("========== END TOPOLOGICAL SORT DEBUG INFO ==========\n")
+            if debug:
+                pluggraph_logger.debug("nearstart:\n  %s" % ("\n  ".join(self.nearstart)))
+                pluggraph_logger.debug("top roots:\n  %s" % ("\n  ".join([names[r] for r in top_roots])))
+                pluggraph_logger.debug("nearend:\n  %s" % ("\n  ".join(self.nearend)))
+                pluggraph_logger.debug("bottom roots:\n  %s" % ("\n  ".join([names[r] for r in bottom_roots])))
+                pluggraph_logger.debug("newroots:\n  %s" % ("\n  ".join([names[r] for r in roots])))
+        if debug:
+            pluggraph_logger.debug("========== END TOPOLOGICAL SORT DEBUG INFO ==========\n")
         # now do the actual topological sort
         # based on http://www.bitformation.com/art/python_toposort.html
+        # The graph itself is left untouched, so it can be sorted (or explained) again.
+        incoming = array('l', self.incoming)
+        done = bytearray(len(names))
         roots.reverse()
         sorted_items = []
         while len(roots) != 0:
             root = roots.pop()
-            sorted_items.append(root)
-            if not root in self.nodes:
-                continue
-            for child in self.nodes[root]:
-                self.incoming_count[child] -= 1
-                if self.incoming_count[child] == 0:
+            sorted_items.append(names[root])
+            done[root] = 1
+            for child in self.children[root]:
+                incoming[child] -= 1
+                if incoming[child] == 0:
                     roots.append(child)
-            del self.nodes[root]
-        if len(self.nodes.items()) != 0:
+        leftover = [node for node in self.listed if not done[node]]
+        if len(leftover) != 0:
             pluggraph_logger.error("Topological Sort Failed!")
-            pluggraph_logger.debug(PrettyPrinter(indent=4).pformat(self.nodes.items()))
+            pluggraph_logger.debug(PrettyPrinter(indent=4).pformat([(names[i], [names[c] for c in self.children[i]]) for i in leftover]))
             return None
         return sorted_items
@@ -0,0 +1,203 @@
+"""
+Find out where mlox spends its time.
+
+The stages mlox goes through (finding the game, reading the rules, building the graph, sorting, writing the results)
+are marked with stage().  While a profile is running, each stage's time is recorded, along with how much memory it
+allocated if memory tracing was asked for.  The whole run is also profiled function by function with cProfile.
+When no profile is running, marking a stage costs next to nothing.
+
+Both cProfile and memory tracing slow mlox down, so the stage times are best compared with each other.
+"""
+import io
+import time
+import json
+import pstats
+import logging
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+profile_logger = logging.getLogger('mlox.profiler')
+
+# The running profile, or None
+active = None
+
+
+class stage_stats:
+    """What was recorded for one stage"""
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth          # How many stages this one is inside of
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocated = 0          # Memory still allocated at the end of the stage, in bytes (with memory tracing)
+        self.peak = 0               # The most memory the stage had allocated at once, in bytes (with memory tracing)
+
+    def to_dict(self):
+        return {"name": self.name, "depth": self.depth, "calls": self.calls, "seconds": self.seconds,
+                "allocated": self.allocated, "peak": self.peak}
+
+
+class _frame:
+    """A stage that is running"""
+    def __init__(self, stats, memory):
+        self.stats = stats
+        self.start_memory = memory
+        self.peak_memory = memory
+        self.start_time = time.perf_counter()
+
+
+class profile:
+    """Per stage timings for one run of mlox, plus a cProfile profile of the whole run"""
+    def __init__(self, use_cprofile = True, trace_memory = False):
+        """
+        :param use_cprofile: Also profile every function call with cProfile
+        :param trace_memory: Also record how much memory each stage allocates with tracemalloc
+        """
+        self.use_cprofile = use_cprofile
+        self.trace_memory = trace_memory
+        self.stages = {}            # (stage name, depth) -> stage_stats, in the order the stages first ran
+        self.seconds = 0.0
+        self.cprofile = None
+        self._stack = []
+        self._thread = None
+        self._start_time = None
+        self._started_tracing = False
+
+    def start(self):
+        """Start recording.  Only stages run by the thread calling this are recorded."""
+        global active
+        if active != None:
+            raise RuntimeError("A profile is already running")
+        self._thread = threading.get_ident()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.use_cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self._start_time = time.perf_counter()
+        active = self
+
+    def stop(self):
+        """Stop recording"""
+        global active
+        self.seconds = time.perf_counter() - self._start_time
+        if self.cprofile != None:
+            self.cprofile.disable()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        active = None
+
+    def _enter(self, name):
+        memory = 0
+        if self.trace_memory:
+            (memory, peak) = tracemalloc.get_traced_memory()
+            # The peak is reset for each stage, so keep the outer stage's peak so far
+            if self._stack:
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, peak)
+            tracemalloc.reset_peak()
+        key = (name, len(self._stack))
+        stats = self.stages.get(key)
+        if stats == None:
+            stats = self.stages[key] = stage_stats(name, len(self._stack))
+        self._stack.append(_frame(stats, memory))
+
+    def _exit(self):
+        frame = self._stack.pop()
+        stats = frame.stats
+        stats.calls += 1
+        stats.seconds += time.perf_counter() - frame.start_time
+        if self.trace_memory:
+            (memory, peak) = tracemalloc.get_traced_memory()
+            frame.peak_memory = max(frame.peak_memory, peak)
+            stats.allocated += memory - frame.start_memory
+            stats.peak = max(stats.peak, frame.peak_memory - frame.start_memory)
+            if self._stack:
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, frame.peak_memory)
+            tracemalloc.reset_peak()
+
+    def table(self):
+        """Format the stage timings as a table"""
+        out = "{0:<44} {1:>6} {2:>10}".format("Stage", "Calls", "Seconds")
+        if self.trace_memory:
+            out += " {0:>12} {1:>12}".format("Allocated", "Peak")
+        out += "\n"
+        for stats in self.stages.values():
+            out += "{0:<44} {1:>6} {2:>10.4f}".format(("  " * stats.depth + stats.name)[:44], stats.calls, stats.seconds)
+            if self.trace_memory:
+                out += " {0:>12} {1:>12}".format(_format_bytes(stats.allocated), _format_bytes(stats.peak))
+            out += "\n"
+        out += "{0:<44} {1:>6} {2:>10.4f}\n".format("Total", "", self.seconds)
+        return out
+
+    def function_stats(self, limit = 20, sort = "tottime"):
+        """
+        Get the slowest functions found by cProfile.
+
+        :return: A list of dictionaries with each function's file, line, name, calls, and time, or an empty list without cProfile
+        """
+        if self.cprofile == None:
+            return []
+        stats = pstats.Stats(self.cprofile, stream = io.StringIO())
+        field = {"tottime": 2, "cumtime": 3}[sort]
+        slowest = sorted(stats.stats.items(), key = lambda item: item[1][field], reverse = True)[:limit]
+        return [{"file": file_name, "line": line, "function": function, "calls": calls,
+                 "tottime": tottime, "cumtime": cumtime}
+                for ((file_name, line, function), (primitive_calls, calls, tottime, cumtime, callers)) in slowest]
+
+    def print_functions(self, stream, limit = 20):
+        """Print the functions mlox spent the most time in, the way cProfile does"""
+        if self.cprofile == None:
+            return
+        stats = pstats.Stats(self.cprofile, stream = stream)
+        stats.strip_dirs()
+        stats.sort_stats('time', 'calls')
+        stats.print_stats(limit)
+
+    def to_dict(self):
+        return {"seconds": self.seconds,
+                "trace_memory": self.trace_memory,
+                "stages": [stats.to_dict() for stats in self.stages.values()],
+                "functions": self.function_stats(50)}
+
+    def write_json(self, path):
+        """Write the stage timings (and the slowest functions) to a JSON file"""
+        with open(path, 'w', encoding='utf-8') as file_handle:
+            json.dump(self.to_dict(), file_handle, indent = 1)
+        profile_logger.info("Wrote: \"{0}\"".format(path))
+
+    def write_stats(self, path):
+        """Write the cProfile profile to a file, for pstats or other profile viewers"""
+        if self.cprofile == None:
+            return
+        self.cprofile.dump_stats(path)
+        profile_logger.info("Wrote: \"{0}\"".format(path))
+
+
+def _format_bytes(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "{0:.0f} {1}".format(size, unit) if unit == "B" else "{0:.1f} {1}".format(size, unit)
+        size /= 1024
+    return "{0:.1f} GiB".format(size)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Mark a stage of mlox's work, to be timed while a profile is running.
+
+    Use it as "with profiler.stage('sort'):".  Stages can be inside other stages.
+    """
+    current = active
+    if current == None or current._thread != threading.get_ident():
+        yield
+        return
+    current._enter(name)
+    try:
+        yield
+    finally:
+        current._exit()
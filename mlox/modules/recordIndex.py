@@ -0,0 +1,188 @@
+"""
+Find plugins that change the same records.
+
+[CONFLICT] rules only know about the conflicts someone has written a rule for.
+This reads the records in each plugin, and finds the records that more than one active plugin changes.
+Plugins can be hundreds of megabytes, so they are memory mapped and only the start of each record is looked at.
+What each plugin contains is saved in the cache directory, and a plugin is only read again when its size or
+modification time changes.
+
+Only Morrowind (TES3) plugins are understood.  Oblivion plugins are skipped.
+"""
+import os
+import mmap
+import struct
+import logging
+from . import cacheFile
+from .resources import user_path
+
+record_logger = logging.getLogger('mlox.recordIndex')
+
+# Where the index is saved
+cache_dir = os.path.join(user_path, "cache")
+
+# Bump this whenever the layout of the saved index changes, so old indexes are thrown out
+CACHE_FORMAT = 1
+
+# Records the game merges, instead of the last one loaded replacing the others, so changing them is not a conflict.
+# (Cells merge their references, and dialogue topics merge their responses, which are compared as INFO records.)
+merged_types = {"TES3", "CELL", "DIAL"}
+
+# The subrecord identifying a record, for the records that are not identified by their NAME
+id_subrecords = {"INFO": b"INAM", "SKIL": b"INDX", "MGEF": b"INDX", "LAND": b"INTV", "SCPT": b"SCHD"}
+
+
+def _record_id(block, rec_type, start, end):
+    """Get the ID of the record whose subrecords are between start and end, or None if it has none"""
+    wanted = id_subrecords.get(rec_type, b"NAME")
+    pos = start
+    while pos + 8 <= end:
+        (size,) = struct.unpack_from("<I", block, pos + 4)
+        data = pos + 8
+        if block[pos:pos + 4] == wanted:
+            if wanted == b"INDX" and size >= 4:
+                return str(struct.unpack_from("<i", block, data)[0])
+            if wanted == b"INTV" and size >= 8:
+                return "%d,%d" % struct.unpack_from("<ii", block, data)
+            if wanted == b"SCHD":
+                size = min(size, 32)    # the script name is the first field of the script header
+            # IDs are not case sensitive
+            return block[data:min(data + size, end)].split(b"\x00", 1)[0].decode("cp1252", "replace").lower()
+        pos = data + size
+    return None
+
+
+def read_records(plugin):
+    """
+    Get the (record type, ID) of every record in a Morrowind plugin.
+
+    :return: A list of (record type, ID) tuples, or an empty list if the plugin is not a Morrowind plugin
+    :raises IOError: If the plugin can not be read
+    """
+    with open(plugin, 'rb') as inp:
+        try:
+            block = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:          # an empty file can not be mapped
+            return []
+        with block:
+            if block[0:4] != b"TES3":
+                return []
+            records = []
+            end = len(block)
+            pos = 0
+            # Each record is a 16 byte header (type, size, and 2 unused fields), then its subrecords
+            while pos + 16 <= end:
+                rec_type = block[pos:pos + 4].decode("ascii", "replace")
+                (size,) = struct.unpack_from("<I", block, pos + 4)
+                data = pos + 16
+                if rec_type not in merged_types:
+                    rec_id = _record_id(block, rec_type, data, min(data + size, end))
+                    if rec_id != None:
+                        records.append((rec_type, rec_id))
+                pos = data + size
+            return records
+
+
+class record_index(cacheFile.entry_cache):
+    """The records in each plugin, keyed by plugin path.  Each entry is (size, mtime in ns, list of records)."""
+    cache_format = CACHE_FORMAT
+    logger = record_logger
+
+    def _path(self):
+        return self.cache_file if self.cache_file != None else os.path.join(cache_dir, "records.pkl")
+
+    def get(self, plugin, stat = None):
+        """
+        Get the records in a plugin file.
+
+        :param plugin: Path to the plugin
+        :param stat: The result of os.stat(plugin), if the caller already has it
+        :return: A list of (record type, ID) tuples, or None if the plugin can not be read
+        """
+        if plugin == None:
+            return None
+        self._load_once()
+        path = os.path.abspath(plugin)
+        try:
+            if stat == None:
+                stat = os.stat(path)
+            entry = self.entries.get(path)
+            if entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                return entry[2]
+            record_logger.debug("Reading records from: \"{0}\"".format(path))
+            records = read_records(path)
+        except (IOError, OSError):
+            return None
+        self.entries[path] = (stat.st_size, stat.st_mtime_ns, records)
+        self.changed = True
+        return records
+
+
+def find_conflicts(plugins, records, masters):
+    """
+    Find the records that more than one plugin changes.
+
+    A plugin changing its masters' records is how plugins work, so a master is not counted as conflicting with
+    plugins that depend on it.  Only plugins that replace each other's changes are.
+
+    :param plugins: The plugins, in load order
+    :param records: A dictionary of plugin -> its list of (record type, ID) tuples
+    :param masters: A dictionary of plugin -> the set of its masters (as canonical names)
+    :return: A list of (tuple of conflicting plugins, list of records they all change) tuples, in load order
+    """
+    changed_by = {}
+    for p in plugins:
+        for record in records.get(p, ()):
+            changed_by.setdefault(record, []).append(p)
+    groups = {}
+    for (record, changers) in changed_by.items():
+        if len(changers) < 2:
+            continue
+        overridden = set()
+        for p in changers:
+            overridden.update(masters.get(p, ()))
+        changers = tuple(p for p in changers if p not in overridden)
+        if len(changers) > 1:
+            groups.setdefault(changers, []).append(record)
+    position = dict((p, i) for (i, p) in enumerate(plugins))
+    return sorted(((changers, sorted(found)) for (changers, found) in groups.items()),
+                  key=lambda group: [position[p] for p in group[0]])
+
+
+class conflict_message:
+    """
+    A message about plugins that change the same records, shown like the [CONFLICT] messages from the rules.
+    (See ruleEvaluator.rule_message, these have the same attributes.)
+    """
+    kind = "CONFLICT"
+    rule_file = None
+    line_num = None
+    missing_prerequisites = False
+
+    def __init__(self, plugins, found):
+        """
+        :param plugins: The names of the conflicting plugins
+        :param found: The (record type, ID) of each record they all change
+        """
+        self.exprs = list(plugins)
+        self.records = found
+        shown = ", ".join("{0} {1}".format(rec_type, rec_id) for (rec_type, rec_id) in found[:5])
+        if len(found) > 5:
+            shown += ", and {0} more".format(len(found) - 5)
+        self.message = [" These plugins change the same {0} record(s): {1}".format(len(found), shown)]
+
+    def where(self):
+        return "records"
+
+    def text(self):
+        """Format the message the way mlox shows it to users"""
+        return "[CONFLICT]\n" + "".join(" > {0}\n".format(p) for p in self.exprs) + " |" + self.message[0] + "\n"
+
+    def to_dict(self):
+        """The message as a dictionary, ready to be encoded as JSON"""
+        return {"kind": self.kind, "file": None, "line": None, "expressions": self.exprs, "message": self.message,
+                "records": [list(record) for record in self.records]}
+
+
+# The index used by the rest of mlox
+records = record_index()
@@ -0,0 +1,74 @@
+"""
+Cache compiled rule files (mlox_base.txt, mlox_user.txt) on disk.
+
+Reading the rules files is the slowest part of sorting a load order, and the rules rarely change.
+So the compiled form of each file is pickled into the cache directory, tagged with a hash of the source file.
+If the source file changes, the hash no longer matches and the compiled form is rebuilt.
+"""
+import os
+import hashlib
+import logging
+from . import cacheFile
+from .resources import user_path
+
+cache_logger = logging.getLogger('mlox.ruleCache')
+
+# Where compiled rule files are stored
+cache_dir = os.path.join(user_path, "cache")
+
+# Bump this whenever the layout of the compiled data changes, so old caches are thrown out
+CACHE_FORMAT = 7
+
+
+def file_hash(file_path):
+    """Get the hash of a file's contents"""
+    with open(file_path, 'rb') as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+
+def cache_path(rule_file):
+    """Get the path of the cache file for a rule file"""
+    path_hash = hashlib.sha1(os.path.abspath(rule_file).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, "{0}.{1}.pkl".format(os.path.basename(rule_file), path_hash))
+
+
+def _read_cache(cache_file, source_hash):
+    """
+    Read a compiled rule file from the cache.
+
+    :return: The compiled data, or None if it is missing or out of date
+    """
+    cached = cacheFile.read(cache_file, CACHE_FORMAT, cache_logger)
+    if cached == None:
+        return None
+    (cache_hash, compiled) = cached
+    if cache_hash != source_hash:
+        cache_logger.debug("Cache file {0} is out of date".format(cache_file))
+        return None
+    return compiled
+
+
+def _write_cache(cache_file, source_hash, compiled):
+    """Write a compiled rule file to the cache.  Failure is not fatal, the rules will just be compiled again."""
+    return cacheFile.write(cache_file, CACHE_FORMAT, (source_hash, compiled), cache_logger)
+
+
+def load(rule_file, compiler):
+    """
+    Get the compiled form of a rule file.
+
+    :param rule_file: Path to the rules file
+    :param compiler: Function taking the path to the rules file, and returning its compiled form
+    :return: The compiled rules, either from the cache, or freshly compiled
+    :raises IOError: If the rules file can not be read
+    """
+    source_hash = file_hash(rule_file)
+    cache_file = cache_path(rule_file)
+    compiled = _read_cache(cache_file, source_hash)
+    if compiled is not None:
+        cache_logger.debug("Loaded \"{0}\" from cache".format(rule_file))
+        return compiled
+    cache_logger.debug("Compiling \"{0}\"".format(rule_file))
+    compiled = compiler(rule_file)
+    _write_cache(cache_file, source_hash, compiled)
+    return compiled
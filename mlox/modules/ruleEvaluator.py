@@ -0,0 +1,544 @@
+"""
+Evaluate parsed rules against a list of plugins.
+
+The rules files are parsed once into a ruleParser.rule_set, which does not depend on the plugins a user has.
+A rule_evaluator then checks a rule_set against one list of plugins (and possibly the data directory they live in).
+The result is an ordering graph (see pluggraph), and a list of messages for the user (see rule_message).
+"""
+import re
+import bisect
+import itertools
+import logging
+from pprint import PrettyPrinter
+from . import pluggraph
+from . import fileFinder
+from . import ruleParser
+from . import headerCache
+
+# for cleaning up pretty printer
+re_notstr = re.compile(r"\s*'NOT',")
+re_anystr = re.compile(r"\s*'ANY',")
+re_allstr = re.compile(r"\s*'ALL',")
+re_indented = re.compile(r'^', re.MULTILINE)
+
+parse_logger = logging.getLogger('mlox.parser')
+
+# A pattern's literal prefix ends at the first filename metacharacter, or anything else regular expressions treat specially
+re_pattern_prefix = re.compile(r'^[^*?<\[\]{}\\^$|]*')
+# compiled plugin name patterns, shared by all evaluators (see compile_pattern)
+pattern_cache = {}
+
+
+def compile_pattern(plugin):
+    """
+    Turn a plugin name with metacharacters ('*', '?', and '<VER>') into a regular expression.
+
+    :return: A tuple of the compiled expression (or None if the name has no metacharacters),
+             and the canonical literal prefix every matching plugin name must start with.
+    """
+    compiled = pattern_cache.get(plugin)
+    if compiled != None:
+        return compiled
+    pat = "^%s$" % ruleParser.re_escape_meta.sub(r'\\\1', plugin)
+    # if the plugin name contains metacharacters, do filename expansion
+    subbed = False
+    if ruleParser.re_plugin_meta.search(plugin) != None:
+        parse_logger.debug("expand_filename name has META: %s" % pat)
+        pat = ruleParser.re_plugin_meta.sub(r'.\1', pat)
+        subbed = True
+    if ruleParser.re_plugin_metaver.search(plugin) != None:
+        parse_logger.debug("expand_filename name has METAVER: %s" % pat)
+        pat = ruleParser.re_plugin_metaver.sub(lambda m: ruleParser.plugin_version, pat)
+        subbed = True
+    if subbed:
+        parse_logger.debug("expand_filename new RE pat: %s" % pat)
+        re_namepat = re.compile(pat, re.IGNORECASE)
+    else:
+        re_namepat = None
+    prefix = re_pattern_prefix.match(plugin).group(0)
+    compiled = (re_namepat, fileFinder.canonical(prefix))
+    pattern_cache[plugin] = compiled
+    return compiled
+
+
+def format_expr(expr, prefix):
+    """Pretty print an evaluated expression (see rule_evaluator._evaluate_expression), starting each line with prefix"""
+    formatted = PrettyPrinter(indent=2).pformat(expr)
+    formatted = re_notstr.sub("NOT", formatted)
+    formatted = re_anystr.sub("ANY", formatted)
+    formatted = re_allstr.sub("ALL", formatted)
+    return(re_indented.sub(prefix, formatted))
+
+
+def _is_missing(expr):
+    return isinstance(expr, str) and expr[0:8] == "MISSING("
+
+
+def _missing_any(expr):
+    """Return True if an evaluated expression is an [ANY] of only missing plugins"""
+    return isinstance(expr, list) and expr[0] == "ANY" and all(_is_missing(e) for e in expr[1:])
+
+
+def _prune_missing(exprs):
+    """
+    Leave the missing plugins out of the arguments of an [ANY], since they are not why it is True.
+
+    If every plugin is missing they are all kept, since they are why it is False.
+    A [NOT] of them is True only because nothing is installed, so it is left out instead (see rule_evaluator._combine).
+    """
+    pruned = [e for e in exprs if not(_is_missing(e) or _missing_any(e))]
+    return pruned if pruned != [] else exprs
+
+
+class rule_message:
+    """
+    A message from a [CONFLICT], [NOTE], [PATCH], or [REQUIRES] rule that fired.
+
+    Only the parts of the message are kept.  The text users see is put together when it is asked for (see text).
+    """
+    def __init__(self, kind, rule_file, line_num, exprs, message, missing_prerequisites = False):
+        self.kind = kind                # 'CONFLICT', 'NOTE', 'PATCH', or 'REQUIRES'
+        self.rule_file = rule_file
+        self.line_num = line_num
+        # The evaluated expressions the message is about.  Each is a plugin name, "MISSING(plugin name)",
+        # a [DESC], [VER], or [SIZE] check, or a list starting with "ALL", "ANY", or "NOT" followed by more expressions.
+        # [PATCH] has the patch and what it patches, and [REQUIRES] has the plugin and what it requires.
+        self.exprs = exprs
+        self.message = message          # The lines of the message written in the rule
+        # For [PATCH], whether the patch is there but what it patches is not (instead of the other way around)
+        self.missing_prerequisites = missing_prerequisites
+
+    def where(self):
+        return "%s:%d" % (self.rule_file, self.line_num)
+
+    def text(self):
+        """Format the message the way mlox shows it to users"""
+        msg = "" if self.message == [] else " |" + "\n |".join(self.message) + "\n"
+        if self.kind in ("CONFLICT", "NOTE"):
+            return "[%s]\n" % self.kind + "".join(format_expr(e, " > ") + "\n" for e in self.exprs) + msg
+        if self.kind == "PATCH":
+            if self.missing_prerequisites:
+                # case where the patch is present but the thing to be patched is missing
+                template = "[PATCH]\n%s is missing some pre-requisites:\n%s\n\n"
+            else:
+                # case where the patch is missing for the thing to be patched
+                template = "[PATCH]\n%s for:\n%s\n\n"
+            return template % (format_expr(self.exprs[0], " !!"), format_expr(self.exprs[1], " ")) + msg
+        # REQUIRES
+        expr2_str = format_expr(self.exprs[1], " > ")
+        out = "[REQUIRES]\n%s Requires:\n%s\n\n" % (format_expr(self.exprs[0], " !!!"), expr2_str) + msg
+        if ruleParser.re_filename_version.search(expr2_str):
+            out += " | [Note that you may see this message if you have an older version of one of the pre-requisites. In that case, it is suggested that you upgrade to the newer version].\n"
+        return out
+
+    def to_dict(self):
+        """The message as a dictionary, ready to be encoded as JSON"""
+        out = {"kind": self.kind, "file": self.rule_file, "line": self.line_num,
+               "expressions": self.exprs, "message": self.message}
+        if self.kind == "PATCH":
+            out["missing_prerequisites"] = self.missing_prerequisites
+        return out
+
+
+class rule_evaluator:
+    """Evaluates rule statements containing nested boolean expressions, for one list of plugins."""
+
+    def __init__(self, plugin_list, datadir, name_converter):
+        self.plugin_list = plugin_list
+        # For expanding plugin names (see _expand_filename)
+        self.plugin_set = set(fileFinder.canonical(p) for p in plugin_list)
+        # (canonical name, position in plugin_list), sorted so plugins with a common prefix are together
+        self.name_index = sorted((fileFinder.canonical(p), pos) for (pos, p) in enumerate(plugin_list))
+        self.expansions = {}
+        if isinstance(datadir, fileFinder.caseless_dirlist):
+            self.datadir = datadir
+        elif datadir:
+            self.datadir = fileFinder.caseless_dirlist(datadir)
+        else:
+            self.datadir = None
+        self.name_converter = name_converter
+        # The graph shares the plugin table, and so the plugin ids
+        self.graph = pluggraph.pluggraph(name_converter)
+        self.rule_file = None
+        self.messages = []                  # rule_message for each rule that fired, in order
+
+    def _where(self, line_num):
+        """Convenience function letting the caller know at what point in the rule file something happened."""
+        return("%s:%d" % (self.rule_file, line_num))
+
+    def _expand_filename(self, plugin):
+        """
+        Get the plugins (in plugin list order) matching a plugin name, which may contain metacharacters.
+
+        Patterns are compiled once (see compile_pattern), and only plugins sharing the pattern's literal prefix are tried.
+        """
+        parse_logger.debug("expand_filename, plugin=%s" % plugin)
+        matches = self.expansions.get(plugin)
+        if matches != None:
+            return(matches)
+        (re_namepat, prefix) = compile_pattern(plugin)
+        if re_namepat == None:        # no expansions made
+            matches = [plugin] if fileFinder.canonical(plugin) in self.plugin_set else []
+        else:
+            # The names starting with prefix are all next to each other in the sorted name index
+            start = bisect.bisect_left(self.name_index, (prefix,))
+            candidates = []
+            for (name, pos) in itertools.islice(self.name_index, start, None):
+                if not name.startswith(prefix):
+                    break
+                candidates.append(pos)
+            candidates.sort()
+            matches = []
+            for pos in candidates:
+                p = self.plugin_list[pos]
+                if re_namepat.match(p):
+                    matches.append(p)
+                    parse_logger.debug("expand_filename: %s expands to: %s" % (plugin, p))
+        self.expansions[plugin] = matches
+        return(matches)
+
+    def _evaluate_ordering(self, rule):
+        prev = None
+        for (line_num, entry) in rule.entries:
+            # Only the first match of a name with metacharacters is used
+            matches = self._expand_filename(entry.name)
+            p = matches[0] if matches != [] else entry.name
+            if rule.kind == "ORDER":
+                if prev != None:
+                    self.graph.add_edge(self._where(line_num), prev, p)
+                prev = p
+            elif rule.kind == "NEARSTART":
+                self.graph.nearstart.append(p)
+                self.graph.add_node(p)
+            elif rule.kind == "NEAREND":
+                self.graph.nearend.append(p)
+                self.graph.add_node(p)
+
+    def _evaluate_ver(self, expr):
+        op = expr.op
+        orig_ver = expr.orig_ver
+        ver = expr.ver
+        plugin_name = expr.plugin_name
+        expanded = self._expand_filename(plugin_name)
+        result_expr = "[VER %s %s %s]" % (op, orig_ver, plugin_name)
+        parse_logger.debug("evaluate_ver, expr=%s ver=%s" % (result_expr, ver))
+        if len(expanded) == 1:
+            result_expr = "[VER %s %s %s]" % (op, orig_ver, expanded[0])
+        elif expanded == []:
+            parse_logger.debug("evaluate_ver [VER] \"%s\" not active" % plugin_name)
+            return(False, result_expr) # file does not exist
+        if self.datadir == None:
+            # this case is reached when doing fromfile checks
+            # and we do not have the actual plugin to check, so
+            # we assume that the plugin matches the given version
+            return(op == '=', result_expr)
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            info = ruleParser.plugin_header(self.datadir.find_path(plugin), self.datadir.stat(plugin))
+            if info != None and info.version != None:
+                p_ver_orig = info.version
+                p_ver = info.formatted_version
+                parse_logger.debug("evaluate_ver (header) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
+            else:
+                match = ruleParser.re_filename_version.search(plugin)
+                if match:
+                    p_ver_orig = match.group(1)
+                    p_ver = ruleParser.format_version(p_ver_orig)
+                    parse_logger.debug("evaluate_ver (filename) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
+                else:
+                    parse_logger.debug("evaluate_ver no version for %s" % plugin_t)
+                    return(False, result_expr)
+            parse_logger.debug("evaluate_ver compare  p_ver=%s %s ver=%s" % (p_ver, op, ver))
+            result = True
+            if op == '=':
+                result = (p_ver == ver)
+            elif op == '<':
+                result = (p_ver < ver)
+            elif op == '>':
+                result = (p_ver > ver)
+            if result:
+                return(True, "[VER %s %s %s]" % (op, orig_ver, plugin))
+        return(False, result_expr)
+
+    def _evaluate_desc(self, expr):
+        """match patterns against the description string in the plugin header."""
+        bang = expr.bang
+        pat = expr.pat
+        plugin_name = expr.plugin_name
+        result_expr = "[DESC %s/%s/ %s]" % (bang, pat, plugin_name)
+        parse_logger.debug("evaluate_desc, expr=%s" % result_expr)
+        expanded = self._expand_filename(plugin_name)
+        if len(expanded) == 1:
+            result_expr = "[DESC %s/%s/ %s]" % (bang, pat, expanded[0])
+        elif expanded == []:
+            parse_logger.debug("evaluate_desc [DESC] \"%s\" not active" % plugin_name)
+            return(False, result_expr) # file does not exist
+        if self.datadir == None:
+            # this case is reached when doing fromfile checks,
+            # which do not have access to the actual plugin, so we
+            # always assume the test is merely for file existence,
+            # to err on the side of caution
+            return(True, result_expr)
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            re_pat = re.compile(pat)
+            desc = ruleParser.plugin_description(self.datadir.find_path(plugin), self.datadir.stat(plugin))
+            bool = (re_pat.search(desc) != None)
+            if bang == "!": bool = not bool
+            parse_logger.debug("evaluate_desc [DESC] returning: (%s, %s)" % (bool, result_expr))
+            if bool:
+                return(True, "[DESC %s/%s/ %s]" % (bang, pat, plugin_t))
+        return(False, result_expr)
+
+    def _evaluate_size(self, expr):
+        """check the given size of the plugin."""
+        bang = expr.bang
+        wanted_size = expr.wanted_size
+        plugin_name = expr.plugin_name
+        result_expr = "[SIZE %s%d %s]" % (bang, wanted_size, plugin_name)
+        parse_logger.debug("evaluate_size, expr=%s" % result_expr)
+        expanded = self._expand_filename(plugin_name)
+        if len(expanded) == 1:
+            result_expr = "[SIZE %s%d %s]" % (bang, wanted_size, expanded[0])
+        elif expanded == []:
+            parse_logger.debug("evaluate_size [SIZE] \"%s\" not active" % plugin_name)
+            return(False, result_expr) # file does not exist
+        if self.datadir == None:
+            # this case is reached when doing fromfile checks,
+            # which do not have access to the actual plugin, so we
+            # always assume the test is merely for file existence,
+            # to err on the side of caution
+            return(True, result_expr)
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            info = ruleParser.plugin_header(self.datadir.find_path(plugin), self.datadir.stat(plugin))
+            actual_size = None if info == None else info.size
+            bool = (actual_size == wanted_size)
+            if bang == "!": bool = not bool
+            parse_logger.debug("evaluate_size [SIZE] returning: (%s, %s)" % (bool, result_expr))
+            if bool:
+                return(True, "[SIZE %s%d %s]" % (bang, wanted_size, plugin_t))
+        return(False, result_expr)
+
+    def _combine(self, fun, vals, exprs, prune):
+        """Combine the results of the arguments of a boolean function"""
+        if fun == "ALL":
+            # prune out uninteresting expressions from ANY results
+            exprs = [e for e in exprs if not(isinstance(e, list) and e == [])]
+            if exprs == []:
+                return(all(vals), [])
+            return(all(vals), exprs[0] if len(exprs) == 1 else ["ALL"] + exprs)
+        if fun == "ANY":
+            # prune out uninteresting expressions from ANY results
+            if prune:
+                exprs = _prune_missing(exprs)
+            return(any(vals), exprs[0] if len(exprs) == 1 else ["ANY"] + exprs)
+        # fun == "NOT"
+        if prune and all(_missing_any(e) for e in exprs):
+            # True only because plugins are missing, which is nothing worth showing
+            return(not(all(vals)), [])
+        return(not(all(vals)), ["NOT"] + exprs)
+
+    def _evaluate_expression(self, expr, prune=False):
+        """
+        Evaluate an expression.
+
+        :return: A list of (bool, expr) tuples.
+                 There is usually only one, but a plugin name with metacharacters gives one for each plugin it matches.
+        """
+        if isinstance(expr, ruleParser.plugin_expr):
+            matches = self._expand_filename(expr.name)
+            if matches == []:
+                return [(False, "MISSING(%s)" % self.name_converter.truename(expr.name))]
+            return [(True, self.name_converter.truename(p)) for p in matches]
+        if isinstance(expr, ruleParser.bool_expr):
+            vals = []
+            exprs = []
+            for arg in expr.args:
+                for (bool, arg_expr) in self._evaluate_expression(arg, prune):
+                    vals.append(bool)
+                    exprs.append(arg_expr)
+            return [self._combine(expr.fun, vals, exprs, prune)]
+        if isinstance(expr, ruleParser.desc_expr):
+            return [self._evaluate_desc(expr)]
+        if isinstance(expr, ruleParser.ver_expr):
+            return [self._evaluate_ver(expr)]
+        if isinstance(expr, ruleParser.size_expr):
+            return [self._evaluate_size(expr)]
+        raise TypeError("Unknown expression: %r" % expr)
+
+    def _truth(self, expr):
+        """
+        Get only the boolean value of an expression.
+
+        Unlike _evaluate_expression, this stops as soon as an [ANY] is satisfied or an [ALL] fails,
+        so [DESC], [VER], and [SIZE] checks that can not change the result are never done.
+        A plugin name with metacharacters counts as True if it matches anything, the same as [ANY] of its matches.
+        """
+        if isinstance(expr, ruleParser.plugin_expr):
+            return self._expand_filename(expr.name) != []
+        if isinstance(expr, ruleParser.bool_expr):
+            if expr.fun == "ALL":
+                return all(self._truth(arg) for arg in expr.args)
+            if expr.fun == "ANY":
+                return any(self._truth(arg) for arg in expr.args)
+            # fun == "NOT"
+            return not all(self._truth(arg) for arg in expr.args)
+        if isinstance(expr, ruleParser.desc_expr):
+            return self._evaluate_desc(expr)[0]
+        if isinstance(expr, ruleParser.ver_expr):
+            return self._evaluate_ver(expr)[0]
+        if isinstance(expr, ruleParser.size_expr):
+            return self._evaluate_size(expr)[0]
+        raise TypeError("Unknown expression: %r" % expr)
+
+    def _fires(self, rule):
+        """
+        Decide whether a statement rule gives a message, doing as little work as possible.
+
+        Only rules that fire need their expressions fully evaluated, to build the message.
+        """
+        if rule.kind == "CONFLICT":
+            found = 0
+            for expr in rule.exprs:
+                if isinstance(expr, ruleParser.plugin_expr):
+                    # every match of a top level plugin name is a separate conflicting plugin
+                    found += len(self._expand_filename(expr.name))
+                elif self._truth(expr):
+                    found += 1
+                if found > 1:
+                    return True
+            return False
+        if rule.kind == "NOTE":
+            return any(self._truth(expr) for expr in rule.exprs)
+        if rule.kind == "PATCH":
+            return self._truth(rule.exprs[0]) != self._truth(rule.exprs[1])
+        # REQUIRES
+        return self._truth(rule.exprs[0]) and not self._truth(rule.exprs[1])
+
+    def _evaluate_single(self, expr, prune=False):
+        """Evaluate an expression that must produce one result.  Multiple matching plugins are treated as [ANY ...]"""
+        results = self._evaluate_expression(expr, prune)
+        if len(results) == 1:
+            return results[0]
+        return self._combine("ANY", [r[0] for r in results], [r[1] for r in results], prune)
+
+    #Remove the missing plugins from the 'ANY' expression
+    def _prune_any(self,item):
+        #Don't operate on simple strings
+        if isinstance(item,list) == False:
+            return item
+        #Recursive search to make sure we get any nested expressions
+        for i in range(0,len(item)):
+            item[i] = self._prune_any(item[i])
+        #Prune all the missing plugins
+        if item[0] == 'ANY':
+            return ['ANY'] + _prune_missing(item[1:])
+        #A NOT of nothing but missing plugins has nothing to show, and neither does an ALL left empty by that
+        if item[0] == 'NOT' and all(_missing_any(e) for e in item[1:]):
+            return []
+        if item[0] == 'ALL':
+            item = [x for x in item if x != []]
+            if len(item) < 3:
+                return item[1] if len(item) == 2 else []
+        return item
+
+    def _evaluate_statement(self, rule):
+        parse_logger.debug("evaluate_statement(%s, %s)" % (rule.kind, self._where(rule.line_num)))
+        if not self._fires(rule):
+            return
+        if rule.kind == "CONFLICT":  # takes any number of exprs
+            exprs = []
+            for expr in rule.exprs:
+                exprs += [self._prune_any(e) for (bool, e) in self._evaluate_expression(expr) if bool]
+            if len(exprs) > 1:
+                self._add_message(rule, [e for e in exprs if e != []])
+        elif rule.kind == "NOTE":    # takes any number of exprs
+            exprs = []
+            for expr in rule.exprs:
+                exprs += [e for (bool, e) in self._evaluate_expression(expr, prune=True) if bool]
+            if len(exprs) > 0:
+                self._add_message(rule, [e for e in exprs if e != []])
+        elif rule.kind == "PATCH":   # takes 2 exprs
+            (bool1, expr1) = self._evaluate_single(rule.exprs[0])
+            (bool2, expr2) = self._evaluate_single(rule.exprs[1])
+            if bool1 != bool2:
+                self._add_message(rule, [expr1, expr2], missing_prerequisites = bool1)
+        elif rule.kind == "REQUIRES": # takes 2 exprs
+            (bool1, expr1) = self._evaluate_single(rule.exprs[0], prune=True)
+            (bool2, expr2) = self._evaluate_single(rule.exprs[1])
+            if bool1 and not bool2:
+                if expr1 == []:
+                    # pruning left nothing to say what requires it, so show everything
+                    expr1 = self._evaluate_single(rule.exprs[0])[1]
+                self._add_message(rule, [expr1, expr2])
+
+    def _add_message(self, rule, exprs, missing_prerequisites = False):
+        self.messages.append(rule_message(rule.kind, self.rule_file, rule.line_num, exprs, rule.message, missing_prerequisites))
+
+    def _relevant_rules(self, rules):
+        """
+        Use the relevance index of a rule_set to find the statement rules worth evaluating.
+
+        These are the rules that mention at least one of our plugins, and the ones that apply even without any.
+        Every other statement rule would evaluate to no message at all.
+        :return: A set of positions in rules.rules
+        """
+        relevant = set(rules.always)
+        for p in self.plugin_list:
+            relevant.update(rules.index.get(fileFinder.canonical(p), ()))
+        for (pattern, which) in rules.patterns.items():
+            if self._expand_filename(pattern) != []:
+                relevant.update(which)
+        return relevant
+
+    def prefetch_headers(self, rules):
+        """
+        Read the headers of every plugin that [DESC], [VER], or [SIZE] rules could look at, all at once.
+
+        Reading them one at a time as the rules need them means waiting on each file in turn,
+        which is slow when the data directory is on a network drive.
+        """
+        if self.datadir == None:
+            return
+        plugins = set()
+        for name in rules.header_names:
+            plugins.update(self._expand_filename(name))
+        plugins = sorted(plugins)
+        parse_logger.debug("Prefetching {0} plugin headers".format(len(plugins)))
+        headerCache.headers.prefetch([(self.datadir.find_path(p), self.datadir.stat(p)) for p in plugins])
+
+    def evaluate(self, rules, progress = None):
+        """
+        Evaluate a rule_set, adding its orderings to the graph, and its messages to the output.
+
+        Rule sets should be evaluated in order of priority (mlox_user.txt before mlox_base.txt),
+        since any ordering that would cause a cycle in the graph is discarded.
+        """
+        self.rule_file = rules.rule_file
+        # Remember how each plugin name was written, so messages show names as the user would expect
+        for name in rules.names.values():
+            self.name_converter.cname(name)
+        relevant = self._relevant_rules(rules)
+        self.prefetch_headers(rules)
+        parse_logger.debug("{0} of {1} rules are relevant".format(len(relevant), len(rules.rules)))
+        n_rules = len(rules.rules)
+        for (i, rule) in enumerate(rules.rules):
+            #Update the GUI progress bar
+            if progress != None and i % 100 == 0:
+                progress.Update(int(100*i/n_rules), "Loading: {0}".format(self.rule_file))
+            if isinstance(rule, ruleParser.ordering_rule):
+                self._evaluate_ordering(rule)
+            elif i in relevant:
+                self._evaluate_statement(rule)
+
+    def get_messages(self):
+        """
+        Get any messages the evaluator may have generated, as text (see rule_message.text).
+
+        This includes everything from mild notes, to major warnings.
+        """
+        return "".join(m.text() for m in self.messages)
@@ -1,11 +1,12 @@
 
 import os
 import re
-import io
 import logging
-from pprint import PrettyPrinter
-from . import pluggraph
 from . import fileFinder
+from . import ruleCache
+from . import headerCache
+from . import ruleEvaluator
+from . import profiler
 
 # comments start with ';'
 re_comment = re.compile(r'(?:^|\s);.*$')
@@ -40,12 +41,6 @@ re_filename_version = re.compile(r'\D%s\D*\.es[mp]' % plugin_version, re.IGNOREC
 # for grabbing version numbers from plugin header description fields
 re_header_version = re.compile(r'\b(?:version\b\D+|v(?:er)?\.?\s*)%s' % plugin_version, re.IGNORECASE)
 
-# for cleaning up pretty printer
-re_notstr = re.compile(r"\s*'NOT',")
-re_anystr = re.compile(r"\s*'ANY',")
-re_allstr = re.compile(r"\s*'ALL',")
-re_indented = re.compile(r'^', re.MULTILINE)
-
 # set of characters that are not allowed to occur in plugin names. (we allow '*' and '?' for filename matching).
 # Not actually used anywhere
 re_plugin_illegal = re.compile(r'[\"\\/=+<>:;|\^]')
@@ -53,8 +48,6 @@ re_plugin_illegal = re.compile(r'[\"\\/=+<>:;|\^]')
 
 version_operators = {'=': True, '<': True, '>': True}
 
-tes3_min_plugin_size = 362
-
 parse_logger = logging.getLogger('mlox.parser')
 
 
@@ -70,16 +63,39 @@ def get_version(plugin,data_dir = None):
     if isinstance(data_dir,str):
         data_dir = fileFinder.caseless_dirlist(data_dir)
     if isinstance(data_dir,fileFinder.caseless_dirlist) != False:
-        desc = plugin_description(data_dir.find_path(plugin))
-        if desc != None:
-            match = re_header_version.search(desc)
-            desc_ver = match.group(1) if match else None
+        info = plugin_header(data_dir.find_path(plugin), data_dir.stat(plugin))
+        if info != None:
+            desc_ver = info.formatted_version
     if file_ver != None:
         file_ver = format_version(file_ver)
-    if desc_ver != None:
-        desc_ver = format_version(desc_ver)
     return (file_ver, desc_ver)
 
+def get_versions(plugins, data_dir = None):
+    """
+    Get the version information from many plugins at once (see get_version)
+
+    The plugin headers are all read together (see headerCache.header_cache.prefetch), which is much faster than
+    calling get_version for each plugin.
+
+    :param data_dir: The directory holding the plugins.  Ideally a fileFinder.plugin_snapshot, so it is only scanned once.
+    :return: A list of (file version, description version) tuples, in the same order as plugins.
+    """
+    file_vers = []
+    for plugin in plugins:
+        match = re_filename_version.search(plugin)
+        file_vers.append(format_version(match.group(1)) if match else None)
+    if isinstance(data_dir,str):
+        data_dir = fileFinder.plugin_snapshot(data_dir)
+    if not isinstance(data_dir,fileFinder.caseless_dirlist):
+        return [(file_ver, None) for file_ver in file_vers]
+    paths = [(data_dir.find_path(plugin), data_dir.stat(plugin)) for plugin in plugins]
+    desc_vers = []
+    for ((path, stat), info) in zip(paths, headerCache.headers.prefetch(paths)):
+        if info == None:
+            parse_logger.warning("Unable to open plugin file:  {0}".format(path))
+        desc_vers.append(None if info == None else info.formatted_version)
+    return list(zip(file_vers, desc_vers))
+
 def format_version(ver):
     """convert something we think is a version number into a canonical form that can be used for comparison"""
     v = re_ver_delim.split(ver, 3)
@@ -95,59 +111,195 @@ def format_version(ver):
     return("%05d.%05d.%05d.%s" % (v[0], v[1], v[2], alpha))
 
 
-def plugin_description(plugin):
-    """Read the description field of a TES3/TES4 plugin file header"""
-    try:
-        inp = open(plugin, 'rb')
-    except IOError:
+def plugin_header(plugin, stat = None):
+    """
+    Get what is known about a plugin file (see headerCache.plugin_info)
+
+    :param stat: The result of os.stat(plugin), if the caller already has it
+    :return: A plugin_info, or None if the plugin can not be read
+    """
+    info = headerCache.headers.get(plugin, stat)
+    if info == None:
         parse_logger.warning("Unable to open plugin file:  {0}".format(plugin))
-        return ""
-    block = inp.read(4096)
-    inp.close()
-    if block[0:4] == b"TES3":    # Morrowind
-        if len(block) < tes3_min_plugin_size:
-            parse_logger.warning("Cannot read plugin description(%s): file too short, returning NULL string", plugin)
-            return ""
-        desc = block[64:block.find(b"\x00", 64)]
-        return str(desc)
-    elif block[0:4] == b"TES4":  # Oblivion
-        # This is very cheesy.
-        pos = block.find(b"SNAM", 0)
-        if pos == -1:
-            return ""
-        desc_start = block.find(b"\x00", pos) + 1
-        if desc_start == -1:
-            return ""
-        desc_end = block.find(b"\x00", desc_start)
-        if desc_end == -1:
-            return ""
-        desc = block[desc_start:desc_end]
-        return str(desc)
+    return info
+
+
+def plugin_description(plugin, stat = None):
+    """Read the description field of a TES3/TES4 plugin file header"""
+    info = plugin_header(plugin, stat)
+    return "" if info == None else info.description
+
+
+class plugin_expr:
+    """A plugin name in a rule.  The name may contain filename metacharacters ('*', '?', and '<VER>')"""
+    def __init__(self, name):
+        self.name = name    # the canonical (caseless) name
+
+class desc_expr:
+    """[DESC /pattern/ plugin]: Match a regular expression against the description in a plugin's header"""
+    def __init__(self, bang, pat, plugin_name):
+        self.bang = bang    # "!" inverts the meaning of the match
+        self.pat = pat
+        self.plugin_name = plugin_name
+
+class ver_expr:
+    """[VER op version plugin]: Compare a plugin's version against a given version"""
+    def __init__(self, op, orig_ver, plugin_name):
+        self.op = op
+        self.orig_ver = orig_ver
+        self.ver = format_version(orig_ver)
+        self.plugin_name = plugin_name
+
+class size_expr:
+    """[SIZE size plugin]: Check the file size of a plugin"""
+    def __init__(self, bang, wanted_size, plugin_name):
+        self.bang = bang    # "!" means "is not this size"
+        self.wanted_size = wanted_size
+        self.plugin_name = plugin_name
+
+class bool_expr:
+    """[ALL ...], [ANY ...], or [NOT ...]: A boolean function of other expressions"""
+    def __init__(self, fun, args):
+        self.fun = fun
+        self.args = args
+
+
+class ordering_rule:
+    """An [Order], [NearStart], or [NearEnd] rule"""
+    def __init__(self, kind, line_num, entries):
+        self.kind = kind
+        self.line_num = line_num
+        self.entries = entries  # a list of (line number, plugin_expr) tuples
+
+class statement_rule:
+    """A [Conflict], [Note], [Patch], or [Requires] rule"""
+    def __init__(self, kind, line_num, message, exprs):
+        self.kind = kind
+        self.line_num = line_num
+        self.message = message  # the lines of the rule's message
+        self.exprs = exprs
+
+
+def referenced_plugins(expr, names):
+    """Add the canonical names of all plugins an expression refers to, to the set names"""
+    if isinstance(expr, plugin_expr):
+        names.add(expr.name)
+    elif isinstance(expr, bool_expr):
+        for arg in expr.args:
+            referenced_plugins(arg, names)
     else:
-        return ""
+        names.add(fileFinder.canonical(expr.plugin_name))
+
+
+def header_plugins(expr, names):
+    """Add the plugin names used by [DESC], [VER], and [SIZE] in an expression, to the set names"""
+    if isinstance(expr, bool_expr):
+        for arg in expr.args:
+            header_plugins(arg, names)
+    elif not isinstance(expr, plugin_expr):
+        names.add(expr.plugin_name)
+
+
+def missing_value(expr):
+    """The value of an expression, when none of the plugins it refers to are present"""
+    if isinstance(expr, bool_expr):
+        vals = [missing_value(arg) for arg in expr.args]
+        if expr.fun == "ALL":
+            return all(vals)
+        if expr.fun == "ANY":
+            return any(vals)
+        return not(all(vals))
+    # a missing plugin, and [DESC], [VER], and [SIZE] of one, are all False
+    return False
+
+
+def fires_without_plugins(rule):
+    """Return True if a statement rule would produce a message, when none of the plugins it refers to are present"""
+    vals = [missing_value(expr) for expr in rule.exprs]
+    if rule.kind == "CONFLICT":
+        return vals.count(True) > 1
+    if rule.kind == "NOTE":
+        return vals.count(True) > 0
+    if rule.kind == "PATCH":
+        return vals[0] != vals[1]
+    # REQUIRES
+    return vals[0] and not vals[1]
+
+
+class rule_set:
+    """
+    The parsed contents of a rules file.
 
+    Nothing in here depends on the list of plugins, or the data directory.
+    So a rule_set can be evaluated against any number of load orders (see ruleEvaluator).
+    """
+    def __init__(self, rule_file):
+        self.rule_file = rule_file
+        self.version = None
+        self.n_rules = 0
+        self.rules = []
+        # Every plugin name in the rules, as it was first written (keyed by canonical name)
+        self.names = {}
+        # Problems found while parsing, as (log level, line number, message) tuples
+        self.problems = []
+        # The relevance index (see build_index) for skipping [Conflict], [Note], [Patch], and [Requires] rules
+        # that can not say anything about a given load order.
+        # index maps a plugin name to the positions (in rules) of the statement rules that mention it,
+        # patterns does the same for plugin names containing metacharacters,
+        # and always holds the positions of statement rules that apply even when none of their plugins are present.
+        self.index = {}
+        self.patterns = {}
+        self.always = []
+        # The plugin names (possibly with metacharacters) whose headers the rules look at
+        self.header_names = set()
+
+    def build_index(self):
+        """
+        Build the relevance index for the statement rules.
 
-class rule_parser:
-    """A simple recursive descent rule parser, for evaluating rule statements containing nested boolean expressions."""
-    version = "Unknown"
+        Ordering rules are not indexed, since they can connect plugins a user does have through ones they don't.
+        """
+        self.index = {}
+        self.patterns = {}
+        self.always = []
+        self.header_names = set()
+        for (i, rule) in enumerate(self.rules):
+            if not isinstance(rule, statement_rule):
+                continue
+            for expr in rule.exprs:
+                header_plugins(expr, self.header_names)
+            if fires_without_plugins(rule):
+                self.always.append(i)
+                continue
+            names = set()
+            for expr in rule.exprs:
+                referenced_plugins(expr, names)
+            for name in names:
+                if re_plugin_meta.search(name) != None or re_plugin_metaver.search(name) != None:
+                    self.patterns.setdefault(name, []).append(i)
+                else:
+                    self.index.setdefault(name, []).append(i)
 
-    def __init__(self, plugin_list, datadir, name_converter):
-        self.plugin_list = plugin_list
-        if datadir:
-            self.datadir = fileFinder.caseless_dirlist(datadir)
-        else:
-            self.datadir = None
-        self.name_converter = name_converter
-        self.graph = pluggraph.pluggraph()
+    def report_problems(self):
+        """Log any problems found while parsing"""
+        for (level, line_num, what) in self.problems:
+            parse_logger.log(level, "%s:%d: %s" % (self.rule_file, line_num, what))
+
+
+class rule_compiler:
+    """A simple recursive descent rule parser, turning a rules file into a rule_set."""
+
+    def __init__(self, rule_file):
+        self.rule_file = rule_file
+        self.rules = rule_set(rule_file)
         self.line_num = 0
-        self.rule_file = None
-        self.bytesread = 0
         self.input_handle = None
         self.buffer = ""        # the parsing buffer
         self.message = []       # the comment for the current rule
         self.curr_rule = ""     # name of the current rule we are parsing
-        self.parse_dbg_indent = ""
-        self.out_stream = io.StringIO()
+        # One plugin_expr per plugin name, shared by every rule using it.  This keeps the cached rules small,
+        # since the same few thousand plugins are mentioned over and over.
+        self.plugins = {}
 
     def _readline(self):
         """
@@ -161,7 +313,6 @@ class rule_parser:
         try:
             while True:
                 line = next(self.input_handle)
-                self.bytesread += len(line)
                 self.line_num += 1
                 line = re_comment.sub('', line) # remove comments
                 line = line.rstrip() # strip whitespace from end of line, include CRLF
@@ -172,20 +323,18 @@ class rule_parser:
         except StopIteration:
             parse_logger.debug("EOF")
             self.buffer = ""
-            self.input_handle.close()
             self.input_handle = None
             return(False)
 
-    def _where(self):
-        """Convenience function letting the caller know at what point in the rule file something happened."""
-        return("%s:%d" % (self.rule_file, self.line_num))
+    def _problem(self, level, what, line_num = None):
+        """Remember a problem with the rules, so it can be reported whenever they are read."""
+        self.rules.problems.append((level, self.line_num if line_num == None else line_num, what))
 
     def _parse_error(self, what):
-        """print a message about current parsing error, and blow away the
+        """record a message about current parsing error, and blow away the
         current parse buffer so next parse starts on next input line."""
-        parse_logger.error("%s: Parse Error(%s), %s [Buffer=%s]" % (self._where(), self.curr_rule, what, self.buffer))
+        self._problem(logging.ERROR, "Parse Error(%s), %s [Buffer=%s]" % (self.curr_rule, what, self.buffer))
         self.buffer = ""
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
 
     def _parse_message_block(self):
         while self._readline():
@@ -194,84 +343,41 @@ class rule_parser:
             else:
                 return
 
-    def _expand_filename(self, plugin):
-        parse_logger.debug("expand_filename, plugin=%s" % plugin)
-        pat = "^%s$" % re_escape_meta.sub(r'\\\1', plugin)
-        # if the plugin name contains metacharacters, do filename expansion
-        subbed = False
-        if re_plugin_meta.search(plugin) != None:
-            parse_logger.debug("expand_filename name has META: %s" % pat)
-            pat = re_plugin_meta.sub(r'.\1', pat)
-            subbed = True
-        if re_plugin_metaver.search(plugin) != None:
-            parse_logger.debug("expand_filename name has METAVER: %s" % pat)
-            pat = re_plugin_metaver.sub(plugin_version, pat)
-            subbed = True
-        if not subbed:        # no expansions made
-            return([plugin] if plugin.lower() in self.plugin_list else [])
-        parse_logger.debug("expand_filename new RE pat: %s" % pat)
-        matches = []
-        re_namepat = re.compile(pat, re.IGNORECASE)
-        for p in self.plugin_list:
-            if re_namepat.match(p):
-                matches.append(p)
-                parse_logger.debug("expand_filename: %s expands to: %s" % (plugin, p))
-        return(matches)
-
     def _parse_plugin_name(self):
-        self.parse_dbg_indent += "  "
         buff = self.buffer.strip()
         parse_logger.debug("parse_plugin_name buff=%s" % buff)
         plugin_match = re_plugin.match(buff)
         if plugin_match:
-            plugin_name = self.name_converter.cname(plugin_match.group(1))
-            parse_logger.debug("parse_plugin_name name=%s" % plugin_name)
+            plugin_name = plugin_match.group(1)
+            name = fileFinder.canonical(plugin_name)
+            self.rules.names.setdefault(name, plugin_name)
             pos = plugin_match.span(2)[1]
             self.buffer = buff[pos:].lstrip()
-            matches = self._expand_filename(plugin_name)
-            if matches != []:
-                plugin_name = matches.pop(0)
-                parse_logger.debug("parse_plugin_name new name=%s" % plugin_name)
-                if len(matches) > 0:
-                    self.buffer = " ".join(matches) + " " + self.buffer
-                return(True, plugin_name)
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(False, plugin_name)
-        else:
-            self._parse_error("expected a plugin name")
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(None, None)
+            if name not in self.plugins:
+                self.plugins[name] = plugin_expr(name)
+            return(self.plugins[name])
+        self._parse_error("expected a plugin name")
+        return(None)
 
     def _parse_ordering(self, rule):
-        self.parse_dbg_indent += "  "
-        prev = None
-        n_order = 0
+        line_num = self.line_num
+        entries = []
         while self._readline():
             if re_rule.match(self.buffer):
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+                self.rules.rules.append(ordering_rule(rule, line_num, entries))
                 return
-            p = self._parse_plugin_name()[1]
+            p = self._parse_plugin_name()
             if p == None:
                 continue
-            n_order += 1
-            if rule == "ORDER":
-                if prev != None:
-                    self.graph.add_edge(self._where(), prev, p)
-                prev = p
-            elif rule == "NEARSTART":
-                self.graph.nearstart.append(p)
-                self.graph.nodes.setdefault(p, [])
-            elif rule == "NEAREND":
-                self.graph.nearend.append(p)
-                self.graph.nodes.setdefault(p, [])
+            entries.append((self.line_num, p))
         if rule == "ORDER":
-            if n_order == 0:
-                parse_logger.warning("%s: ORDER rule has no entries" % (self._where()))
-            elif n_order == 1:
-                parse_logger.warning("%s: ORDER rule skipped because it only has one entry: %s" % (self._where(), self.name_converter.truename(prev)))
+            if len(entries) == 0:
+                self._problem(logging.WARNING, "ORDER rule has no entries")
+            elif len(entries) == 1:
+                self._problem(logging.WARNING, "ORDER rule skipped because it only has one entry: %s" % self.rules.names[entries[0][1].name])
+        self.rules.rules.append(ordering_rule(rule, line_num, entries))
 
     def _parse_ver(self):
-        self.parse_dbg_indent += "  "
         match = re_ver_fun.match(self.buffer)
         if match:
             p = match.span(0)[1]
@@ -280,259 +386,75 @@ class rule_parser:
             op = match.group(1)
             if op not in version_operators:
                 self._parse_error("Invalid [VER] operator")
-                return(None, None)
-            orig_ver = match.group(2)
-            ver = format_version(orig_ver)
-            plugin_name = match.group(3)
-            expanded = self._expand_filename(plugin_name)
-            expr = "[VER %s %s %s]" % (op, orig_ver, plugin_name)
-            parse_logger.debug("parse_ver, expr=%s ver=%s" % (expr, ver))
-            if len(expanded) == 1:
-                expr = "[VER %s %s %s]" % (op, orig_ver, expanded[0])
-            elif expanded == []:
-                parse_logger.debug("parse_ver [VER] \"%s\" not active" % plugin_name)
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(False, expr) # file does not exist
-            if self.datadir == None:
-                # this case is reached when doing fromfile checks
-                # and we do not have the actual plugin to check, so
-                # we assume that the plugin matches the given version
-                if op == '=':
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(True, expr)
-                else:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(False, expr)
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                desc = plugin_description(self.datadir.find_path(plugin))
-                match = re_header_version.search(desc)
-                if match:
-                    p_ver_orig = match.group(1)
-                    p_ver = format_version(p_ver_orig)
-                    parse_logger.debug("parse_ver (header) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
-                else:
-                    match = re_filename_version.search(plugin)
-                    if match:
-                        p_ver_orig = match.group(1)
-                        p_ver = format_version(p_ver_orig)
-                        parse_logger.debug("parse_ver (filename) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
-                    else:
-                        parse_logger.debug("parse_ver no version for %s" % plugin_t)
-                        return(False, expr)
-                parse_logger.debug("parse_ver compare  p_ver=%s %s ver=%s" % (p_ver, op, ver))
-                result = True
-                if op == '=':
-                    result = (p_ver == ver)
-                elif op == '<':
-                    result = (p_ver < ver)
-                elif op == '>':
-                    result = (p_ver > ver)
-                if result:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(True, "[VER %s %s %s]" % (op, orig_ver, plugin))
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(False, expr)
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+                return(None)
+            return(ver_expr(op, match.group(2), match.group(3)))
         self._parse_error("Invalid [VER] function")
-        return(None, None)
+        return(None)
 
     def _parse_desc(self):
         """match patterns against the description string in the plugin header."""
-        self.parse_dbg_indent += "  "
         match = re_desc_fun.match(self.buffer)
         if match:
             p = match.span(0)[1]
             self.buffer = self.buffer[p:]
             parse_logger.debug("parse_desc new buffer = %s" % self.buffer)
-            bang = match.group(1) # means to invert the meaning of the match
-            pat = match.group(2)
-            plugin_name = match.group(3)
-            expr = "[DESC %s/%s/ %s]" % (bang, pat, plugin_name)
-            parse_logger.debug("parse_desc, expr=%s" % expr)
-            expanded = self._expand_filename(plugin_name)
-            if len(expanded) == 1:
-                expr = "[DESC %s/%s/ %s]" % (bang, pat, expanded[0])
-            elif expanded == []:
-                parse_logger.debug("parse_desc [DESC] \"%s\" not active" % plugin_name)
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(False, expr) # file does not exist
-            if self.datadir == None:
-                # this case is reached when doing fromfile checks,
-                # which do not have access to the actual plugin, so we
-                # always assume the test is merely for file existence,
-                # to err on the side of caution
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(True, expr)
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                re_pat = re.compile(pat)
-                desc = plugin_description(self.datadir.find_path(plugin))
-                bool = (re_pat.search(desc) != None)
-                if bang == "!": bool = not bool
-                parse_logger.debug("parse_desc [DESC] returning: (%s, %s)" % (bool, expr))
-                if bool:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(True, "[DESC %s/%s/ %s]" % (bang, pat, plugin_t))
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(False, expr)
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            return(desc_expr(match.group(1), match.group(2), match.group(3)))
         self._parse_error("Invalid [DESC] function")
-        return(None, None)
+        return(None)
 
     def _parse_size(self):
         """check the given size of the plugin."""
-        self.parse_dbg_indent += "  "
         match = re_size_fun.match(self.buffer)
         if match:
             p = match.span(0)[1]
             self.buffer = self.buffer[p:]
             parse_logger.debug("parse_size new buffer = %s" % self.buffer)
-            bang = match.group(1) # means "is not this size"
-            wanted_size = int(match.group(2))
-            plugin_name = match.group(3)
-            expr = "[SIZE %s%d %s]" % (bang, wanted_size, plugin_name)
-            parse_logger.debug("parse_size, expr=%s" % expr)
-            expanded = self._expand_filename(plugin_name)
-            if len(expanded) == 1:
-                expr = "[SIZE %s%d %s]" % (bang, wanted_size, expanded[0])
-            elif expanded == []:
-                parse_logger.debug("parse_size [SIZE] \"%s\" not active" % match.group(3))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(False, expr) # file does not exist
-            if self.datadir == None:
-                # this case is reached when doing fromfile checks,
-                # which do not have access to the actual plugin, so we
-                # always assume the test is merely for file existence,
-                # to err on the side of caution
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(True, expr)
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                actual_size = os.path.getsize(self.datadir.find_path(plugin))
-                bool = (actual_size == wanted_size)
-                if bang == "!": bool = not bool
-                parse_logger.debug("parse_size [SIZE] returning: (%s, %s)" % (bool, expr))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                if bool:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(True, "[SIZE %s%d %s]" % (bang, wanted_size, plugin_t))
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(False, expr)
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            return(size_expr(match.group(1), int(match.group(2)), match.group(3)))
         self._parse_error("Invalid [SIZE] function")
-        return(None, None)
+        return(None)
 
-    def _parse_expression(self, prune=False):
-        self.parse_dbg_indent += "  "
+    def _parse_expression(self):
         self.buffer = self.buffer.strip()
         if self.buffer == "":
             if self._readline():
                 if re_rule.match(self.buffer):
                     parse_logger.debug("parse_expression new line started new rule, returning None")
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return(None, None)
+                    return(None)
                 self.buffer = self.buffer.strip()
             else:
                 parse_logger.debug("parse_expression EOF, returning None")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(None, None)
+                return(None)
         parse_logger.debug("parse_expression, start buffer: \"%s\"" % self.buffer)
         match = re_fun.match(self.buffer)
         if match:
             fun = match.group(1).upper()
             if fun == "DESC":
-                parse_logger.debug("parse_expression calling parse_desc()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
                 return(self._parse_desc())
             elif fun == "VER":
-                parse_logger.debug("parse_expression calling parse_ver()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
                 return(self._parse_ver())
             elif fun == "SIZE":
-                parse_logger.debug("parse_expression calling parse_size()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
                 return(self._parse_size())
             # otherwise it's a boolean function ...
-            parse_logger.debug("parse_expression parsing expression: \"%s\"" % self.buffer)
             p = match.span(0)[1]
             self.buffer = self.buffer[p:]
-            parse_logger.debug("fun = %s" % fun)
-            vals = []
-            exprs = []
+            args = []
             bool_end = re_end_fun.match(self.buffer)
-            parse_logger.debug("self.buffer 1 =\"%s\"" % self.buffer)
             while not bool_end:
-                (bool, expr) = self._parse_expression(prune)
-                if bool == None:
+                expr = self._parse_expression()
+                if expr == None:
                     self._parse_error("[%s] Invalid boolean arguments" % fun)
-                    return(None, None)
-                exprs.append(expr)
-                vals.append(bool)
-                parse_logger.debug("self.buffer 2 =\"%s\"" % self.buffer)
+                    return(None)
+                args.append(expr)
                 bool_end = re_end_fun.match(self.buffer)
             pos = bool_end.span(0)[1]
             self.buffer = self.buffer[pos:]
-            parse_logger.debug("self.buffer 3 =\"%s\"" % self.buffer)
-            if fun == "ALL":
-                # prune out uninteresting expressions from ANY results
-                exprs = [e for e in exprs if not(isinstance(e, list) and e == [])]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(all(vals), exprs[0] if len(exprs) == 1 else ["ALL"] + exprs)
-            if fun == "ANY":
-                # prune out uninteresting expressions from ANY results
-                if prune:
-                    exprs = [e for e in exprs if not(isinstance(e, str) and e[0:8] == "MISSING(")]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(any(vals), exprs[0] if len(exprs) == 1 else ["ANY"] + exprs)
-            if fun == "NOT":
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return(not(all(vals)), ["NOT"] + exprs)
-            else:
-                # should not be reached due to match on re_fun
-                self._parse_error("Expected Boolean function (ALL, ANY, NOT)")
-                return(None, None)
-            parse_logger.debug("parse_expression NOTREACHED")
-        else:
-            if re_fun.match(self.buffer):
-                self._parse_error("Invalid function expression")
-                return(None, None)
-            parse_logger.debug("parse_expression parsing plugin: \"%s\"" % self.buffer)
-            (exists, p) = self._parse_plugin_name()
-            if exists != None and p != None:
-                p = self.name_converter.truename(p) if exists else ("MISSING(%s)" % self.name_converter.truename(p))
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return(exists, p)
-        parse_logger.debug("parse_expression NOTREACHED(2)")
-
-    def _pprint(self, expr, prefix):
-        """pretty printer for parsed expressions"""
-        formatted = PrettyPrinter(indent=2).pformat(expr)
-        formatted = re_notstr.sub("NOT", formatted)
-        formatted = re_anystr.sub("ANY", formatted)
-        formatted = re_allstr.sub("ALL", formatted)
-        return(re_indented.sub(prefix, formatted))
-
-    #Remove the missing plugins from the 'ANY' expression
-    def _prune_any(self,item):
-        #Don't operate on simple strings
-        if isinstance(item,list) == False:
-            return item
-        #Recursive search to make sure we get any nested expressions
-        for i in range(0,len(item)):
-            item[i] = self._prune_any(item[i])
-        #Prune all the missing plugins
-        if item[0] == 'ANY':
-            return filter(lambda x: x.find('MISSING(') == -1, item)
-        return item
+            return(bool_expr(fun, args))
+        parse_logger.debug("parse_expression parsing plugin: \"%s\"" % self.buffer)
+        return(self._parse_plugin_name())
 
     def _parse_statement(self, rule, msg, expr):
-        self.parse_dbg_indent += "  "
         parse_logger.debug("parse_statement(%s, %s, %s)" % (rule, msg, expr))
+        line_num = self.line_num
         expr = expr.strip()
         if msg == "":
             if expr == "":
@@ -542,138 +464,127 @@ class rule_parser:
             self.message = [msg]
         if expr == "":
             if not self._readline():
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
                 return
         else:
             self.buffer = expr
-        msg = "" if self.message == [] else " |" + "\n |".join(self.message) # no ending LF
-        if rule == "CONFLICT":  # takes any number of exprs
-            exprs = []
-            parse_logger.debug("before conflict parse_expr() expr=%s line=%s" % (expr, self.buffer))
-            (bool, expr) = self._parse_expression()
-            parse_logger.debug("conflict parse_expr()1 bool=%s bool=%s" % (bool, expr))
-            while bool != None:
-                if bool:
-                    exprs.append(expr)
-                (bool, expr) = self._parse_expression()
-                parse_logger.debug("conflict parse_expr()N bool=%s bool=%s" % ("True" if bool else "False", expr))
-            if len(exprs) > 1:
-                print("[CONFLICT]", file=self.out_stream)
-                for e in exprs:
-                    print(self._pprint(self._prune_any(e), " > "), file=self.out_stream)
-                if msg != "":
-                    print(msg, file=self.out_stream)
-        elif rule == "NOTE":    # takes any number of exprs
-            parse_logger.debug("function NOTE: %s" % msg)
-            exprs = []
-            (bool, expr) = self._parse_expression(prune=True)
-            while bool != None:
-                if bool:
-                    exprs.append(expr)
-                (bool, expr) = self._parse_expression(prune=True)
-            if len(exprs) > 0:
-                print("[NOTE]", file=self.out_stream)
-                for e in exprs:
-                    print(self._pprint(e, " > "), file=self.out_stream)
-                if msg != "":
-                    print(msg, file=self.out_stream)
-        elif rule == "PATCH":   # takes 2 exprs
-            (bool1, expr1) = self._parse_expression()
-            if bool1 == None:
-                parse_logger.warning("%s: PATCH rule invalid first expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return
-            (bool2, expr2) = self._parse_expression()
-            if bool2 == None:
-                parse_logger.warning("%s: PATCH rule invalid second expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return
-            if bool1 and not bool2:
-                # case where the patch is present but the thing to be patched is missing
-                print("[PATCH]\n%s is missing some pre-requisites:\n%s\n" % (self._pprint(expr1, " !!"), self._pprint(expr2, " ")), file=self.out_stream)
-                if msg != "":
-                    print(msg, file=self.out_stream)
-            if bool2 and not bool1:
-                # case where the patch is missing for the thing to be patched
-                print("[PATCH]\n%s for:\n%s\n" % (self._pprint(expr1, " !!"), self._pprint(expr2, " ")), file=self.out_stream)
-                if msg != "":
-                    print(msg, file=self.out_stream)
-        elif rule == "REQUIRES": # takes 2 exprs
-            (bool1, expr1) = self._parse_expression(prune=True)
-            if bool1 == None:
-                parse_logger.warning("%s: REQUIRES rule invalid first expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return
-            (bool2, expr2) = self._parse_expression()
-            if bool2 == None:
-                parse_logger.warning("%s: REQUIRES rule invalid second expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return
-            if bool1 and not bool2:
-                expr2_str = self._pprint(expr2, " > ")
-                print("[REQUIRES]\n%s Requires:\n%s\n" % (self._pprint(expr1, " !!!"), expr2_str), file=self.out_stream)
-                if msg != "":
-                    print(msg, file=self.out_stream)
-                match = re_filename_version.search(expr2_str)
-                if match:
-                    print(" | [Note that you may see this message if you have an older version of one of the pre-requisites. In that case, it is suggested that you upgrade to the newer version].", file=self.out_stream)
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        parse_logger.debug("parse_statement RETURNING")
+        exprs = []
+        if rule in ("CONFLICT", "NOTE"):  # takes any number of exprs
+            expr = self._parse_expression()
+            while expr != None:
+                exprs.append(expr)
+                expr = self._parse_expression()
+        elif rule in ("PATCH", "REQUIRES"):   # takes 2 exprs
+            for which in ("first", "second"):
+                expr = self._parse_expression()
+                if expr == None:
+                    self._problem(logging.WARNING, "%s rule invalid %s expression" % (rule, which))
+                    return
+                exprs.append(expr)
+        self.rules.rules.append(statement_rule(rule, line_num, self.message, exprs))
+
+    def compile(self):
+        """
+        Parse the rules file.
+
+        :return: a rule_set
+        :raises IOError: If the rules file can not be read
+        """
+        parse_logger.debug("Parsing rules from: \"{0}\"".format(self.rule_file))
+        with open(self.rule_file, 'r') as self.input_handle:
+            while True:
+                if self.buffer == "":
+                    if not self._readline():
+                        break
+                self.curr_rule = ""
+                new_rule = re_rule.match(self.buffer)
+                if new_rule:        # start a new rule
+                    self.rules.n_rules += 1
+                    self.curr_rule = new_rule.group(1).upper()
+                    self.message = []
+                    if self.curr_rule == "VERSION":
+                        self.buffer = ""
+                        self.rules.version = new_rule.group(2)
+                    elif self.curr_rule in ("ORDER", "NEAREND", "NEARSTART"):
+                        self._parse_ordering(self.curr_rule)
+                    elif self.curr_rule in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                        self._parse_statement(self.curr_rule, new_rule.group(2), new_rule.group(3))
+                    else:
+                        # we should never reach here, since re_rule only matches known rules
+                        self._parse_error("read_rules failed sanity check, unknown rule")
+                else:
+                    self._parse_error("expected start of rule")
+        self.rules.build_index()
+        return self.rules
+
+
+def compile_rule_file(rule_file):
+    """Parse a rules file into a rule_set"""
+    return rule_compiler(rule_file).compile()
+
+
+def read_rule_file(rule_file):
+    """
+    Get the rule_set for a rules file, from the cache if possible.
+
+    Any problems found in the rules are logged every time the file is read.
+    :return: a rule_set
+    :raises IOError: If the rules file can not be read
+    """
+    parse_logger.debug("Reading rules from: \"{0}\"".format(rule_file))
+    with profiler.stage("read rules: {0}".format(os.path.basename(rule_file))):
+        rules = ruleCache.load(rule_file, compile_rule_file)
+    rules.rule_file = rule_file
+    rules.report_problems()
+    if rules.version != None:
+        parse_logger.info("\"{0}\" Version {1}".format(os.path.basename(rule_file), rules.version))
+    return rules
+
+
+class rule_parser:
+    """
+    Read rules files, and evaluate them against a list of plugins.
+
+    Parsing is done by rule_compiler, and evaluation by ruleEvaluator.rule_evaluator.
+    """
+    version = "Unknown"
+
+    def __init__(self, plugin_list, datadir, name_converter):
+        self.evaluator = ruleEvaluator.rule_evaluator(plugin_list, datadir, name_converter)
 
     def read_rules(self, rule_file, progress = None):
         """Read rules from rule files (e.g., mlox_user.txt or mlox_base.txt),
         add order rules to graph, and print warnings."""
-        n_rules = 0
-        self.rule_file = rule_file
-
-        parse_logger.debug("Reading rules from: \"{0}\"".format(self.rule_file))
         try:
-            self.input_handle = open(self.rule_file, 'r')
-            inputsize = os.path.getsize(self.rule_file)
-        except IOError as OSError:
-            parse_logger.error("Unable to open rules file:  {0}".format(self.rule_file))
+            rules = read_rule_file(rule_file)
+        except (IOError, OSError):
+            parse_logger.error("Unable to open rules file:  {0}".format(rule_file))
             return False
-
-        self.line_num = 0
-        while True:
-            if self.buffer == "":
-                if not self._readline():
-                    break
-            #Update the GUI progress bar
-            if progress != None and inputsize > 0:
-                pct = int(100*self.bytesread/inputsize)
-                if pct < 100:
-                    progress.Update(pct, "Loading: {0}".format(self.rule_file))
-            self.parse_dbg_indent = ""
-            self.curr_rule = ""
-            new_rule = re_rule.match(self.buffer)
-            if new_rule:        # start a new rule
-                n_rules += 1
-                self.curr_rule = new_rule.group(1).upper()
-                self.message = []
-                if self.curr_rule == "VERSION":
-                    self.buffer = ""
-                    self.version= new_rule.group(2)
-                    parse_logger.info("\"{0}\" Version {1}".format(os.path.basename(self.rule_file),self.version))
-                elif self.curr_rule in ("ORDER", "NEAREND", "NEARSTART"):
-                    self._parse_ordering(self.curr_rule)
-                elif self.curr_rule in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
-                    self._parse_statement(self.curr_rule, new_rule.group(2), new_rule.group(3))
-                else:
-                    # we should never reach here, since re_rule only matches known rules
-                    self._parse_error("read_rules failed sanity check, unknown rule")
-            else:
-                self._parse_error("expected start of rule")
-        parse_logger.info("Read {0} rules from: \"{1}\"".format(n_rules, self.rule_file))
+        except UnicodeDecodeError:
+            parse_logger.error("Bad Characters in rules file:  {0}".format(rule_file))
+            return False
+        self.add_rules(rules, progress)
+        parse_logger.info("Read {0} rules from: \"{1}\"".format(rules.n_rules, rule_file))
         return True
 
+    def add_rules(self, rules, progress = None):
+        """Add the order rules from an already read rule_set (see read_rule_file) to graph, and print warnings."""
+        if rules.version != None:
+            self.version = rules.version
+        # Evaluating the rules is what builds the graph
+        with profiler.stage("evaluate rules: {0}".format(os.path.basename(str(rules.rule_file)))):
+            self.evaluator.evaluate(rules, progress)
+
     def get_messages(self):
         """
         Get any messages the parser may have generated.
 
         This includes everything from mild notes, to major warnings.
         """
-        return self.out_stream.getvalue()
+        return self.evaluator.get_messages()
+
+    def get_rule_messages(self):
+        """Get the messages, as ruleEvaluator.rule_message objects instead of text"""
+        return self.evaluator.messages
 
     def get_graph(self):
         """
@@ -681,4 +592,4 @@ class rule_parser:
 
         NOTE:  This graph DOES NOT take the original load order into consideration.
         """
-        return self.graph
\ No newline at end of file
+        return self.evaluator.graph
@@ -0,0 +1,203 @@
+"""
+Answer requests to sort, check, and explain load orders, without starting mlox for each one.
+
+Requests are answered by one engine.Engine, so the rules are read once and kept in memory between requests
+(they are read again if the rules files change), along with everything else mlox keeps around.
+
+Requests and answers are JSON objects.  They are either posted over HTTP to localhost,
+or sent over a Unix socket as one object per line.  (Unix sockets are not available on Windows.)
+A request has an "action" ("sort", "check", or "explain"), and the load order as either "order"
+(a list of plugin names), or "text" (the contents of a load order file in any format mlox can read).
+"explain" also takes the "plugin" to explain, and optionally "base_only".
+Over HTTP, the action can instead be given as the path, as in "POST /sort".
+
+An answer always has "ok".  When it is false, "error" says what went wrong.
+The messages from the rules are given both as text ("messages"), and as objects ("structured_messages", see
+ruleEvaluator.rule_message.to_dict), so they don't have to be picked out of the text.
+"""
+import os
+import stat
+import json
+import logging
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import engine
+from . import version
+
+server_logger = logging.getLogger('mlox.server')
+
+# The longest request answered, in bytes.  Longer ones get an error, without being read into memory.
+max_request_size = 4 * 1024 * 1024
+
+# Unix sockets are not available everywhere (Windows), while HTTP is
+unix_sockets = hasattr(socketserver, "ThreadingUnixStreamServer")
+
+
+def handle_request(request, mlox_engine):
+    """
+    Answer one request.
+
+    :param request: The decoded JSON request
+    :param mlox_engine: The engine.Engine to use
+    :return: The answer, ready to be encoded as JSON
+    """
+    if not isinstance(request, dict):
+        return {"ok": False, "error": "A request must be a JSON object"}
+    action = request.get("action")
+    if action not in ("sort", "check", "explain"):
+        return {"ok": False, "error": "Unknown action: {0}".format(action)}
+    if mlox_engine.rules() == None:
+        return {"ok": False, "error": "Unable to read the rules"}
+    if isinstance(request.get("text"), str):
+        order = request["text"]
+    elif isinstance(request.get("order"), list) and all(isinstance(p, str) for p in request["order"]):
+        order = request["order"]
+    else:
+        return {"ok": False, "error": "A request needs an \"order\" list or a load order \"text\""}
+    if action == "explain":
+        if not isinstance(request.get("plugin"), str):
+            return {"ok": False, "error": "explain needs a \"plugin\""}
+        explanation = mlox_engine.explain(request["plugin"], order, base_only = bool(request.get("base_only")))
+        return {"ok": True, "explanation": explanation}
+    result = mlox_engine.update(order)
+    if result.messages is False:
+        return {"ok": False, "error": "Unable to sort the load order"}
+    structured = [m.to_dict() for m in result.loadorder.messages]
+    if action == "check":
+        return {"ok": True, "messages": result.messages, "structured_messages": structured,
+                "is_sorted": result.loadorder.is_sorted}
+    return {"ok": True, "messages": result.messages, "structured_messages": structured,
+            "is_sorted": result.loadorder.is_sorted, "new_order": result.loadorder.new_order,
+            "formatted": result.loadorder.get_new_order()}
+
+
+def _answer(data, mlox_engine, action = None):
+    """
+    Answer a request that has not been decoded yet.
+
+    :param action: The action to use, instead of the one in the request
+    """
+    try:
+        request = json.loads(data)
+    except ValueError as e:
+        return {"ok": False, "error": "Invalid JSON: {0}".format(e)}
+    if action != None and isinstance(request, dict):
+        request["action"] = action
+    try:
+        return handle_request(request, mlox_engine)
+    except Exception as e:
+        server_logger.exception("Unable to answer request")
+        return {"ok": False, "error": str(e)}
+
+
+class http_handler(BaseHTTPRequestHandler):
+    """Answer requests posted over HTTP"""
+    def _reply(self, code, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(200, {"ok": True, "version": version.version_info()})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > max_request_size:
+            self.close_connection = True
+            self._reply(413, _too_long())
+            return
+        data = self.rfile.read(length).decode('utf-8', 'replace')
+        action = self.path.strip("/")
+        answer = _answer(data, self.server.engine, action if action != "" else None)
+        self._reply(200 if answer["ok"] else 400, answer)
+
+    def log_message(self, format, *args):
+        server_logger.debug(format, *args)
+
+
+class socket_handler(socketserver.StreamRequestHandler):
+    """Answer requests sent over a Unix socket, one JSON object per line"""
+    def handle(self):
+        while True:
+            line = self.rfile.readline(max_request_size + 1)
+            if line == b"":
+                return
+            if len(line) > max_request_size and not line.endswith(b"\n"):
+                # skip the rest of the request, without keeping it
+                while line != b"" and not line.endswith(b"\n"):
+                    line = self.rfile.readline(max_request_size)
+                answer = _too_long()
+            elif line.strip() == b"":
+                continue
+            else:
+                answer = _answer(line.decode('utf-8', 'replace'), self.server.engine)
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b"\n")
+            self.wfile.flush()
+
+
+def _too_long():
+    return {"ok": False, "error": "A request can be at most {0} bytes".format(max_request_size)}
+
+
+def _is_port(address):
+    return isinstance(address, int) or address.isdigit()
+
+
+def _remove_socket(path):
+    """Remove a Unix socket left behind, without touching anything else that might be at path"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def address_error(address):
+    """
+    Check that requests can be answered on an address (see make_server).
+
+    :return: What is wrong with the address, or None if it can be used
+    """
+    if not _is_port(address) and not unix_sockets:
+        return "Unix sockets are not available on this system, give a port number instead"
+    return None
+
+
+def make_server(address):
+    """
+    Make a server for answering requests.
+
+    :param address: A port number to listen on localhost with HTTP, or the path of a Unix socket to create
+    :return: A socketserver, ready for serve_forever()
+    :raises ValueError: If the address can not be used (see address_error)
+    """
+    error = address_error(address)
+    if error != None:
+        raise ValueError(error)
+    if _is_port(address):
+        server = ThreadingHTTPServer(("127.0.0.1", int(address)), http_handler)
+    else:
+        _remove_socket(address)
+        server = socketserver.ThreadingUnixStreamServer(address, socket_handler)
+    server.daemon_threads = True
+    server.engine = engine.Engine()
+    return server
+
+
+def serve(address):
+    """Answer requests until interrupted"""
+    server = make_server(address)
+    # Read the rules now, so the first request doesn't have to wait
+    server.engine.rules()
+    server_logger.info("Listening on {0}".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not _is_port(address):
+            _remove_socket(address)
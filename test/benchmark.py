@@ -0,0 +1,323 @@
+#! /usr/bin/python3
+
+"""
+Benchmark mlox against synthetic load orders and rule sets.
+
+For each size, a Data Files directory of that many Morrowind plugins (with real TES3 headers, masters, and
+descriptions) and a rules file with that many rules are generated, then the slow parts of mlox are timed:
+  * read_rules        Reading (and compiling) the rules file, and evaluating it against the plugins
+  * read_rules_cached The same, with the compiled rules in the cache
+  * add_edge          Adding edges between the plugins to an empty graph, some of which would make cycles
+  * topo_sort         Sorting that graph
+  * add_current_order Adding the current load order to the graph built from the rules
+  * update            A full loadorder.update(), from a warm cache (the time of each stage is also recorded)
+
+Each benchmark is run several times, and the fastest and median times are kept.
+The results are printed as a table, and can be saved as JSON and compared with an earlier run:
+
+    ./benchmark.py --sizes 100 1000 10000 --output after.json --compare before.json
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import struct
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mlox'))
+
+import modules.version as version
+import modules.fileFinder as fileFinder
+import modules.pluggraph as pluggraph
+import modules.ruleParser as ruleParser
+import modules.ruleCache as ruleCache
+import modules.headerCache as headerCache
+import modules.loadOrder as loadOrder
+import modules.profiler as profiler
+
+default_sizes = [100, 1000, 10000]
+
+# Benchmarks that are this much slower than in the compared run are marked
+slower_ratio = 1.2
+
+
+def plugin_names(count, rng):
+    """Make up count plugin names, with a few masters first.  Some have version numbers, like real plugins."""
+    words = ["Better", "Ald", "Vivec", "Tamriel", "Armor", "Bodies", "Quest", "Fix", "Mage", "Guild", "House",
+             "Lights", "Water", "Sounds", "Patch", "Expansion", "Creatures", "Rebirth", "Tweaks", "Merged"]
+    names = ["Morrowind.esm", "Tribunal.esm", "Bloodmoon.esm"]
+    n_masters = max(1, count // 50)
+    for i in range(count - len(names)):
+        name = "{0} {1}_{2:05d}".format(rng.choice(words), rng.choice(words), i)
+        if rng.random() < 0.2:
+            name += " v{0}.{1}".format(rng.randint(1, 3), rng.randint(0, 9))
+        names.append(name + (".esm" if i < n_masters else ".esp"))
+    return names
+
+
+def plugin_data(description, masters, n_records):
+    """A Morrowind plugin: the TES3 header record, then n_records small records"""
+    hedr = struct.pack("<fI", 1.3, 0) + b"Benchmark".ljust(32, b"\x00") + \
+           description.encode("cp1252")[:255].ljust(256, b"\x00") + struct.pack("<I", n_records)
+    subrecords = b"HEDR" + struct.pack("<I", len(hedr)) + hedr
+    for master in masters:
+        name = master.encode("cp1252") + b"\x00"
+        subrecords += b"MAST" + struct.pack("<I", len(name)) + name + b"DATA" + struct.pack("<IQ", 8, 0)
+    data = b"TES3" + struct.pack("<III", len(subrecords), 0, 0) + subrecords
+    for i in range(n_records):
+        body = b"NAME" + struct.pack("<I", 8) + "rec{0:04d}\x00".format(i).encode("ascii")[:8]
+        data += b"MISC" + struct.pack("<III", len(body), 0, 0) + body
+    return data
+
+
+def make_data_dir(data_dir, names, rng):
+    """
+    Write the plugins, with modification times in a shuffled order so there is sorting to do.
+
+    :return: The description of each plugin, by name
+    """
+    os.makedirs(data_dir)
+    masters = [n for n in names if n.endswith(".esm")]
+    order = list(names[3:])
+    rng.shuffle(order)
+    order = names[:3] + order
+    descriptions = {}
+    for (i, name) in enumerate(order):
+        plugin_masters = ["Morrowind.esm"]
+        if name not in masters:
+            plugin_masters += [m for m in rng.sample(masters[3:], min(2, len(masters) - 3)) if rng.random() < 0.3]
+        descriptions[name] = "{0}, version 1.{1}".format(name[:-4], rng.randint(0, 9))
+        path = os.path.join(data_dir, name)
+        with open(path, 'wb') as plugin:
+            plugin.write(plugin_data(descriptions[name], plugin_masters if name != "Morrowind.esm" else [], 8))
+        os.utime(path, (1000000000 + i * 60, 1000000000 + i * 60))
+    return descriptions
+
+
+def make_rules(rule_file, names, descriptions, count, rng):
+    """
+    Write a rules file with count rules, in the style of mlox_base.txt.
+
+    Like the real rules, most rules are about plugins the user does not have.
+    """
+    missing = ["Missing Mod {0:05d}.esp".format(i) for i in range(count)]
+    everyone = names + missing
+
+    def some(k):
+        return rng.sample(everyone, k)
+
+    def pattern(name):
+        # Replace the number in the name with a wildcard
+        return name[:-9] + "*" + name[-4:] if name[-9:-4].isdigit() else name
+
+    lines = ["; Synthetic rules for benchmarking mlox", "[Version {0}]".format(count), ""]
+    lines += ["[NearStart]", "Morrowind.esm", "", "[NearEnd]", names[-1], ""]
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            lines += ["[Order]"] + some(rng.randint(2, 5))
+        elif kind < 0.55:
+            lines += ["[Conflict]", " These change the same things."] + [pattern(n) for n in some(2)]
+        elif kind < 0.7:
+            lines += ["[Note]", " A note about this plugin.", "[ANY {0}]".format(" ".join(some(2)))]
+        elif kind < 0.8:
+            (plugin, needed) = some(2)
+            lines += ["[Requires]", " It needs this.", plugin, "[ALL {0} [NOT {1}]]".format(needed, some(1)[0])]
+        elif kind < 0.88:
+            (patch, a, b) = some(3)
+            lines += ["[Patch]", " Glue them together.", patch, "[ALL {0} {1}]".format(a, b)]
+        elif kind < 0.94:
+            name = rng.choice(names)
+            wanted = descriptions.get(name, "anything")[-3:]
+            lines += ["[Note]", " The description matches.", "[DESC /{0}/ {1}]".format(wanted.replace(".", r"\."), name)]
+        else:
+            name = rng.choice(names)
+            lines += ["[Note]", " The version is old.", "[VER < 1.5 {0}]".format(name)]
+        lines.append("")
+    with open(rule_file, 'w', encoding='utf-8') as out:
+        out.write("\n".join(lines) + "\n")
+
+
+def time_runs(repeat, setup, run):
+    """
+    Time run(setup()) repeat times.  Only run is timed.
+
+    :return: A list of times, in seconds
+    """
+    times = []
+    for i in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summary(times):
+    return {"min": min(times), "median": statistics.median(times), "runs": times}
+
+
+def benchmark_size(size, work_dir, repeat, seed):
+    """Generate the data for one size, and time everything on it"""
+    rng = random.Random(seed + size)
+    size_dir = os.path.join(work_dir, str(size))
+    data_dir = os.path.join(size_dir, "Data Files")
+    rule_file = os.path.join(size_dir, "mlox_base.txt")
+    shutil.rmtree(size_dir, ignore_errors = True)
+    names = plugin_names(size, rng)
+    descriptions = make_data_dir(data_dir, names, rng)
+    make_rules(rule_file, names, descriptions, size, rng)
+
+    loadOrder.base_file = rule_file
+    loadOrder.user_file = os.path.join(size_dir, "mlox_user.txt")    # never written, so skipped
+
+    def new_loadorder():
+        a_loadorder = loadOrder.loadorder()
+        a_loadorder.game_type = "Morrowind"
+        a_loadorder.datadir = data_dir
+        a_loadorder.get_data_files()
+        return a_loadorder
+
+    def new_parser():
+        a_loadorder = new_loadorder()
+        return ruleParser.rule_parser(a_loadorder.order, a_loadorder._data_snapshot(), a_loadorder.caseless)
+
+    def cold_parser():
+        shutil.rmtree(ruleCache.cache_dir, ignore_errors = True)
+        return new_parser()
+
+    timings = {}
+    timings["read_rules"] = summary(time_runs(repeat, cold_parser, lambda parser: parser.read_rules(rule_file)))
+    timings["read_rules_cached"] = summary(time_runs(repeat, new_parser, lambda parser: parser.read_rules(rule_file)))
+
+    # Random edges, mostly from earlier to later plugins.  The rest would usually make cycles, and are rejected.
+    edges = []
+    for i in range(size * 3):
+        (a, b) = sorted(rng.sample(range(size), 2))
+        edges.append((names[b], names[a]) if rng.random() < 0.1 else (names[a], names[b]))
+    canonical_edges = [(fileFinder.canonical(a), fileFinder.canonical(b)) for (a, b) in edges]
+
+    def add_edges(graph):
+        for (a, b) in canonical_edges:
+            graph.add_edge("", a, b)
+        return graph
+
+    graphs = []
+    timings["add_edge"] = summary(time_runs(repeat, pluggraph.pluggraph, lambda graph: graphs.append(add_edges(graph))))
+    timings["topo_sort"] = summary(time_runs(repeat, lambda: graphs.pop().copy(), lambda graph: graph.topo_sort()))
+
+    def rule_graph():
+        a_loadorder = new_loadorder()
+        parser = ruleParser.rule_parser(a_loadorder.order, a_loadorder._data_snapshot(), a_loadorder.caseless)
+        parser.read_rules(rule_file)
+        return (a_loadorder, parser.get_graph())
+
+    timings["add_current_order"] = summary(time_runs(repeat, rule_graph, lambda args: args[0].add_current_order(args[1])))
+
+    # Warm the caches, then time full updates, recording the time of each stage of the last one
+    new_loadorder().update()
+    stages = {}
+
+    def update(a_loadorder):
+        a_profile = profiler.profile(use_cprofile = False)
+        a_profile.start()
+        try:
+            a_loadorder.update()
+        finally:
+            a_profile.stop()
+        stages.clear()
+        for stats in a_profile.stages.values():
+            stages[stats.name] = stats.seconds
+
+    timings["update"] = summary(time_runs(repeat, new_loadorder, update))
+    return {"size": size, "plugins": len(names), "rules": size, "timings": timings, "update_stages": dict(stages)}
+
+
+def run_benchmarks(sizes, repeat = 3, seed = 0, work_dir = None):
+    """
+    Run every benchmark for each size.
+
+    :param work_dir: Where to generate the data.  Defaults to a temporary directory, which is removed afterwards.
+    :return: The results, ready to be saved as JSON
+    """
+    temp_dir = tempfile.mkdtemp(prefix = "mlox_benchmark_") if work_dir == None else None
+    work_dir = temp_dir if work_dir == None else os.path.abspath(work_dir)
+    old_cwd = os.getcwd()
+    saved = (loadOrder.base_file, loadOrder.user_file, ruleCache.cache_dir, headerCache.cache_dir)
+    try:
+        # Keep the caches, and the load orders update() writes, out of the user's directories
+        ruleCache.cache_dir = os.path.join(work_dir, "cache")
+        headerCache.cache_dir = os.path.join(work_dir, "cache")
+        os.makedirs(work_dir, exist_ok = True)
+        os.chdir(work_dir)
+        results = [benchmark_size(size, work_dir, repeat, seed) for size in sizes]
+    finally:
+        os.chdir(old_cwd)
+        (loadOrder.base_file, loadOrder.user_file, ruleCache.cache_dir, headerCache.cache_dir) = saved
+        if temp_dir != None:
+            shutil.rmtree(temp_dir)
+    return {"mlox_version": version.full_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "repeat": repeat,
+            "seed": seed,
+            "results": results}
+
+
+def format_results(results, compare = None):
+    """
+    Format results as a table of the median times.
+
+    :param compare: Earlier results to compare with.  Each time is followed by how many times slower it is now.
+    """
+    old_times = {}
+    if compare != None:
+        for result in compare["results"]:
+            for (name, times) in result["timings"].items():
+                old_times[(result["size"], name)] = times["median"]
+    out = "{0:<20} {1:>8} {2:>12}\n".format("Benchmark", "Size", "Median (s)")
+    for result in results["results"]:
+        for (name, times) in result["timings"].items():
+            out += "{0:<20} {1:>8} {2:>12.4f}".format(name, result["size"], times["median"])
+            old = old_times.get((result["size"], name))
+            if old:
+                ratio = times["median"] / old
+                out += " {0:>6.2f}x{1}".format(ratio, " SLOWER" if ratio > slower_ratio else "")
+            out += "\n"
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark mlox against synthetic load orders and rule sets.")
+    parser.add_argument("--sizes", help = "The numbers of plugins (and rules) to try.", metavar = "N", nargs = "+",
+                        type = int, default = default_sizes)
+    parser.add_argument("--repeat", help = "How many times to run each benchmark.", type = int, default = 3)
+    parser.add_argument("--seed", help = "Seed for generating the data, so runs can be compared.", type = int, default = 0)
+    parser.add_argument("--work-dir", help = "Generate the data here (replacing any from an earlier run), and keep it, instead of in a temporary directory.",
+                        metavar = "dir")
+    parser.add_argument("--output", help = "Save the results to this JSON file.", metavar = "file")
+    parser.add_argument("--compare", help = "Compare with the results saved in this JSON file.", metavar = "file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.ERROR)
+    compare = None
+    if args.compare:
+        with open(args.compare, encoding = 'utf-8') as compare_file:
+            compare = json.load(compare_file)
+    results = run_benchmarks(args.sizes, args.repeat, args.seed, args.work_dir)
+    print(format_results(results, compare), end = "")
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as output_file:
+            json.dump(results, output_file, indent = 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,18 @@ class fileFinder_test(unittest.TestCase):
     def test_file_names(self):
         import modules.fileFinder as fileFinder
         file_names = fileFinder.caseless_filenames()
-        #TODO:  Actually test this
+        self.assertEqual(file_names.cname("Straße.ESP"), "strasse.esp")
+        self.assertEqual(file_names.cname("STRASSE.esp"), "strasse.esp")
+        # The first spelling seen is the truename
+        self.assertEqual(file_names.truename("strasse.esp"), "Straße.ESP")
+        self.assertEqual(file_names.intern("strasse.esp"), 0)
+        self.assertEqual(file_names.intern("other.esp"), 1)
+        # A graph built with the table uses its ids
+        import modules.pluggraph as pluggraph
+        graph = pluggraph.pluggraph(file_names)
+        graph.add_edge("", "other.esp", "strasse.esp")
+        self.assertEqual(graph.children[1], [0])
+        self.assertFalse(graph.can_reach("strasse.esp", "unknown.esp"))
 
     def test_dir_list(self):
         import modules.fileFinder as fileFinder
@@ -41,6 +52,16 @@ class fileFinder_test(unittest.TestCase):
         #TODO:  Actually test these two (seperately)
         #print(fileFinder.filter_dup_files(dir_list.filelist()))
 
+    def test_plugin_snapshot(self):
+        import modules.fileFinder as fileFinder
+        snapshot = fileFinder.plugin_snapshot("./test1.data/")
+        dir_list = fileFinder.caseless_dirlist("./test1.data/")
+        plugins = [f for f in dir_list.filelist() if f.lower()[-4:] in (".esp", ".esm")]
+        self.assertEqual(sorted(snapshot.plugins()), sorted(plugins))
+        self.assertEqual(snapshot.stat(plugins[0].upper()).st_size, os.path.getsize(dir_list.find_path(plugins[0])))
+        self.assertTrue(snapshot.stat("not_a_plugin.esp") is None)
+        self.assertTrue(dir_list.stat(plugins[0]) is None)
+
 #Config Handler
 class configHandler_test(unittest.TestCase):
     import modules.configHandler as configHandler
@@ -128,6 +149,60 @@ class configHandler_test(unittest.TestCase):
         self.assertEqual(dirHandler.read(),self.modified_plugins)
         dirHandler.write(self.test1_plugins)
 
+    def test_moved_plugins(self):
+        old = ["a.esp", "b.esp", "c.esp", "d.esp", "e.esp"]
+        self.assertEqual(self.configHandler.moved_plugins(old, old), set())
+        self.assertEqual(self.configHandler.moved_plugins(old, ["a.esp", "d.esp", "b.esp", "c.esp", "e.esp"]), {"d.esp"})
+        self.assertEqual(self.configHandler.moved_plugins(old, ["E.esp", "a.esp", "b.esp", "c.esp", "d.esp", "new.esp"]), {"e.esp", "new.esp"})
+        self.assertEqual(len(self.configHandler.moved_plugins(old, list(reversed(old)))), 4)
+
+    def test_dirHandler_minimal(self):
+        """A minimal write only touches the plugins that move"""
+        import tempfile
+        import shutil
+        temp_dir = tempfile.mkdtemp()
+        try:
+            plugins = ["a.esm", "a.esp", "b.esp", "c.esp", "d.esp"]
+            for (i, a_plugin) in enumerate(plugins):
+                open(os.path.join(temp_dir, a_plugin), 'w').close()
+                os.utime(os.path.join(temp_dir, a_plugin), (-1, 1000000000 + 600 * i))
+            dirHandler = self.configHandler.dataDirHandler(temp_dir)
+            self.assertEqual(dirHandler.read(), plugins)
+            new_order = ["a.esm", "a.esp", "d.esp", "b.esp", "c.esp"]
+            self.assertTrue(dirHandler.write_minimal(new_order))
+            self.assertEqual(dirHandler.read(), new_order)
+            for a_plugin in ["a.esm", "a.esp", "b.esp", "c.esp"]:
+                self.assertEqual(os.path.getmtime(os.path.join(temp_dir, a_plugin)), 1000000000 + 600 * plugins.index(a_plugin))
+            # No room between plugins, so every plugin is rewritten
+            os.utime(os.path.join(temp_dir, "b.esp"), (-1, 1000000000 + 600))
+            self.assertTrue(dirHandler.write_minimal(["a.esm", "d.esp", "b.esp", "a.esp", "c.esp"]))
+            self.assertEqual(dirHandler.read(), ["a.esm", "d.esp", "b.esp", "a.esp", "c.esp"])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_dirHandler_minimal_official_masters(self):
+        """Moving an official master gives it (and its bsa) the fixed tes3cmd resetdates time, like a full write"""
+        import tempfile
+        import shutil
+        temp_dir = tempfile.mkdtemp()
+        try:
+            plugins = ["Tribunal.esm", "Morrowind.esm", "a.esp"]
+            for (i, a_file) in enumerate(plugins + ["Morrowind.bsa", "Tribunal.bsa"]):
+                open(os.path.join(temp_dir, a_file), 'w').close()
+                os.utime(os.path.join(temp_dir, a_file), (-1, 1100000000 + 600 * i))
+            dirHandler = self.configHandler.dataDirHandler(temp_dir)
+            self.assertEqual(dirHandler.read(), plugins)
+            new_order = ["Morrowind.esm", "Tribunal.esm", "a.esp"]
+            self.assertTrue(dirHandler.write_minimal(new_order))
+            self.assertEqual(dirHandler.read(), new_order)
+            times = self.configHandler.official_master_times
+            for a_file in ["Morrowind.esm", "Morrowind.bsa"]:
+                self.assertEqual(os.path.getmtime(os.path.join(temp_dir, a_file)), times["morrowind.esm"])
+            for a_file in ["Tribunal.esm", "Tribunal.bsa"]:
+                self.assertEqual(os.path.getmtime(os.path.join(temp_dir, a_file)), times["tribunal.esm"])
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_morrowind_ini_clearing_writing(self):
         """
         Test both clearing and writing to a morrowind.ini file at the same time
@@ -220,6 +295,206 @@ class parser_pluggraph_test(unittest.TestCase):
         graph=myParser.get_graph()
         self.assertEqual(graph.topo_sort(),self.test1_graph)
 
+    def test_evaluate_many(self):
+        """One parsed rule set can be evaluated against any number of plugin lists"""
+        import modules.ruleEvaluator as ruleEvaluator
+        rules = self.ruleParser.compile_rule_file("./test2.data/mlox_base.txt")
+        self.assertEqual(rules.version, None)
+        only_a = ruleEvaluator.rule_evaluator(["aaaaa.esp"], None, self.file_names)
+        only_a.evaluate(rules)
+        self.assertIn("[REQUIRES]\n !!!'aaaaa.esp' Requires:\n > 'MISSING(ggggg.esp)'", only_a.get_messages())
+        a_and_g = ruleEvaluator.rule_evaluator(["aaaaa.esp", "ggggg.esp"], None, self.file_names)
+        a_and_g.evaluate(rules)
+        self.assertNotIn("[REQUIRES]", a_and_g.get_messages())
+        # The graph only depends on the rules
+        self.assertEqual(only_a.graph.as_dict(), a_and_g.graph.as_dict())
+
+    def test_rule_messages(self):
+        import json
+        import modules.ruleEvaluator as ruleEvaluator
+        rules = self.ruleParser.compile_rule_file("./test2.data/mlox_base.txt")
+        evaluator = ruleEvaluator.rule_evaluator(["aaaaa.esp", "abpat.esp"], None, self.file_names)
+        evaluator.evaluate(rules)
+        self.assertEqual([m.kind for m in evaluator.messages], ["NOTE", "NOTE", "PATCH", "REQUIRES"])
+        (note, patch) = evaluator.messages[1:3]
+        self.assertEqual(note.exprs, ["aaaaa.esp"])
+        self.assertEqual(note.message, [" Second message for aaaaa.esp"])
+        self.assertEqual(note.where(), "./test2.data/mlox_base.txt:32")
+        self.assertTrue(patch.missing_prerequisites)
+        self.assertEqual(patch.exprs, ["abpat.esp", ["ALL", "aaaaa.esp", "MISSING(bbbbb.esp)"]])
+        # The text is only put together from the parts when asked for
+        self.assertEqual(evaluator.get_messages(), "".join(m.text() for m in evaluator.messages))
+        self.assertIn("[PATCH]\n !!'abpat.esp' is missing some pre-requisites:", patch.text())
+        self.assertEqual(json.loads(json.dumps(patch.to_dict()))["expressions"], patch.exprs)
+        # An [ANY] of only missing plugins has nothing to show, and neither does a [NOT] of it
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False) as rule_file:
+            rule_file.write("[Note]\n a note\n[ALL anyp.esp [NOT [ANY anyx.esp anyy.esp]]]\n"
+                            "[Conflict]\nanyp.esp\n[ALL anyq.esp [NOT [ANY anyx.esp anyy.esp]]]\n"
+                            "[Note]\n another note\n[NOT [ALL anyp.esp [ANY anyx.esp anyy.esp]]]\n")
+        try:
+            rules = self.ruleParser.compile_rule_file(rule_file.name)
+        finally:
+            os.remove(rule_file.name)
+        evaluator = ruleEvaluator.rule_evaluator(["anyp.esp", "anyq.esp"], None, self.file_names)
+        evaluator.evaluate(rules)
+        (note, conflict, not_note) = evaluator.messages
+        self.assertEqual(note.text(), "[NOTE]\n > 'anyp.esp'\n | a note\n")
+        self.assertEqual(conflict.exprs, ["anyp.esp", "anyq.esp"])
+        # Unless they are why an [ALL] is False
+        self.assertEqual(not_note.exprs, [["NOT", ["ALL", "anyp.esp", ["ANY", "MISSING(anyx.esp)", "MISSING(anyy.esp)"]]]])
+        self.assertNotIn("['ANY']", evaluator.get_messages())
+
+    def test_relevance_index(self):
+        import tempfile
+        import modules.ruleEvaluator as ruleEvaluator
+        with tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False) as rule_file:
+            rule_file.write("[Note]\n a note\nA.esp\n[Requires]\n[NOT X.esp]\nY.esp\n[Conflict]\nfoo*.esp\nbar.esp\n")
+        try:
+            rules = self.ruleParser.compile_rule_file(rule_file.name)
+        finally:
+            os.remove(rule_file.name)
+        self.assertEqual(rules.index, {"a.esp": [0], "bar.esp": [2]})
+        self.assertEqual(rules.patterns, {"foo*.esp": [2]})
+        # The [Requires] rule fires even when none of its plugins are present
+        self.assertEqual(rules.always, [1])
+        evaluator = ruleEvaluator.rule_evaluator(["a.esp"], None, self.file_names)
+        self.assertEqual(evaluator._relevant_rules(rules), {0, 1})
+        evaluator = ruleEvaluator.rule_evaluator(list(map(self.file_names.cname, ["foo2.esp", "bar.esp"])), None, self.file_names)
+        self.assertEqual(evaluator._relevant_rules(rules), {1, 2})
+        evaluator.evaluate(rules)
+        self.assertIn("[CONFLICT]", evaluator.get_messages())
+
+    def test_expand_filename(self):
+        import modules.ruleEvaluator as ruleEvaluator
+        plugins = ["zed v2.esp", "bar.esp", "foo_1.0.esp", "zed v1.esp", "foo.esp"]
+        evaluator = ruleEvaluator.rule_evaluator(plugins, None, self.file_names)
+        # Matches come back in load order
+        self.assertEqual(evaluator._expand_filename("zed v?.esp"), ["zed v2.esp", "zed v1.esp"])
+        self.assertEqual(evaluator._expand_filename("*.esp"), plugins)
+        self.assertEqual(evaluator._expand_filename("foo_<VER>.esp"), ["foo_1.0.esp"])
+        self.assertEqual(evaluator._expand_filename("Foo*.esp"), ["foo_1.0.esp", "foo.esp"])
+        self.assertEqual(evaluator._expand_filename("Bar.esp"), ["Bar.esp"])
+        self.assertEqual(evaluator._expand_filename("baz*.esp"), [])
+        self.assertEqual(ruleEvaluator.compile_pattern("foo (bar)*.esp")[1], "foo (bar)")
+
+    def test_short_circuit(self):
+        import modules.ruleEvaluator as ruleEvaluator
+        R = self.ruleParser
+        evaluator = ruleEvaluator.rule_evaluator(["a.esp", "b.esp"], None, self.file_names)
+        checked = []
+        def evaluate_desc(expr):
+            checked.append(expr.plugin_name)
+            return (True, "")
+        evaluator._evaluate_desc = evaluate_desc
+        desc = R.desc_expr("", "foo", "b.esp")
+        self.assertTrue(evaluator._truth(R.bool_expr("ANY", [R.plugin_expr("a.esp"), desc])))
+        self.assertFalse(evaluator._truth(R.bool_expr("ALL", [R.plugin_expr("c.esp"), desc])))
+        self.assertFalse(evaluator._truth(R.bool_expr("NOT", [R.plugin_expr("a.esp"), R.plugin_expr("b.esp")])))
+        self.assertEqual(checked, [])
+        self.assertTrue(evaluator._truth(R.bool_expr("ALL", [R.plugin_expr("a.esp"), desc])))
+        self.assertEqual(checked, ["b.esp"])
+        # Rules that do not fire are never fully evaluated
+        self.assertFalse(evaluator._fires(R.statement_rule("REQUIRES", 1, [], [R.plugin_expr("c.esp"), desc])))
+        self.assertTrue(evaluator._fires(R.statement_rule("CONFLICT", 1, [], [R.plugin_expr("*.esp")])))
+        self.assertEqual(checked, ["b.esp"])
+
+    def test_prefetch_headers(self):
+        import tempfile
+        import shutil
+        import modules.ruleEvaluator as ruleEvaluator
+        import modules.headerCache as headerCache
+        temp_dir = tempfile.mkdtemp()
+        old_headers = headerCache.headers
+        try:
+            rule_file = os.path.join(temp_dir, "rules.txt")
+            with open(rule_file, 'w') as rules:
+                rules.write("[Note]\n a note\n[DESC /x/ Foo*.esp]\n[Conflict]\n[SIZE 10 bar.esp]\na.esp\n")
+            rules = self.ruleParser.compile_rule_file(rule_file)
+            self.assertEqual(rules.header_names, {"Foo*.esp", "bar.esp"})
+            data_dir = os.path.join(temp_dir, "data")
+            os.mkdir(data_dir)
+            for plugin in ["foo1.esp", "foo2.esp", "bar.esp", "a.esp"]:
+                open(os.path.join(data_dir, plugin), 'wb').close()
+            headerCache.headers = headerCache.header_cache(os.path.join(temp_dir, "headers.pkl"))
+            snapshot = self.fileFinder.plugin_snapshot(data_dir)
+            evaluator = ruleEvaluator.rule_evaluator(["foo1.esp", "foo2.esp", "bar.esp", "a.esp"], snapshot, self.file_names)
+            evaluator.prefetch_headers(rules)
+            self.assertEqual(sorted(map(os.path.basename, headerCache.headers.entries)), ["bar.esp", "foo1.esp", "foo2.esp"])
+        finally:
+            headerCache.headers = old_headers
+            shutil.rmtree(temp_dir)
+
+    def test_pluggraph_cycles(self):
+        graph = self.pluggraph.pluggraph()
+        self.assertTrue(graph.add_edge("test:1", "c.esp", "d.esp"))
+        self.assertTrue(graph.add_edge("test:2", "b.esp", "c.esp"))
+        self.assertTrue(graph.add_edge("test:3", "a.esp", "b.esp"))
+        self.assertTrue(graph.add_edge("test:4", "a.esp", "b.esp"))   # duplicate
+        with self.assertLogs('mlox.pluggraph', level='WARNING') as l:
+            self.assertFalse(graph.add_edge("test:5", "d.esp", "a.esp"))
+            self.assertEqual(l.output, ['WARNING:mlox.pluggraph:test:5: Cycle detected, not adding: "d.esp" -> "a.esp"'])
+        self.assertFalse(graph.add_edge("", "b.esp", "b.esp"))
+        self.assertTrue(graph.can_reach("a.esp", "d.esp"))
+        self.assertFalse(graph.can_reach("d.esp", "a.esp"))
+        # The topological order is kept consistent with every edge
+        for (parent, children) in graph.as_dict().items():
+            for child in children:
+                self.assertLess(graph.order_index[graph.ids[parent]], graph.order_index[graph.ids[child]])
+        self.assertEqual(graph.topo_sort(), ["a.esp", "b.esp", "c.esp", "d.esp"])
+
+    def test_pluggraph_bulk(self):
+        """Bulk edge insertion gives the same graph as adding the edges one at a time"""
+        import random
+        rand = random.Random(42)
+        for n in range(20):
+            plugins = ["%d.esp" % i for i in range(30)]
+            rules = [rand.sample(plugins, 2) for i in range(40)]
+            order = rand.sample(plugins, 25)
+            anchored = set(rand.sample(order, 3))
+            one_by_one = self.pluggraph.pluggraph()
+            bulk = self.pluggraph.pluggraph()
+            for (a, b) in rules:
+                one_by_one.add_edge("", a, b)
+                bulk.add_edge("", a, b)
+            for p_end in sorted(anchored):
+                for p in order:
+                    if p != p_end:
+                        one_by_one.add_edge("", p, p_end)
+                bulk.add_edges_to("", [p for p in order if p != p_end], p_end)
+            one_by_one.add_node(order[0])
+            for curr_i in range(1, len(order)):
+                one_by_one.add_node(order[curr_i])
+                if order[curr_i] not in anchored:
+                    for i in range(curr_i - 1, 0, -1):
+                        if order[i] not in anchored and one_by_one.add_edge("", order[i], order[curr_i]):
+                            break
+            bulk.add_chain("", order, anchored)
+            self.assertEqual(bulk.as_dict(), one_by_one.as_dict())
+            self.assertEqual(bulk.topo_sort(), one_by_one.topo_sort())
+            # The topological order is still kept up to date
+            self.assertFalse(bulk.add_edge("", order[-1], order[-1]))
+            for (parent, children) in bulk.as_dict().items():
+                for child in children:
+                    self.assertLess(bulk.order_index[bulk.ids[parent]], bulk.order_index[bulk.ids[child]])
+
+    def test_pluggraph_resort(self):
+        graph = self.pluggraph.pluggraph()
+        graph.add_edge("test:1", "b.esp", "c.esp")
+        graph.add_edge("test:2", "a.esp", "c.esp")
+        graph.add_node("d.esp")
+        nodes = graph.as_dict()
+        first = graph.topo_sort()
+        # Sorting leaves the graph intact, so it can be sorted again
+        self.assertEqual(graph.as_dict(), nodes)
+        self.assertEqual(graph.topo_sort(), first)
+        # Changing a copy does not change the original
+        what_if = graph.copy()
+        what_if.add_edge("", "d.esp", "b.esp")
+        self.assertEqual(what_if.topo_sort(), ["a.esp", "d.esp", "b.esp", "c.esp"])
+        self.assertEqual(graph.topo_sort(), first)
+        self.assertFalse(graph.can_reach("d.esp", "b.esp"))
+
     #TODO:  d_ver doesn't seem correct
     def test_plugin_version(self):
         #Multi-line check here
@@ -227,6 +502,207 @@ class parser_pluggraph_test(unittest.TestCase):
         self.assertEqual(f_ver,'00001.00001.00000._')
         self.assertEqual(d_ver,None)
 
+#Cache files
+class cacheFile_test(unittest.TestCase):
+    import modules.cacheFile as cacheFile
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, "cache", "test.pkl")
+
+    def test_read_write(self):
+        self.assertEqual(self.cacheFile.read(self.cache_file, 1), None)
+        self.assertTrue(self.cacheFile.write(self.cache_file, 1, {"a": 1}))
+        self.assertEqual(self.cacheFile.read(self.cache_file, 1), {"a": 1})
+        # Files in another format are thrown out
+        self.assertEqual(self.cacheFile.read(self.cache_file, 2), None)
+        # And so are files that are not a cache at all
+        with open(self.cache_file, 'wb') as cache_file:
+            cache_file.write(b"not a pickle")
+        self.assertEqual(self.cacheFile.read(self.cache_file, 1), None)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), ["test.pkl"])
+
+    def test_entry_cache(self):
+        class test_cache(self.cacheFile.entry_cache):
+            cache_format = 1
+        cache = test_cache(self.cache_file)
+        cache._load_once()
+        cache.entries["a"] = 1
+        cache.changed = True
+        self.assertTrue(cache.save())
+        self.assertFalse(cache.changed)
+        # Entries added before the saved cache is loaded are kept
+        cache = test_cache(self.cache_file)
+        cache.entries["b"] = 2
+        cache._load_once()
+        self.assertEqual(cache.entries, {"a": 1, "b": 2})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+#Rule cache
+class ruleCache_test(unittest.TestCase):
+    import modules.ruleCache as ruleCache
+    import modules.ruleParser as ruleParser
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_cache_dir = self.ruleCache.cache_dir
+        self.ruleCache.cache_dir = os.path.join(self.temp_dir, "cache")
+        self.rule_file = os.path.join(self.temp_dir, "mlox_base.txt")
+        shutil.copyfile("./test2.data/mlox_base.txt", self.rule_file)
+
+    def test_load(self):
+        compiled = self.ruleCache.load(self.rule_file, self.ruleParser.compile_rule_file)
+        self.assertEqual(compiled.n_rules, self.ruleParser.compile_rule_file(self.rule_file).n_rules)
+        self.assertTrue(os.path.isfile(self.ruleCache.cache_path(self.rule_file)))
+        # A second load comes from the cache, and does not call the compiler
+        cached = self.ruleCache.load(self.rule_file, None)
+        self.assertEqual(cached.n_rules, compiled.n_rules)
+        self.assertEqual(cached.names, compiled.names)
+        # Every mention of a plugin shares one plugin_expr, which keeps the cache small
+        exprs = {}
+        for rule in cached.rules:
+            if isinstance(rule, self.ruleParser.ordering_rule):
+                for (line, p) in rule.entries:
+                    self.assertIs(exprs.setdefault(p.name, p), p)
+
+    def test_rebuild_on_change(self):
+        compiled = self.ruleCache.load(self.rule_file, self.ruleParser.compile_rule_file)
+        with open(self.rule_file, 'a') as rule_file:
+            rule_file.write("\n[Order]\nA.esp\nB.esp\n")
+        recompiled = self.ruleCache.load(self.rule_file, self.ruleParser.compile_rule_file)
+        self.assertEqual(recompiled.n_rules, compiled.n_rules + 1)
+        self.assertEqual([p.name for (line, p) in recompiled.rules[-1].entries], ["a.esp", "b.esp"])
+
+    def tearDown(self):
+        import shutil
+        self.ruleCache.cache_dir = self.old_cache_dir
+        shutil.rmtree(self.temp_dir)
+
+#Plugin header cache
+class headerCache_test(unittest.TestCase):
+    import modules.headerCache as headerCache
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, "cache", "headers.pkl")
+        self.plugin = os.path.join(self.temp_dir, "plugin.esp")
+        # A minimal Morrowind plugin header, with a description at offset 64
+        with open(self.plugin, 'wb') as plugin:
+            plugin.write(b"TES3".ljust(64, b"\x00") + b"A plugin, Version 1.2".ljust(400, b"\x00"))
+
+    def test_get(self):
+        cache = self.headerCache.header_cache(self.cache_file)
+        info = cache.get(self.plugin)
+        self.assertEqual(info.header_type, "TES3")
+        self.assertEqual(info.size, 464)
+        self.assertEqual(info.formatted_version, "00001.00002.00000._")
+        self.assertIs(cache.get(self.plugin), info)
+        self.assertEqual(cache.get(os.path.join(self.temp_dir, "missing.esp")), None)
+        # Saved entries are used by the next run
+        self.assertTrue(cache.save())
+        cache = self.headerCache.header_cache(self.cache_file)
+        self.assertEqual(cache.get(self.plugin).description, info.description)
+        self.assertFalse(cache.changed)
+        # Until the plugin changes
+        with open(self.plugin, 'ab') as plugin:
+            plugin.write(b"\x00")
+        self.assertEqual(cache.get(self.plugin).size, info.size + 1)
+
+    def test_masters(self):
+        import struct
+        def subrecord(name, data, size_format):
+            return name + struct.pack(size_format, len(data)) + data
+        # Morrowind: a 16 byte record header, then HEDR with the description at offset 64, then MAST/DATA pairs
+        hedr = struct.pack("<fI", 1.3, 0) + b"me".ljust(32, b"\x00") + b"Masters v1".ljust(256, b"\x00") + struct.pack("<I", 5)
+        body = subrecord(b"HEDR", hedr, "<I")
+        for master in (b"Morrowind.esm", b"Tribunal.esm"):
+            body += subrecord(b"MAST", master + b"\x00", "<I") + subrecord(b"DATA", b"\x00" * 8, "<I")
+        with open(self.plugin, 'wb') as plugin:
+            plugin.write(b"TES3" + struct.pack("<III", len(body), 0, 0) + body + b"CELL".ljust(64, b"\x00"))
+        info = self.headerCache.header_cache(self.cache_file).get(self.plugin)
+        self.assertEqual(info.masters, ["Morrowind.esm", "Tribunal.esm"])
+        self.assertEqual(info.formatted_version, "00001.00000.00000._")
+        # Oblivion: a 20 byte record header, and 2 byte subrecord sizes
+        body = subrecord(b"HEDR", b"\x00" * 12, "<H") + subrecord(b"SNAM", b"Oblivion plugin\x00", "<H")
+        body += subrecord(b"MAST", b"Oblivion.esm\x00", "<H") + subrecord(b"DATA", b"\x00" * 8, "<H")
+        with open(self.plugin, 'wb') as plugin:
+            plugin.write(b"TES4" + struct.pack("<IIII", len(body), 0, 0, 0) + body)
+        (header_type, description, masters) = self.headerCache.read_header(self.plugin)
+        self.assertEqual((header_type, masters), ("TES4", ["Oblivion.esm"]))
+
+    def test_prefetch(self):
+        cache = self.headerCache.header_cache(self.cache_file)
+        missing = os.path.join(self.temp_dir, "missing.esp")
+        infos = cache.prefetch([(self.plugin, None), (None, None), (missing, None), (self.plugin, os.stat(self.plugin))], 2)
+        self.assertEqual([info != None for info in infos], [True, False, False, True])
+        self.assertEqual(infos[0].formatted_version, "00001.00002.00000._")
+        self.assertIs(cache.get(self.plugin), infos[0])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
+class recordIndex_test(unittest.TestCase):
+    import modules.recordIndex as recordIndex
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, "cache", "records.pkl")
+
+    def write_plugin(self, name, records):
+        """Write a Morrowind plugin, from a list of (record type, [(subrecord type, data)])"""
+        import struct
+        data = b""
+        for (rec_type, subrecords) in [(b"TES3", [(b"HEDR", b"\x00" * 300)])] + records:
+            body = b"".join(sub_type + struct.pack("<I", len(sub_data)) + sub_data for (sub_type, sub_data) in subrecords)
+            data += rec_type + struct.pack("<III", len(body), 0, 0) + body
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as plugin:
+            plugin.write(data)
+        return path
+
+    def test_read_records(self):
+        import struct
+        plugin = self.write_plugin("a.esp", [(b"NPC_", [(b"NAME", b"Fargoth\x00"), (b"FNAM", b"x\x00")]),
+                                             (b"CELL", [(b"NAME", b"Balmora\x00")]),
+                                             (b"INFO", [(b"INAM", b"12345\x00"), (b"NAME", b"Hello\x00")]),
+                                             (b"LAND", [(b"INTV", struct.pack("<ii", -2, 3))]),
+                                             (b"SKIL", [(b"INDX", struct.pack("<i", 8))])])
+        expected = [("NPC_", "fargoth"), ("INFO", "12345"), ("LAND", "-2,3"), ("SKIL", "8")]
+        self.assertEqual(self.recordIndex.read_records(plugin), expected)
+        index = self.recordIndex.record_index(self.cache_file)
+        self.assertEqual(index.get(plugin), expected)
+        self.assertTrue(index.save())
+        # The saved index is used until the plugin changes
+        index = self.recordIndex.record_index(self.cache_file)
+        self.assertEqual(index.get(plugin), expected)
+        self.assertFalse(index.changed)
+        self.write_plugin("a.esp", [])
+        self.assertEqual(index.get(plugin), [])
+        self.assertEqual(index.get(os.path.join(self.temp_dir, "missing.esp")), None)
+
+    def test_find_conflicts(self):
+        records = {"morrowind.esm": [("NPC_", "fargoth"), ("WEAP", "dagger")],
+                   "a.esp": [("NPC_", "fargoth"), ("WEAP", "dagger")],
+                   "b.esp": [("NPC_", "fargoth")],
+                   "patch.esp": [("WEAP", "dagger")]}
+        masters = {"a.esp": {"morrowind.esm"}, "b.esp": {"morrowind.esm"}, "patch.esp": {"morrowind.esm", "a.esp"}}
+        conflicts = self.recordIndex.find_conflicts(["morrowind.esm", "a.esp", "b.esp", "patch.esp"], records, masters)
+        # Plugins do not conflict with their masters, only with each other
+        self.assertEqual(conflicts, [(("a.esp", "b.esp"), [("NPC_", "fargoth")])])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir)
+
 #Load order
 #TODO: Actually test anything here
 class loadOrder_test(unittest.TestCase):
@@ -248,6 +724,75 @@ class loadOrder_test(unittest.TestCase):
         l2.get_data_files()
         l2.update()
 
+    def test_masters(self):
+        import tempfile
+        import shutil
+        import struct
+        import modules.headerCache as headerCache
+        import modules.pluggraph as pluggraph
+        temp_dir = tempfile.mkdtemp()
+        old_headers = headerCache.headers
+        try:
+            headerCache.headers = headerCache.header_cache(os.path.join(temp_dir, "headers.pkl"))
+            body = b"MAST" + struct.pack("<I", 7) + b"A.esm\x00\x00"
+            with open(os.path.join(temp_dir, "B.esp"), 'wb') as plugin:
+                plugin.write(b"TES3" + struct.pack("<III", len(body), 0, 0) + body + b"CELL".ljust(400, b"\x00"))
+            open(os.path.join(temp_dir, "A.esm"), 'wb').close()
+            l4 = self.loadorder()
+            l4.datadir = temp_dir
+            l4.get_data_files()
+            graph = pluggraph.pluggraph(l4.caseless)
+            l4.add_masters(graph)
+            self.assertTrue(graph.can_reach("a.esm", "b.esp"))
+        finally:
+            headerCache.headers = old_headers
+            shutil.rmtree(temp_dir)
+
+    def test_masters_before_rules(self):
+        import tempfile
+        import shutil
+        import struct
+        import modules.headerCache as headerCache
+        import modules.loadOrder as loadOrder
+        temp_dir = tempfile.mkdtemp()
+        old_headers = headerCache.headers
+        old_rules = (loadOrder.base_file, loadOrder.user_file)
+        old_cwd = os.getcwd()
+        try:
+            headerCache.headers = headerCache.header_cache(os.path.join(temp_dir, "headers.pkl"))
+            data_dir = os.path.join(temp_dir, "Data Files")
+            os.mkdir(data_dir)
+            for (n, name, masters) in [(1, "Base.esp", []), (2, "Child.esp", [b"Base.esp"]), (3, "Orphan.esp", [b"Gone.esm"])]:
+                body = b"".join(b"MAST" + struct.pack("<I", len(m) + 1) + m + b"\x00" for m in masters)
+                path = os.path.join(data_dir, name)
+                with open(path, 'wb') as plugin:
+                    plugin.write(b"TES3" + struct.pack("<III", len(body), 0, 0) + body + b"CELL".ljust(400, b"\x00"))
+                os.utime(path, (1000000000 + n * 60, 1000000000 + n * 60))
+            # A rule that contradicts a master
+            loadOrder.base_file = os.path.join(temp_dir, "mlox_base.txt")
+            loadOrder.user_file = os.path.join(temp_dir, "mlox_user.txt")
+            with open(loadOrder.base_file, 'w') as rule_file:
+                rule_file.write("[Order]\nChild.esp\nBase.esp\n")
+            os.chdir(temp_dir)
+            l5 = self.loadorder()
+            l5.datadir = data_dir
+            l5.get_data_files()
+            with self.assertLogs('mlox', level='WARNING') as logs:
+                l5.update()
+            self.assertEqual(l5.new_order, ["Base.esp", "Child.esp", "Orphan.esp"])
+            # The rule is rejected, not the master
+            self.assertTrue(any('mlox_base.txt:3: Cycle detected, not adding: "child.esp" -> "base.esp"' in line for line in logs.output))
+            self.assertTrue(any("missing its master \"Gone.esm\"" in line for line in logs.output))
+            # Missing masters are only reported when updating
+            l5.rule_graph = None
+            with self.assertNoLogs('mlox.loadOrder', level='WARNING'):
+                self.assertIn("child.esp", l5.explain("Base.esp"))
+        finally:
+            os.chdir(old_cwd)
+            headerCache.headers = old_headers
+            (loadOrder.base_file, loadOrder.user_file) = old_rules
+            shutil.rmtree(temp_dir)
+
     def test_File(self):
         l3 = self.loadorder()
         l3.read_from_file("./userfiles/abot.txt")
@@ -255,6 +800,301 @@ class loadOrder_test(unittest.TestCase):
         print(l3.explain("Morrowind.esm"))
         print(l3.explain("Morrowind.esm", True))
 
+#Batch mode
+class batch_test(unittest.TestCase):
+    import modules.batch as batch
+    import modules.loadOrder as loadOrder
+    files = ["./userfiles/abot.txt", "./userfiles/5h4rp.txt", "./userfiles/11225.txt"]
+
+    def setUp(self):
+        self.rule_files = (self.loadOrder.base_file, self.loadOrder.user_file)
+        self.loadOrder.base_file = os.path.abspath("../data/mlox_base.txt")
+        self.loadOrder.user_file = os.path.abspath("./no_user_file.txt")
+
+    def test_check_files(self):
+        results = list(self.batch.check_files(self.files))
+        self.assertEqual([r["file"] for r in results], self.files)
+        # The same as checking each file on its own
+        for result in results:
+            l5 = self.loadOrder.loadorder()
+            l5.read_from_file(result["file"])
+            self.assertEqual(l5.update(), result["messages"])
+            self.assertEqual(l5.new_order, result["new_order"])
+        self.assertEqual(list(self.batch.check_files(self.files, 2)), results)
+
+    def test_no_game_search(self):
+        import modules.fileFinder as fileFinder
+        find_game_dirs = fileFinder.find_game_dirs
+        def no_search():
+            raise AssertionError("find_game_dirs should not be called")
+        fileFinder.find_game_dirs = no_search
+        try:
+            results = list(self.batch.check_files(self.files[:1]))
+        finally:
+            fileFinder.find_game_dirs = find_game_dirs
+        self.assertNotEqual(results[0]["new_order"], [])
+
+    def test_unreadable_rules(self):
+        self.loadOrder.base_file = os.path.abspath("./no_base_file.txt")
+        with self.assertLogs('mlox.batch', level='ERROR'):
+            self.assertEqual(self.batch.check_files(self.files), None)
+
+    def test_write_reports(self):
+        import tempfile
+        import shutil
+        temp_dir = tempfile.mkdtemp()
+        files = []
+        # Files with the same name in different directories get their own reports
+        for sub_dir in ("a", "b"):
+            os.makedirs(os.path.join(temp_dir, "orders", sub_dir))
+            files.append(os.path.join(temp_dir, "orders", sub_dir, "load.txt"))
+        shutil.copyfile(self.files[0], files[0])
+        shutil.copyfile(self.files[1], files[1])
+        self.assertEqual(self.batch.report_names(files), {files[0]: os.path.join("a", "load.txt.out"),
+                                                          files[1]: os.path.join("b", "load.txt.out")})
+        report_dir = os.path.join(temp_dir, "reports")
+        results = list(self.batch.check_files(files))
+        self.batch.write_reports(results, report_dir, files)
+        for (sub_dir, result) in zip(("a", "b"), results):
+            with open(os.path.join(report_dir, sub_dir, "load.txt.out"), encoding='utf-8') as report:
+                self.assertEqual(report.read(), self.batch.format_report(result))
+        shutil.rmtree(temp_dir)
+
+    def tearDown(self):
+        (self.loadOrder.base_file, self.loadOrder.user_file) = self.rule_files
+
+#Engine
+class engine_test(unittest.TestCase):
+    import modules.engine as engine
+    import modules.loadOrder as loadOrder
+
+    def setUp(self):
+        self.mlox_engine = self.engine.Engine(os.path.abspath("../data/mlox_base.txt"), os.path.abspath("./no_user_file.txt"))
+        self.l7 = self.loadOrder.loadorder()
+        self.l7.read_from_file("./userfiles/abot.txt")
+        self.order = [self.l7.caseless.truename(p) for p in self.l7.order]
+
+    def test_sort_and_check(self):
+        from concurrent.futures import ThreadPoolExecutor
+        rules = self.mlox_engine.rules()
+        messages = self.l7.update(rules = rules)
+        self.assertEqual(self.mlox_engine.sort(self.order), self.l7.new_order)
+        self.assertEqual(self.mlox_engine.check(self.order), messages)
+        # The same load order is only updated once
+        self.assertIs(self.mlox_engine.update(self.order), self.mlox_engine.update(list(self.order)))
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            explanations = list(pool.map(lambda p: self.mlox_engine.explain(p, self.order), self.order[:8]))
+        self.assertEqual(explanations, [self.l7.explain(p, False, rules) for p in self.order[:8]])
+        self.assertIs(self.mlox_engine.rules(), rules)
+
+    def test_datadir(self):
+        import tempfile
+        import shutil
+        self.temp_dir = tempfile.mkdtemp()
+        data_dir = os.path.join(self.temp_dir, "Data Files")
+        os.makedirs(data_dir)
+        for plugin in ("a.esp", "b.esp"):
+            open(os.path.join(data_dir, plugin), 'wb').close()
+        old_cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            result = self.mlox_engine.update(["a.esp", "b.esp"], data_dir)
+            self.assertEqual(result.loadorder.new_order, ["a.esp", "b.esp"])
+            # Nothing is written for the caller
+            self.assertEqual(sorted(os.listdir(self.temp_dir)), ["Data Files"])
+            self.assertIs(self.mlox_engine.update(["a.esp", "b.esp"], data_dir), result)
+            # Until the plugins change
+            with open(os.path.join(data_dir, "b.esp"), 'wb') as plugin:
+                plugin.write(b"changed")
+            self.assertIsNot(self.mlox_engine.update(["a.esp", "b.esp"], data_dir), result)
+        finally:
+            os.chdir(old_cwd)
+            shutil.rmtree(self.temp_dir)
+
+    def test_no_game_search(self):
+        import modules.fileFinder as fileFinder
+        find_game_dirs = fileFinder.find_game_dirs
+        def no_search():
+            raise AssertionError("find_game_dirs should not be called")
+        fileFinder.find_game_dirs = no_search
+        try:
+            self.assertEqual(self.mlox_engine.sort(["Tribunal.esm", "Morrowind.esm"]), ["Morrowind.esm", "Tribunal.esm"])
+        finally:
+            fileFinder.find_game_dirs = find_game_dirs
+
+    def test_versions(self):
+        versions = self.mlox_engine.versions(["one.esp", "two_2_2g.esp"], "./test8.data/")
+        self.assertEqual(versions, [("one.esp", None, "00001.00000.00009.f"), ("two_2_2g.esp", "00002.00002.00000.g", None)])
+
+#Server
+class server_test(unittest.TestCase):
+    import modules.server as server
+    import modules.loadOrder as loadOrder
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.rule_files = (self.loadOrder.base_file, self.loadOrder.user_file)
+        self.loadOrder.base_file = os.path.abspath("../data/mlox_base.txt")
+        self.loadOrder.user_file = os.path.join(self.temp_dir, "mlox_user.txt")
+
+    def start(self, address):
+        import threading
+        self.instance = self.server.make_server(address)
+        threading.Thread(target=self.instance.serve_forever, daemon=True).start()
+
+    def test_unix_socket(self):
+        import json
+        import socket
+        address = os.path.join(self.temp_dir, "mlox.sock")
+        self.start(address)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(address)
+            stream = connection.makefile('rw')
+            with open("./userfiles/abot.txt") as load_order:
+                text = load_order.read()
+            requests = [{"action": "sort", "text": text},
+                        {"action": "explain", "order": ["Morrowind.esm", "Tribunal.esm"], "plugin": "Tribunal.esm"},
+                        {"action": "dance"}]
+            for request in requests:
+                stream.write(json.dumps(request) + "\n")
+            stream.write("not json\n")
+            stream.flush()
+            answers = [json.loads(stream.readline()) for i in range(4)]
+        l6 = self.loadOrder.loadorder()
+        l6.read_from_file("./userfiles/abot.txt")
+        l6.update()
+        self.assertEqual(answers[0]["new_order"], l6.new_order)
+        self.assertIn("follow Tribunal.esm", answers[1]["explanation"])
+        self.assertEqual([a["ok"] for a in answers], [True, True, False, False])
+
+    def test_long_request(self):
+        import json
+        import socket
+        address = os.path.join(self.temp_dir, "mlox.sock")
+        self.start(address)
+        old_size = self.server.max_request_size
+        self.server.max_request_size = 100
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(address)
+                stream = connection.makefile('rw')
+                stream.write(json.dumps({"action": "check", "order": ["a.esp"] * 100}) + "\n")
+                stream.write(json.dumps({"action": "check", "order": ["Morrowind.esm"]}) + "\n")
+                stream.flush()
+                answers = [json.loads(stream.readline()) for i in range(2)]
+        finally:
+            self.server.max_request_size = old_size
+        self.assertEqual(answers[0], {"ok": False, "error": "A request can be at most 100 bytes"})
+        self.assertTrue(answers[1]["ok"])
+
+    def test_no_unix_sockets(self):
+        old_unix_sockets = self.server.unix_sockets
+        self.server.unix_sockets = False
+        try:
+            self.assertIn("Unix sockets are not available", self.server.address_error("mlox.sock"))
+            self.assertEqual(self.server.address_error("8080"), None)
+            self.assertRaises(ValueError, self.server.make_server, os.path.join(self.temp_dir, "mlox.sock"))
+        finally:
+            self.server.unix_sockets = old_unix_sockets
+
+    def test_http(self):
+        import json
+        import urllib.request
+        self.start("0")
+        url = "http://127.0.0.1:{0}/check".format(self.instance.server_address[1])
+        request = urllib.request.Request(url, json.dumps({"order": ["Morrowind.esm", "Tribunal.esm"]}).encode('utf-8'))
+        with urllib.request.urlopen(request) as response:
+            answer = json.loads(response.read().decode('utf-8'))
+        self.assertTrue(answer["ok"])
+        self.assertTrue(answer["is_sorted"])
+        # Changing the rules is noticed
+        rules = self.instance.engine.rules()
+        with open(self.loadOrder.user_file, 'w') as user_file:
+            user_file.write("[Order]\nTribunal.esm\nMorrowind.esm\n")
+        self.assertIsNot(self.instance.engine.rules(), rules)
+
+    def tearDown(self):
+        import shutil
+        if hasattr(self, "instance"):
+            self.instance.shutdown()
+            self.instance.server_close()
+        (self.loadOrder.base_file, self.loadOrder.user_file) = self.rule_files
+        shutil.rmtree(self.temp_dir)
+
+#Profiler
+class profiler_test(unittest.TestCase):
+    import modules.profiler as profiler
+    import modules.loadOrder as loadOrder
+
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.mkdtemp()
+        self.rule_files = (self.loadOrder.base_file, self.loadOrder.user_file)
+        self.loadOrder.base_file = os.path.abspath("./test8.data/mlox_base.txt")
+        self.loadOrder.user_file = os.path.abspath("./no_user_file.txt")
+
+    def test_stages(self):
+        import json
+        # Not recorded without a running profile
+        with self.profiler.stage("nothing"):
+            pass
+        a_profile = self.profiler.profile(trace_memory=True)
+        a_profile.start()
+        try:
+            l8 = self.loadOrder.loadorder()
+            l8.read_from_file("./userfiles/abot.txt")
+            l8.update()
+        finally:
+            a_profile.stop()
+        names = [stats.name for stats in a_profile.stages.values()]
+        self.assertEqual(names, ["find game directories", "read load order file", "add masters", "read rules: mlox_base.txt",
+                                 "evaluate rules: mlox_base.txt", "add current order", "topological sort"])
+        self.assertIn("topological sort", a_profile.table())
+        a_profile.write_stats(os.path.join(self.temp_dir, "mlox.prof"))
+        a_profile.write_json(os.path.join(self.temp_dir, "mlox.json"))
+        with open(os.path.join(self.temp_dir, "mlox.json")) as json_file:
+            saved = json.load(json_file)
+        self.assertEqual([stats["name"] for stats in saved["stages"]], names)
+        self.assertTrue(saved["functions"])
+        self.assertIsNone(self.profiler.active)
+
+    def test_nested(self):
+        a_profile = self.profiler.profile(use_cprofile=False, trace_memory=True)
+        a_profile.start()
+        with self.profiler.stage("outer"):
+            with self.profiler.stage("inner"):
+                kept = [0] * 100000
+            with self.profiler.stage("inner"):
+                pass
+        a_profile.stop()
+        (outer, inner) = a_profile.stages.values()
+        self.assertEqual((outer.depth, inner.depth, inner.calls), (0, 1, 2))
+        self.assertGreaterEqual(outer.peak, inner.peak)
+        self.assertGreaterEqual(inner.allocated, 800000)
+        del kept
+
+    def tearDown(self):
+        import shutil
+        (self.loadOrder.base_file, self.loadOrder.user_file) = self.rule_files
+        shutil.rmtree(self.temp_dir)
+
+#Benchmark
+class benchmark_test(unittest.TestCase):
+    def test_small_run(self):
+        import json
+        import benchmark
+        import modules.loadOrder as loadOrder
+        base_file = loadOrder.base_file
+        results = benchmark.run_benchmarks([60], repeat=1)
+        self.assertEqual(loadOrder.base_file, base_file)
+        (result,) = json.loads(json.dumps(results))["results"]
+        self.assertEqual(result["plugins"], 60)
+        self.assertEqual(sorted(result["timings"]), sorted(["read_rules", "read_rules_cached", "add_edge", "topo_sort",
+                                                            "add_current_order", "update"]))
+        self.assertIn("topological sort", result["update_stages"])
+        self.assertIn("update", benchmark.format_results(results, results))
+
 #Version
 class version_test(unittest.TestCase):
     import modules.version as version